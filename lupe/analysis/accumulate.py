@@ -0,0 +1,68 @@
+"""Saving, loading and merging the state of accumulators.
+
+An accumulator's counts only depend on which queries it has seen, so the
+queries can be split into shards, such as days of logs, and counted apart,
+in parallel or on different machines. Saving each shard's accumulators to a
+file and merging the files gives the counts for all of the queries, without
+counting any of them again.
+
+Accumulators implement merge(other), which adds the counts of another
+accumulator of the same analysis to their own, and finalize(), which returns
+their results. They are saved with pickle.
+"""
+from collections import Counter, OrderedDict
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+def merge_counts(counts, other):
+    """Adds the counts in other to counts. Both map keys to numbers, or to
+    dicts that are merged the same way."""
+    for (key, value) in other.iteritems():
+        if isinstance(value, dict):
+            merge_counts(counts.setdefault(key, Counter()), value)
+        else:
+            counts[key] = counts.get(key, 0) + value
+
+
+def check_mergeable(accumulator, other, *attributes):
+    """Raises a ValueError unless the accumulators are of the same class and
+    agree on the given attributes, which configure what they count."""
+    if type(accumulator) is not type(other):
+        raise ValueError("Cannot merge %s into %s." %
+            (type(other).__name__, type(accumulator).__name__))
+    for attribute in attributes:
+        if getattr(accumulator, attribute) != getattr(other, attribute):
+            raise ValueError("Cannot merge %s with different %s." %
+                (type(accumulator).__name__, attribute))
+
+
+def save(accumulators, filename):
+    """Saves accumulators, a dict from name to accumulator, to filename."""
+    with open(filename, "wb") as f:
+        pickle.dump(OrderedDict(accumulators), f, pickle.HIGHEST_PROTOCOL)
+
+
+def load(filename):
+    with open(filename, "rb") as f:
+        return pickle.load(f)
+
+
+def merge_states(states):
+    """Merges dicts from name to accumulator, such as loaded from several
+    files, into the first of them and returns it. Accumulators that are not
+    in the first are added to it."""
+    merged = None
+    for state in states:
+        if merged is None:
+            merged = state
+            continue
+        for (name, accumulator) in state.iteritems():
+            if name in merged:
+                merged[name].merge(accumulator)
+            else:
+                merged[name] = accumulator
+    return merged
@@ -0,0 +1,177 @@
+"""Computes the tables and figures that tally parsed queries in one pass.
+
+Each analysis is an accumulator with the parse fields it needs (see
+lupe.parsing.cache), update(query) for each lupe.analysis.stream.ParsedQuery
+and write(output). run() streams the queries of a source once, parses each
+distinct text once for all the fields any of them need, feeds every query to
+every accumulator and then writes all of their outputs.
+
+Which queries are counted is defined once, by QUERY_FILTERS and
+SelectedQueries, for these runs and for the incremental runs of
+lupe.analysis.incremental alike, so both count the same queries. They are
+read with SQL from the queries table of a PostgresDB or SQLite3DB source.
+
+Running this file does what the tab3, tab4, toppaths and fig2 to fig5
+targets of the Makefile do, with one scan of the queries:
+
+    python lupe/analysis/engine.py -s postgresdb -U lupe -P lupe -D lupe -q scheduled -o results -j 8
+
+With --state, the accumulators are also saved, and runs over different
+shards of the queries can then be combined without scanning them again:
+
+    python lupe/analysis/engine.py --merge day1.state day2.state -o results
+"""
+import os
+from collections import OrderedDict
+
+from queryutils.query import QueryType
+
+from lupe.analysis.accumulate import load, merge_states, save
+from lupe.analysis.stream import parsed_queries
+from lupe.clustering.streaming import stream_query
+from lupe.statemachines.compute import TransitionGraph
+from lupe.statemachines.paths import TopPaths
+from lupe.subsequences.lcs import SubsequenceTally
+from lupe.transformations.barchart import TransformTally
+from lupe.transformations.commands import CommandTally
+from lupe.transformations.coverage import CoverageTally
+from lupe.transformations.users import Category, UserTally
+
+ANALYSES = OrderedDict()
+
+# The queries of each query type that the analyses count.
+QUERY_FILTERS = {
+    QueryType.INTERACTIVE: "is_interactive=true AND is_suspicious=false",
+    QueryType.SCHEDULED: "is_interactive=false",
+}
+
+
+def register(name, output, factory):
+    """Registers an analysis. factory is called with the query type and
+    returns the accumulator, whose output is named output in the output
+    directory."""
+    ANALYSES[name] = (output, factory)
+
+
+register("tab3", "tab3", lambda query_type: CommandTally())
+register("tab4", "tab4.csv", lambda query_type: SubsequenceTally())
+register("toppaths", "toppaths.txt", lambda query_type: TopPaths())
+register("fig2", "fig2", lambda query_type: TransformTally())
+register("fig3", "fig3", lambda query_type: TransitionGraph("user"))
+register("fig4", "fig4", lambda query_type: TransitionGraph("solaris3-web-access", threshold=0.))
+register("fig5", "fig5", lambda query_type: TransitionGraph("vmware:perf:", threshold=0.))
+register("coverage", "coverage.csv",
+    lambda query_type: CoverageTally(distinct=(query_type == QueryType.SCHEDULED)))
+register("users-transforms", "users", lambda query_type: UserTally(Category.TRANSFORMS))
+register("users-commands", "users", lambda query_type: UserTally(Category.COMMANDS))
+
+
+class SelectedQueries(object):
+    """Iterates over (user, text) for the queries of query_type with an id
+    above watermark, or all of them, in order of id, itersize rows at a time
+    (see lupe.clustering.streaming). watermark is updated to the last id
+    read, and count is the number of queries read."""
+
+    def __init__(self, source, query_type, watermark=None, itersize=None):
+        if query_type not in QUERY_FILTERS:
+            raise RuntimeError("Invalid query type.")
+        self.source = source
+        self.query_type = query_type
+        self.watermark = watermark
+        self.itersize = itersize
+        self.count = 0
+
+    def __iter__(self):
+        sql = ("SELECT queries.id AS id, users.name AS name, queries.text AS text "
+            "FROM queries, users WHERE queries.user_id=users.id AND " + QUERY_FILTERS[self.query_type])
+        params = ()
+        if self.watermark is not None:
+            sql += " AND queries.id > " + self.source.wildcard
+            params = (self.watermark,)
+        sql += " ORDER BY queries.id"
+        self.source.connect()
+        try:
+            for row in stream_query(self.source, sql, params, self.itersize):
+                self.watermark = row["id"]
+                self.count += 1
+                yield row["name"], row["text"]
+        finally:
+            self.source.close()
+
+
+def make_accumulators(query_type, names=None):
+    """Returns a dict from the name of each of the named analyses, or of all
+    of them, to a new accumulator."""
+    if names is None:
+        names = ANALYSES.keys()
+    return OrderedDict((name, ANALYSES[name][1](query_type)) for name in names)
+
+
+def update(accumulators, queries, workers=1):
+    """Feeds queries, which are (user, text) pairs, to every accumulator."""
+    fields = []
+    for accumulator in accumulators.itervalues():
+        for field in accumulator.fields:
+            if field not in fields:
+                fields.append(field)
+    for query in parsed_queries(queries, fields, workers, users=True):
+        for accumulator in accumulators.itervalues():
+            accumulator.update(query)
+
+
+def write(accumulators, outdir):
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    for (name, accumulator) in accumulators.iteritems():
+        accumulator.write(os.path.join(outdir, ANALYSES[name][0]))
+
+
+def run(source, query_type, outdir, names=None, workers=1, state=None, itersize=None):
+    """Runs the named analyses, or all of them, over one scan of the queries
+    of source and writes their outputs to outdir. If state is given, the
+    accumulators are also saved to it, to be merged with other runs later."""
+    accumulators = make_accumulators(query_type, names)
+    update(accumulators, SelectedQueries(source, query_type, itersize=itersize), workers)
+    if state is not None:
+        save(accumulators, state)
+    write(accumulators, outdir)
+
+
+def merge(states, outdir):
+    """Merges the accumulators saved in the state files and writes their
+    outputs to outdir."""
+    write(merge_states(load(filename) for filename in states), outdir)
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    from queryutils.arguments import get_arguments, initialize_source
+    parser = ArgumentParser(
+        description="Computes the transformation, command, subsequence and transition tables and figures in one pass.")
+    parser.add_argument("-a", "--analyses", nargs="+", choices=ANALYSES.keys(),
+                        help="the analyses to run (default: all)")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of processes to parse queries with; 0 means one per CPU (default: 1)")
+    parser.add_argument("--itersize", type=int,
+                        help="number of rows to fetch from the database at a time (default: 10000)")
+    parser.add_argument("--state",
+                        help="the file to save the accumulators to, for merging later")
+    parser.add_argument("--merge", nargs="+", metavar="STATE",
+                        help="merge saved accumulators and write their outputs instead of scanning a source")
+    args = get_arguments(parser, o=True)
+    if all([arg is None for arg in vars(args).values()]):
+        parser.print_help()
+        exit()
+    if args.output is None:
+        args.output = "results"
+    if args.merge:
+        merge(args.merge, args.output)
+        exit()
+    if args.source is None:
+        raise RuntimeError(
+            "You must specify where to fetch the data and the corresponding arguments (-s or --source).")
+    if args.querytype is None:
+        raise RuntimeError("You must specify a query type.")
+
+    source = initialize_source(args.source, args)
+    run(source, args.querytype, args.output, args.analyses, args.jobs, args.state, args.itersize)
@@ -0,0 +1,96 @@
+"""Keeps the analyses up to date by only scanning queries added since the last run.
+
+The state file holds the accumulators of lupe.analysis.engine together with
+a watermark: the highest id of the queries they have counted. Each run
+fetches the queries with a higher id from the source's queries table, picked
+by the same lupe.analysis.engine.SelectedQueries as a full run, adds them to
+the accumulators, saves the state with the new watermark and writes every
+output. A nightly run then takes time in proportion to a day of logs.
+
+The first run, without a state file, counts all of the queries:
+
+    python lupe/analysis/incremental.py -s postgresdb -U lupe -P lupe -D lupe -q scheduled --state results/scheduled.state -o results
+
+Query ids only grow, so unlike the query time, the watermark does not skip
+queries logged late with the same time as the last one counted.
+"""
+import os
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from lupe.analysis.engine import SelectedQueries, make_accumulators, update, write
+
+
+def load_state(filename):
+    with open(filename, "rb") as f:
+        return pickle.load(f)
+
+
+def save_state(state, filename):
+    """Saves state to filename, replacing any previous state only once the
+    new one is completely written."""
+    directory = os.path.dirname(os.path.abspath(filename))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    tmp = filename + ".tmp"
+    with open(tmp, "wb") as f:
+        pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp, filename)
+
+
+def run(source, query_type, statefile, outdir, names=None, workers=1, itersize=None):
+    """Adds the queries of source that are newer than the watermark in
+    statefile to its accumulators, saves them and writes their outputs. If
+    statefile does not exist, all of the queries are counted, by the named
+    analyses or all of them. Returns the number of new queries."""
+    if os.path.exists(statefile):
+        state = load_state(statefile)
+        if state["query_type"] != query_type:
+            raise RuntimeError("The state in %s is for %s queries." % (statefile, state["query_type"]))
+        if names is not None and set(names) != set(state["accumulators"].keys()):
+            raise RuntimeError("The state in %s is for the analyses %s." %
+                (statefile, ", ".join(state["accumulators"].keys())))
+    else:
+        state = {
+            "query_type": query_type,
+            "watermark": None,
+            "accumulators": make_accumulators(query_type, names),
+        }
+
+    queries = SelectedQueries(source, query_type, state["watermark"], itersize)
+    update(state["accumulators"], queries, workers)
+    state["watermark"] = queries.watermark
+    save_state(state, statefile)
+    write(state["accumulators"], outdir)
+    return queries.count
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    from queryutils.arguments import get_arguments, initialize_source
+    from lupe.analysis.engine import ANALYSES
+    parser = ArgumentParser(
+        description="Updates the analyses with the queries added since the last run.")
+    parser.add_argument("--state", required=True,
+                        help="the file holding the accumulators and the watermark")
+    parser.add_argument("-a", "--analyses", nargs="+", choices=ANALYSES.keys(),
+                        help="the analyses to run on the first run (default: all)")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of processes to parse queries with; 0 means one per CPU (default: 1)")
+    parser.add_argument("--itersize", type=int,
+                        help="number of rows to fetch from the database at a time (default: 10000)")
+    args = get_arguments(parser, o=True)
+    if args.source is None:
+        raise RuntimeError(
+            "You must specify where to fetch the data and the corresponding arguments (-s or --source).")
+    if args.output is None:
+        args.output = "results"
+    if args.querytype is None:
+        raise RuntimeError("You must specify a query type.")
+
+    source = initialize_source(args.source, args)
+    nqueries = run(source, args.querytype, args.state, args.output, args.analyses, args.jobs, args.itersize)
+    print "New queries: %d" % nqueries
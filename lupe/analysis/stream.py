@@ -0,0 +1,42 @@
+"""The parsed form of a stream of queries, as fed to the tallies.
+
+Each distinct text of a chunk of queries is parsed once, and comes with how
+many times each user ran it (see lupe.parsing.dedup). Tallies that are not
+weighted by user only look at the total count.
+"""
+from operator import itemgetter
+
+from lupe.parsing.dedup import count_texts, count_texts_by_user
+from lupe.parsing.parallel import parse_queries
+
+
+class ParsedQuery(object):
+
+    def __init__(self, text, users, categories=None, commands=None):
+        self.text = text
+        self.users = users # user -> number of times they ran the text
+        self.count = sum(users.itervalues())
+        self.categories = categories
+        self.commands = commands
+
+    def weights(self, by_user):
+        """Returns (user, count) for each user that ran the query if by_user,
+        and otherwise (None, count) for all of its runs."""
+        if by_user:
+            return self.users.iteritems()
+        return [(None, self.count)]
+
+
+def parsed_queries(queries, fields, workers=1, users=False):
+    """Yields a ParsedQuery with the given fields (see lupe.parsing.cache)
+    for each distinct text in each chunk of queries, reading the queries a
+    chunk at a time. If users is true, queries are (user, text) pairs;
+    otherwise they are texts and the user is None."""
+    if users:
+        counted = count_texts_by_user(queries)
+    else:
+        counted = ((text, {None: count}) for (text, count) in count_texts(queries))
+    fields = list(fields)
+    for parsed in parse_queries(counted, fields, workers, text=itemgetter(0)):
+        ((text, user_counts), values) = (parsed[0], parsed[1:])
+        yield ParsedQuery(text, user_counts, **dict(zip(fields, values)))
@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+"""
+t-SNE in NumPy, with the repulsive forces approximated Barnes-Hut style.
+
+Input similarities: each point's conditional distribution over its
+3 * perplexity nearest neighbours is calibrated to the perplexity by bisection
+on the Gaussian precision, for all points at once, and then symmetrized into
+a sparse joint distribution P (van der Maaten, 2014).
+
+Gradient: the attractive forces are summed over the edges of P. The repulsive
+forces are summed exactly for small inputs. Otherwise a tree of Morton-ordered
+grid cells is built over the embedding, with each cell summarized by its point
+count and centre of mass. A cell whose width over its distance from a point is
+below theta stands in for all of its points. The tree is walked one level at
+a time for a chunk of points at once, so each iteration takes O(n log n).
+
+The optimizer is gradient descent with momentum and per-coordinate gains. P
+is exaggerated for the first iterations so that clusters form early.
+"""
+
+from distances import nearest_neighbors
+import numpy as np
+import scipy.sparse as sparse
+
+PERPLEXITY = 30.
+THETA = .5
+MAX_ITERATIONS = 1000
+EXAGGERATION = 12.
+EXAGGERATION_ITERATIONS = 250
+LEARNING_RATE = 200.
+INITIAL_MOMENTUM = .5
+FINAL_MOMENTUM = .8
+MIN_GAIN = .01
+EXACT_MAX_POINTS = 2000 # sum the repulsive forces exactly up to this many points
+CHUNK_SIZE = 1 << 12 # points walked through the tree at once
+MAX_DEPTH = 30 # points closer than 2**-30 of the embedding's width coincide
+PERPLEXITY_TOLERANCE = 1e-5
+PERPLEXITY_STEPS = 100
+
+
+def embed(data, no_dims=2, perplexity=PERPLEXITY, theta=THETA,
+        max_iter=MAX_ITERATIONS, random_state=None):
+
+    X = np.asarray(data, dtype=np.float64)
+    n = X.shape[0]
+    rng = np.random.RandomState(random_state)
+    if n < 2:
+        return np.zeros((n, no_dims))
+
+    P = joint_probabilities(X, perplexity)
+    exact = theta <= 0. or n <= EXACT_MAX_POINTS
+    Y = rng.normal(scale=1e-4, size=(n, no_dims))
+    velocity = np.zeros_like(Y)
+    gains = np.ones_like(Y)
+    for iteration in range(max_iter):
+        early = iteration < EXAGGERATION_ITERATIONS
+        exaggeration = EXAGGERATION if early else 1.
+        momentum = INITIAL_MOMENTUM if early else FINAL_MOMENTUM
+        grad = gradient(P, Y, exaggeration, theta, exact)
+        same_sign = (grad > 0.) == (velocity > 0.)
+        gains = np.where(same_sign, gains * .8, gains + .2)
+        np.maximum(gains, MIN_GAIN, out=gains)
+        velocity = momentum * velocity - LEARNING_RATE * gains * grad
+        Y += velocity
+        Y -= Y.mean(axis=0)
+    return Y
+
+
+def joint_probabilities(X, perplexity):
+    """The symmetrized input similarities, as arrays of rows, columns and
+    values of the nonzero entries."""
+    n = X.shape[0]
+    k = max(1, min(n - 1, int(3. * perplexity)))
+    indices, neighbor_distances = nearest_neighbors(X, k)
+    conditional = calibrate(neighbor_distances ** 2, perplexity)
+    P = sparse.csr_matrix((conditional.ravel(), (np.repeat(np.arange(n), k), indices.ravel())),
+        shape=(n, n))
+    P = (P + P.T).tocoo()
+    return P.row, P.col, P.data / P.data.sum()
+
+
+def calibrate(squared_distances, perplexity):
+    """Each row's Gaussian conditional distribution over its neighbours, with
+    the precision found by bisection so that its entropy is log(perplexity)."""
+    (n, k) = squared_distances.shape
+    target = np.log(min(perplexity, k))
+    # Shifting by the nearest distance leaves the distribution unchanged and
+    # keeps the largest weight at one.
+    D = squared_distances - squared_distances[:, :1]
+    beta = np.ones(n)
+    low = np.zeros(n)
+    high = np.empty(n)
+    high.fill(np.inf)
+    for _ in range(PERPLEXITY_STEPS):
+        W = np.exp(-D * beta[:, np.newaxis])
+        sums = W.sum(axis=1)
+        entropy = np.log(sums) + beta * (D * W).sum(axis=1) / sums
+        if (np.abs(entropy - target) <= PERPLEXITY_TOLERANCE).all():
+            break
+        too_flat = entropy > target
+        low = np.where(too_flat, beta, low)
+        high = np.where(too_flat, high, beta)
+        beta = np.where(np.isinf(high), beta * 2., (low + high) / 2.)
+    W = np.exp(-D * beta[:, np.newaxis])
+    return W / W.sum(axis=1)[:, np.newaxis]
+
+
+def gradient(P, Y, exaggeration, theta, exact):
+    attractive = attractive_forces(P, Y)
+    if exact:
+        repulsive, Z = exact_repulsive_forces(Y)
+    else:
+        repulsive, Z = tree_repulsive_forces(Y, theta)
+    return 4. * (exaggeration * attractive - repulsive / Z)
+
+
+def attractive_forces(P, Y):
+    (rows, cols, values) = P
+    diff = Y[rows] - Y[cols]
+    weights = values / (1. + (diff * diff).sum(axis=1))
+    return sum_by_point(rows, weights[:, np.newaxis] * diff, Y.shape)
+
+
+def sum_by_point(points, values, shape):
+    total = np.empty(shape)
+    for dim in range(shape[1]):
+        total[:, dim] = np.bincount(points, weights=values[:, dim], minlength=shape[0])
+    return total
+
+
+def exact_repulsive_forces(Y):
+    """The unnormalized repulsive forces and the normalization Z."""
+    squared_norms = (Y * Y).sum(axis=1)
+    Q = np.dot(Y, Y.T)
+    Q *= -2.
+    Q += squared_norms[:, np.newaxis]
+    Q += squared_norms[np.newaxis, :]
+    np.maximum(Q, 0., out=Q)
+    Q += 1.
+    Q = np.divide(1., Q, out=Q)
+    np.fill_diagonal(Q, 0.)
+    Z = Q.sum()
+    Q *= Q
+    return Q.sum(axis=1)[:, np.newaxis] * Y - np.dot(Q, Y), Z
+
+
+class SpaceTree(object):
+    """A hierarchy of grid cells over the points. At each level, keys holds
+    the sorted Morton codes of the nonempty cells, with their point counts and
+    centres of mass. children gives each cell's range of cells at the next
+    level, and the leaves' points are order[leaf_starts:leaf_ends]."""
+
+    def __init__(self, Y):
+        (n, d) = Y.shape
+        max_depth = min(MAX_DEPTH, 62 // d)
+        low = Y.min(axis=0)
+        width = (Y.max(axis=0) - low).max()
+        if width <= 0.:
+            width = 1.
+        side = 2 ** max_depth
+        grid = np.floor((Y - low) / width * side).astype(np.int64)
+        np.clip(grid, 0, side - 1, out=grid)
+        shifts = np.arange(d, dtype=np.int64)
+        finest = np.zeros(n, dtype=np.int64)
+        for level in range(1, max_depth + 1):
+            bits = (grid >> (max_depth - level)) & 1
+            finest = (finest << d) | (bits << shifts).sum(axis=1)
+        distinct = len(np.unique(finest))
+
+        # Subdivide until no cell holds more than one distinct point, however
+        # tightly the points are clustered.
+        self.levels = []
+        level = 0
+        while True:
+            key = finest >> (d * (max_depth - level))
+            keys, inverse = np.unique(key, return_inverse=True)
+            counts = np.bincount(inverse)
+            centers = np.empty((len(keys), d))
+            for dim in range(d):
+                centers[:, dim] = np.bincount(inverse, weights=Y[:, dim]) / counts
+            self.levels.append((keys, counts, centers))
+            if len(keys) == distinct:
+                break
+            level += 1
+        self.depth = level
+        self.widths = width / 2. ** np.arange(self.depth + 1)
+
+        self.children = []
+        for level in range(self.depth):
+            parents = self.levels[level + 1][0] >> d
+            keys = self.levels[level][0]
+            self.children.append((np.searchsorted(parents, keys, side="left"),
+                np.searchsorted(parents, keys, side="right")))
+
+        self.order = np.argsort(key, kind="mergesort")
+        leaves = self.levels[-1][0]
+        self.leaf_starts = np.searchsorted(key[self.order], leaves, side="left")
+        self.leaf_ends = np.searchsorted(key[self.order], leaves, side="right")
+
+
+def expand(pairs, starts, ends):
+    """Replaces each pair's cell with every index in its [start, end) range,
+    returning the repeated pairs and the indices."""
+    counts = ends - starts
+    total = counts.sum()
+    offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(pairs, counts), np.repeat(starts, counts) + offsets
+
+
+def tree_repulsive_forces(Y, theta):
+    tree = SpaceTree(Y)
+    forces = np.empty_like(Y)
+    Z = 0.
+    for start in range(0, Y.shape[0], CHUNK_SIZE):
+        points = np.arange(start, min(start + CHUNK_SIZE, Y.shape[0]))
+        forces[points], chunk_Z = walk(tree, Y, points, theta)
+        Z += chunk_Z
+    return forces, Z
+
+
+def walk(tree, Y, points, theta):
+    forces = np.zeros((len(points), Y.shape[1]))
+    Z = 0.
+    # Pairs of a position in points and a cell at the current level.
+    pairs = np.arange(len(points))
+    cells = np.zeros(len(points), dtype=np.int64)
+    for level in range(tree.depth + 1):
+        (_, counts, centers) = tree.levels[level]
+        diff = Y[points[pairs]] - centers[cells]
+        squared = (diff * diff).sum(axis=1)
+        count = counts[cells]
+        # A cell holding a single point is exact at any distance. It is the
+        # point itself if they coincide, as a duplicate would share the cell.
+        accept = (tree.widths[level] ** 2 < theta * theta * squared) | (count == 1)
+        use = accept & ~((count == 1) & (squared == 0.))
+        q = 1. / (1. + squared[use])
+        Z += (count[use] * q).sum()
+        forces += sum_by_point(pairs[use], (count[use] * q * q)[:, np.newaxis] * diff[use],
+            forces.shape)
+        pairs, cells = pairs[~accept], cells[~accept]
+        if level < tree.depth:
+            (starts, ends) = tree.children[level]
+            pairs, cells = expand(pairs, starts[cells], ends[cells])
+    # Whatever is left shares a leaf with more than one point.
+    pairs, members = expand(pairs, tree.leaf_starts[cells], tree.leaf_ends[cells])
+    members = tree.order[members]
+    others = members != points[pairs]
+    pairs, members = pairs[others], members[others]
+    diff = Y[points[pairs]] - Y[members]
+    q = 1. / (1. + (diff * diff).sum(axis=1))
+    Z += q.sum()
+    forces += sum_by_point(pairs, (q * q)[:, np.newaxis] * diff, forces.shape)
+    return forces, Z
@@ -1,41 +1,72 @@
 
 import spectral as spectral_module
 import kmedoids as kmedoids_module
+import distances as distances_module
+import kmeans as kmeans_module
 from featurize import get_features
 
 from argparse import ArgumentParser
-from numpy import array, linalg, zeros
 
 # TODO: Add clustering methods from scipy here.
 
+DISTANCE_SETTINGS = {
+    'metric': 'euclidean', # euclidean, cosine, manhattan or chebyshev
+    'condensed': False, # store only the upper triangle of the matrix
+    'dtype': 'float64', # float64 or float32
+
+    # If set, the distance matrix is backed by a memory-mapped file of this
+    # name instead of being held in memory.
+    'filename': None,
+
+    # Number of processes filling the distance matrix; 0 means one per CPU.
+    'workers': 1,
+}
+
+CLARA_SETTINGS = {
+    'samples': kmedoids_module.CLARA_SAMPLES, # number of subsamples to cluster
+    'sample_size': None, # points per subsample; None means 40 + 2k
+}
+
+SPECTRAL_SETTINGS = {
+    'neighbors': spectral_module.NEIGHBORS, # neighbours per point in the graph
+    'epsilon': None, # if set, connect all points within this distance instead
+}
+
 def kmedoids(points, k):
-    distances = build_distance_matrix(points)
+    distances = build_distance_storage(points)
     return kmedoids_module.cluster(distances, k=k)
 
+def clara(points, k):
+    return kmedoids_module.clara(points, k=k,
+        samples=CLARA_SETTINGS['samples'],
+        sample_size=CLARA_SETTINGS['sample_size'],
+        metric=DISTANCE_SETTINGS['metric'])
+
+def minibatch(points, k):
+    return kmeans_module.minibatch_cluster(points, k=k)
+
 def spectral(points, k):
-    distances = build_distance_matrix(points)
+    distances = build_distance_storage(points)
     return spectral_module.cluster(distances, k=k)
 
-def build_distance_matrix(data, normalize=False):
-    m = len(data)
-    distances = zeros((m, m))
-    i = j = 0.
-    max_distance = -1e10
-    for i in range(m):
-        for j in range(i + 1, m):
-            p = data[i]
-            q = data[j]
-            distance = dist(p, q)
-            max_distance = max(max_distance, distance)
-            distances[i, j] = distances[j, i] = distance
-    if normalize:
-        return distances / max_distance
-    return distances
-
-def dist(a, b):
-    a = array([float(x) for x in a])
-    b = array([float(x) for x in b])
-    return linalg.norm(a - b)
+def sparse_spectral(points, k):
+    return spectral_module.cluster_sparse(points, k=k,
+        neighbors=SPECTRAL_SETTINGS['neighbors'],
+        epsilon=SPECTRAL_SETTINGS['epsilon'],
+        metric=DISTANCE_SETTINGS['metric'])
+
+def build_distance_matrix(data, normalize=False, metric="euclidean"):
+    return distances_module.build_distance_matrix(data, normalize=normalize, metric=metric)
+
+def build_distance_storage(data, normalize=False):
+    """Builds the distance matrix using the storage in DISTANCE_SETTINGS."""
+    settings = DISTANCE_SETTINGS
+    return distances_module.build_distance_matrix(data, normalize=normalize,
+        metric=settings['metric'],
+        condensed=settings['condensed'],
+        dtype=settings['dtype'],
+        filename=settings['filename'],
+        workers=settings['workers'])
 
 def main(k, input, output):
     points, ids = read_points(input)
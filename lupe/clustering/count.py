@@ -1,10 +1,12 @@
 from collections import defaultdict
+from operator import itemgetter
 import numpy
 import matplotlib.pyplot as plt
 from queryutils.arguments import get_arguments, lookup, SOURCES
 from queryutils.query import QueryType
-from queryutils.parse import tokenize_query, split_query_into_stages, parse_query
-from queryutils.splunktypes import lookup_categories
+from queryutils.parse import tokenize_query
+from lupe.parsing.cache import CATEGORIES, PARSETREE, lookup_categories, parse_query, split_query_into_stages
+from lupe.parsing.parallel import parse_stages
 from featurize import get_features, featurize_obj
 import classify
 
@@ -68,9 +70,9 @@ TRANSFORM_LABELS = {
     "Aggregate": AGGREGATE_LABELS
 }
 
-def main(source, query_type, user_weighted, chosen_transform, examples, output, classify=False):
+def main(source, query_type, user_weighted, chosen_transform, examples, output, classify=False, workers=1):
     if classify:
-        classify_and_count(source, query_type, user_weighted, chosen_transform, examples, output)
+        classify_and_count(source, query_type, user_weighted, chosen_transform, examples, output, workers)
     else:
         count_examples(examples, output, chosen_transform)
 
@@ -86,24 +88,26 @@ def count_examples(examples, output, transform):
 def lookup_label(transform, code):
     return TRANSFORM_LABELS[transform][code]
 
-def classify_and_count(source, query_type, user_weighted, chosen_transform, examples, output):
+def classify_and_count(source, query_type, user_weighted, chosen_transform, examples, output, workers=1):
     clf = classify.fit_classifier(examples)
     if user_weighted:
-        classify_and_count_weighted(source, query_type, chosen_transform, clf, output)
+        classify_and_count_weighted(source, query_type, chosen_transform, clf, output, workers)
     else:
-        classify_and_count_unweighted(source, query_type, chosen_transform, clf, output)
+        classify_and_count_unweighted(source, query_type, chosen_transform, clf, output, workers)
 
-def classify_and_count_weighted(source, query_type, chosen_transform, clf, output):
+def classify_and_count_weighted(source, query_type, chosen_transform, clf, output, workers=1):
     chosen_transform_counts = {}
-    for (user, query) in source.fetch_queries_by_user(query_type):
+    queries = source.fetch_queries_by_user(query_type)
+    for ((user, query), stages) in parse_query_stages(queries, workers, text=itemgetter(1)):
         if not user in chosen_transform_counts:
             chosen_transform_counts[user] = defaultdict(int)
-        classify_and_count_query(query, chosen_transform, chosen_transform_counts[user], clf)
+        classify_and_count_query(query, chosen_transform, chosen_transform_counts[user], clf, stages)
 
-def classify_and_count_unweighted(source, query_type, chosen_transform, clf, output):
+def classify_and_count_unweighted(source, query_type, chosen_transform, clf, output, workers=1):
     chosen_transform_counts = defaultdict(int)
-    for query in source.fetch_queries(query_type):
-        classify_and_count_query(query, chosen_transform, chosen_transform_counts, clf)
+    queries = source.fetch_queries(query_type)
+    for (query, stages) in parse_query_stages(queries, workers):
+        classify_and_count_query(query, chosen_transform, chosen_transform_counts, clf, stages)
     print_counts(chosen_transform_counts, totalincl=True)
 
 def print_counts(cnts, totalincl=False):
@@ -120,17 +124,29 @@ def print_chosen_transform_counts(cnts):
             pct *= 2 # Because we count the total of transforms too
         print "%50s %6d %.2f" % (label, cnt, pct)
 
-def classify_and_count_query(query, chosen_transform, counts, clf):
-    stages = split_query_into_stages(query)
-    for pos, stage in enumerate(stages):
-        transforms = lookup_categories(stage)
+def parse_query_stages(queries, workers=1, text=None):
+    """Yields each query with (stage, transforms, parsetree) for its stages.
+    With several workers every stage is parsed up front. With one, the parse
+    trees are None and only the stages that get classified are parsed."""
+    if workers == 1:
+        for (query, stages) in parse_stages(queries, [CATEGORIES], workers, text):
+            yield query, [(stage, transforms, None) for (stage, transforms) in stages]
+    else:
+        for parsed in parse_stages(queries, [CATEGORIES, PARSETREE], workers, text):
+            yield parsed
+
+def classify_and_count_query(query, chosen_transform, counts, clf, stages=None):
+    if stages is None:
+        stages = [(stage, lookup_categories(stage), None) for stage in split_query_into_stages(query)]
+    for pos, (stage, transforms, p) in enumerate(stages):
         if len(transforms) == 0:
             print query
             print stage
             continue
         if transforms[0] == chosen_transform:
             counts[chosen_transform] += 1
-            p = parse_query(stage)
+            if p is None:
+                p = parse_query(stage)
             if p is not None:
                 p.position = pos
                 code = CLASSIFY_STAGE[chosen_transform](p, clf)
@@ -169,6 +185,8 @@ if __name__ == "__main__":
                         help="the training data file to train the classifier (.csv)")
     parser.add_argument("-c", "--classify", action="store_true",
                         help="whether or not to classify the entire data set or simply count examples")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of processes to parse queries with; 0 means one per CPU (default: 1)")
     args = get_arguments(parser, o=True, w=True)
     if all([arg is None for arg in vars(args).values()]):
         parser.print_help()
@@ -185,5 +203,5 @@ if __name__ == "__main__":
     src_class = SOURCES[args.source][0]
     src_args = lookup(vars(args), SOURCES[args.source][1])
     source = src_class(*src_args)
-    main(source, args.querytype, args.weighted, args.transform, args.examples, args.output, args.classify)
+    main(source, args.querytype, args.weighted, args.transform, args.examples, args.output, args.classify, args.jobs)
 
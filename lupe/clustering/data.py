@@ -1,9 +1,11 @@
-from featurize import get_features, featurize_obj
-from json import dump
+from featurize import get_features, featurize_obj, featurize_parallel, feature_names
+from json import dump, dumps
 from logging import getLogger as get_logger
 from os import path, walk
+from store import FeatureMatrix
 from time import time
 import csv
+import numpy
 
 logger = get_logger("lupe")
 
@@ -17,10 +19,7 @@ class Clusterees(object):
     QUERYGROUPS = "querygroups"
 
 
-def fetch_data(source, clusterees):
-    logger.debug("[pipeline] - Fetching data.")
-    start = time()
-    data = None
+def get_fetcher(source, clusterees):
     fetchers = {
         Clusterees.SESSIONS: (source.get_sessions, label_session),
         Clusterees.FILTERS: (source.get_unique_filters, label_parsetree),
@@ -32,8 +31,14 @@ def fetch_data(source, clusterees):
     if fetcher is None:
         raise RuntimeError(
             "No valid set of objects to cluster over has been chosen.")
-    fetch = fetcher[0]
-    label = fetcher[1]
+    return fetcher
+
+
+def fetch_data(source, clusterees):
+    logger.debug("[pipeline] - Fetching data.")
+    start = time()
+    data = None
+    (fetch, label) = get_fetcher(source, clusterees)
     data = []
     mouseovers = []
     for d in fetch():
@@ -46,6 +51,22 @@ def fetch_data(source, clusterees):
     return data, mouseovers
 
 
+def stream_data(source, clusterees, mouseovers_filename):
+    """Yields objects as they are fetched, writing their mouseovers to the
+    same file output_mouseovers would without keeping them in memory."""
+    (fetch, label) = get_fetcher(source, clusterees)
+    filename = ".".join([mouseovers_filename, "json"])
+    with open(filename, 'w') as f:
+        f.write("[")
+        separator = "\n    "
+        for d in fetch():
+            f.write(separator + dumps(label(d), sort_keys=True))
+            separator = ",\n    "
+            if d is not None:
+                yield d
+        f.write("\n]")
+
+
 def label_session(session):
     label = ["User: " + session.user.name]
     for query in session.queries:
@@ -67,42 +88,85 @@ def output_mouseovers(mouseovers, filename):
         dump(mouseovers, f, sort_keys=True, indent=4, separators=(',', ': '))
 
 
-def featurize(objects, features):
+def featurize_rows(objects, featurecode, workers=1):
+    """Yields the id and the feature vector of each of objects that could be
+    featurized, in order. With more than one worker, 0 meaning one per CPU,
+    the objects are featurized in a pool of processes. The vector is only
+    valid until the next one is yielded."""
+    if workers == 1:
+        features = get_features(featurecode)
+        row = numpy.empty(len(feature_names(features)))
+        for obj in objects:
+            if featurize_obj(obj, features, row) is not None:
+                yield obj.id, row
+        return
+    for (fid, row) in featurize_parallel(objects, featurecode, workers):
+        if row is not None:
+            yield fid, row
+
+
+def featurize(objects, features, workers=1):
+    """Featurizes a list of objects into a FeatureMatrix, leaving out the
+    objects that could not be featurized."""
     logger.debug("[pipeline] - Computing features.")
     start = time()
-    features = get_features(features)
-    feature_vectors = [fid + feature_vector for (fid, feature_vector) in
-                       [([obj.id], featurize_obj(obj, features))
-                        for obj in objects]
-                       if feature_vector is not None]
-    if not feature_vectors:
+    names = feature_names(get_features(features))
+    vectors = numpy.empty((len(objects), len(names)))
+    ids = []
+    for (fid, row) in featurize_rows(objects, features, workers):
+        vectors[len(ids)] = row
+        ids.append(fid)
+    if len(ids) < len(objects):
+        logger.warning("[pipeline] - Objects that could not be featurized: " + str(len(objects) - len(ids)))
+    if not ids:
         raise RuntimeError(
             "Featurizing was unsuccessful -- no features computed.")
+    vectors.resize((len(ids), len(names)), refcheck=False)
     elapsed = time() - start 
     logger.debug("[pipeline] - Time to featurize (seconds): " + str(elapsed))
-    f = feature_vectors[0]
-    logger.debug("[pipeline] - Number of features per object computed: " + str(len(f)))
-    return feature_vectors
-
-
-def output_features(feature_vectors, filename):
+    logger.debug("[pipeline] - Number of features per object computed: " + str(len(names)))
+    return FeatureMatrix(numpy.array(ids), vectors, names)
+
+
+def featurize_chunks(objects, features, chunk_size, workers=1):
+    """Featurizes objects from an iterable chunk_size at a time, yielding a
+    list of ids and an array of feature vectors for each chunk."""
+    width = len(feature_names(get_features(features)))
+    ids = []
+    vectors = numpy.empty((chunk_size, width))
+    for (fid, row) in featurize_rows(objects, features, workers):
+        vectors[len(ids)] = row
+        ids.append(fid)
+        if len(ids) == chunk_size:
+            yield ids, vectors
+            ids = []
+            vectors = numpy.empty((chunk_size, width))
+    if ids:
+        yield ids, vectors[:len(ids)]
+
+
+def output_features(features, filename):
     filename = ".".join([filename, "csv"])
     with open(filename, 'w') as f:
-        writer = csv.writer(f)
-        for v in feature_vectors:
-            writer.writerow(v)
+        write_features(features, f)
+
+
+def write_features(features, f):
+    """Writes the rows of features, a FeatureMatrix, to the open file f."""
+    writer = csv.writer(f)
+    for row in features.rows():
+        writer.writerow(row)
 
 
 def fetch_features(filename):
     logger.debug("[pipeline] - Fetching features.")
     start = time()
-    with open(filename, 'r') as f:
-        reader = csv.reader(f)
-        features = [[float(r) for r in row] for row in reader]
+    rows = numpy.loadtxt(filename, delimiter=",", ndmin=2)
+    features = FeatureMatrix(rows[:, 0], rows[:, 1:])
     elapsed = time() - start 
     logger.debug("[pipeline] - Time to fetch features (seconds): " + str(elapsed))
     logger.debug("[pipeline] - Number of vectors fetched: " + str(len(features)))
-    logger.debug("[pipeline] - Number of features per vector: " + str(len(features[0])))
+    logger.debug("[pipeline] - Number of features per vector: " + str(features.vectors.shape[1]))
     return features
 
 
@@ -1,4 +1,5 @@
 import os
+from lupe.clustering.streaming import stream_query
 
 DATABASE_SETTINGS = {
     'driver': 'psycopg2', # sqlite3 or psycopg2
@@ -10,6 +11,7 @@ DATABASE_SETTINGS = {
     'password': 'lupe', # postgres only
     'host': None, # postgres only, if the DB is on a different machine
     'port': 5432, # postgres only, this is the default value.
+    'directory': '', # sqlite only, where the DB file is; relative to the working directory
 }
 
 DB_DRIVER = __import__(DATABASE_SETTINGS['driver'], globals(), locals(), [], -1)
@@ -92,6 +94,11 @@ class Database(object):
             cursor.execute(query, params)
             return cursor
 
+    def stream(self, query, params=(), itersize=None):
+        if not self.connection:
+            raise ValueError("Must connect to database before running queries.")
+        return stream_query(self, query, params, itersize)
+
     def close(self):
         self.connection.close()
         self.connection = None
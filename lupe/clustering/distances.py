@@ -0,0 +1,440 @@
+#!/usr/bin/env python
+"""
+Blocked all-pairs distance computation.
+
+The feature matrix is converted once to a contiguous float64 array and the
+distance matrix is filled one block of rows at a time, so each metric runs as
+a handful of NumPy operations per block instead of one Python call per pair.
+Only the upper triangle is computed; the lower triangle is its mirror image.
+
+Blocks can also be filled by a pool of worker processes that share the
+feature matrix and the output. Every block is computed by the same code no
+matter which process runs it, so the result is identical to a serial run.
+
+The result can be stored densely or as a condensed upper triangle, in float64
+or float32, and in memory or in a memory-mapped file. Consumers that want to
+work with either representation should go through rows(), columns() and
+submatrix() rather than indexing the matrix directly.
+"""
+
+from multiprocessing import Pool, RawArray, cpu_count
+import numpy as np
+
+BLOCK_SIZE = 512 # rows per block
+BLOCK_ELEMENTS = 1 << 22 # cap on the number of entries in one block
+
+
+def as_matrix(data):
+    return np.ascontiguousarray(data, dtype=np.float64)
+
+
+def euclidean(X, Y, XX=None, YY=None):
+    # Gram-matrix identity: |x - y|^2 = |x|^2 + |y|^2 - 2 x.y
+    if XX is None:
+        XX = np.einsum("ij,ij->i", X, X)
+    if YY is None:
+        YY = np.einsum("ij,ij->i", Y, Y)
+    D = np.dot(X, Y.T)
+    D *= -2.
+    D += XX[:, np.newaxis]
+    D += YY[np.newaxis, :]
+    np.maximum(D, 0., out=D) # Rounding can make this slightly negative.
+    return np.sqrt(D, out=D)
+
+
+def cosine(X, Y, XX=None, YY=None):
+    if XX is None:
+        XX = np.einsum("ij,ij->i", X, X)
+    if YY is None:
+        YY = np.einsum("ij,ij->i", Y, Y)
+    xnorm = np.sqrt(XX)
+    ynorm = np.sqrt(YY)
+    xnorm[xnorm == 0.] = 1.
+    ynorm[ynorm == 0.] = 1.
+    D = np.dot(X, Y.T)
+    D /= xnorm[:, np.newaxis]
+    D /= ynorm[np.newaxis, :]
+    np.clip(D, -1., 1., out=D)
+    return np.subtract(1., D, out=D)
+
+
+def manhattan(X, Y):
+    # Accumulate one feature at a time so the temporary is only a block.
+    D = np.zeros((X.shape[0], Y.shape[0]))
+    for col in range(X.shape[1]):
+        D += np.abs(X[:, col, np.newaxis] - Y[np.newaxis, :, col])
+    return D
+
+
+def chebyshev(X, Y):
+    D = np.zeros((X.shape[0], Y.shape[0]))
+    for col in range(X.shape[1]):
+        np.maximum(D, np.abs(X[:, col, np.newaxis] - Y[np.newaxis, :, col]), out=D)
+    return D
+
+
+METRICS = {
+    "euclidean": euclidean,
+    "cosine": cosine,
+    "manhattan": manhattan,
+    "chebyshev": chebyshev,
+}
+
+# Metrics that can reuse the squared row norms of the feature matrix.
+NORM_METRICS = [euclidean, cosine]
+
+
+def get_metric(metric):
+    if callable(metric):
+        return metric
+    try:
+        return METRICS[metric]
+    except KeyError:
+        raise RuntimeError("No such distance metric: " + str(metric))
+
+
+def pairwise(X, Y, metric="euclidean"):
+    """Distances between every row of X and every row of Y."""
+    metric = get_metric(metric)
+    X = as_matrix(X)
+    Y = as_matrix(Y)
+    if metric in METRICS.values():
+        return metric(X, Y)
+    return callable_block(metric, X, Y)
+
+
+def callable_block(metric, X, Y):
+    # Arbitrary Python metrics cannot be vectorized; evaluate them per pair.
+    D = np.empty((X.shape[0], Y.shape[0]))
+    for i in range(X.shape[0]):
+        for j in range(Y.shape[0]):
+            D[i, j] = metric(X[i], Y[j])
+    return D
+
+
+def compute_block(X, start, stop, metric, norms=None):
+    """Distances from rows [start, stop) to rows [start, m) of X."""
+    if metric in NORM_METRICS:
+        block = metric(X[start:stop], X[start:], norms[start:stop], norms[start:])
+    elif metric in METRICS.values():
+        block = metric(X[start:stop], X[start:])
+    else:
+        block = callable_block(metric, X[start:stop], X[start:])
+    # Make the square part exactly symmetric with a zero diagonal.
+    square = block[:, :stop - start]
+    upper = np.triu(square, 1)
+    square[:] = upper + upper.T
+    return block
+
+
+def rows_per_block(m, block_size=BLOCK_SIZE):
+    return max(1, min(block_size, BLOCK_ELEMENTS // max(m, 1)))
+
+
+def block_bounds(m, block_size=BLOCK_SIZE):
+    block_size = rows_per_block(m, block_size)
+    return [(start, min(start + block_size, m)) for start in range(0, m, block_size)]
+
+
+def condensed_size(m):
+    # A memmap cannot be empty, so always allocate at least one entry.
+    return max(m * (m - 1) // 2, 1)
+
+
+def upper_mask(start, stop, m):
+    """Selects, in row-major order, the strictly upper triangular entries of
+    the block of rows [start, stop) by columns [start, m)."""
+    return np.triu(np.ones((stop - start, m - start), dtype=bool), 1)
+
+
+class CondensedDistances(object):
+    """The strictly upper triangle of a symmetric matrix with a zero diagonal,
+    stored row by row in a flat array of m * (m - 1) / 2 entries.
+
+    The flat array can be held in memory or backed by a file via numpy.memmap.
+    """
+
+    def __init__(self, m, dtype=np.float64, filename=None, data=None, mode="w+"):
+        self.m = m
+        self.shape = (m, m)
+        self.dtype = np.dtype(dtype)
+        self.filename = filename
+        if data is not None:
+            self.data = data
+        elif filename is not None:
+            self.data = np.memmap(filename, dtype=self.dtype, mode=mode, shape=(condensed_size(m),))
+        else:
+            self.data = np.zeros(condensed_size(m), dtype=self.dtype)
+        rows = np.arange(m + 1, dtype=np.int64)
+        self.offsets = rows * m - rows * (rows + 1) // 2
+
+    def __len__(self):
+        return self.m
+
+    def empty_like(self, suffix=""):
+        filename = self.filename + suffix if self.filename is not None else None
+        return CondensedDistances(self.m, dtype=self.dtype, filename=filename)
+
+    def positions(self, i, j):
+        """Flat positions of the entries (i, j), which must not be diagonal."""
+        lo = np.minimum(i, j)
+        hi = np.maximum(i, j)
+        return self.offsets[lo] + (hi - lo - 1)
+
+    def set_block(self, start, stop, block):
+        """Stores the block of rows [start, stop) by columns [start, m)."""
+        self.data[self.offsets[start]:self.offsets[stop]] = block[upper_mask(start, stop, self.m)]
+
+    def get_block(self, start, stop):
+        """The upper triangular part of rows [start, stop) by columns [start, m)."""
+        block = np.zeros((stop - start, self.m - start), dtype=self.dtype)
+        block[upper_mask(start, stop, self.m)] = self.data[self.offsets[start]:self.offsets[stop]]
+        return block
+
+    def rows(self, idx):
+        idx = np.asarray(idx, dtype=np.int64)
+        out = np.zeros((len(idx), self.m), dtype=self.dtype)
+        for (r, i) in enumerate(idx):
+            if i > 0:
+                lower = np.arange(i)
+                out[r, :i] = self.data[self.offsets[lower] + (i - lower - 1)]
+            out[r, i + 1:] = self.data[self.offsets[i]:self.offsets[i + 1]]
+        return out
+
+    def submatrix(self, idx):
+        idx = np.asarray(idx, dtype=np.int64)
+        out = np.zeros((len(idx), len(idx)), dtype=self.dtype)
+        step = rows_per_block(len(idx))
+        for start in range(0, len(idx), step):
+            I = idx[start:start + step, np.newaxis]
+            J = idx[np.newaxis, :]
+            off_diagonal = I != J
+            positions = self.positions(I, J)
+            out[start:start + step][off_diagonal] = self.data[positions[off_diagonal]]
+        return out
+
+    def dot(self, x):
+        """The product of the full symmetric matrix with the vector x."""
+        x = np.asarray(x, dtype=np.float64)
+        y = np.zeros(self.m)
+        for (start, stop) in block_bounds(self.m):
+            block = self.get_block(start, stop)
+            y[start:stop] += np.dot(block, x[start:])
+            y[start:] += np.dot(block.T, x[start:stop])
+        return y
+
+    def max(self):
+        return self.data.max() if self.m > 1 else 0.
+
+    def divide(self, value):
+        self.data /= value
+
+    def todense(self):
+        dense = np.zeros(self.shape, dtype=self.dtype)
+        for (start, stop) in block_bounds(self.m):
+            block = self.get_block(start, stop)
+            dense[start:stop, start:] += block
+            dense[start:, start:stop] += block.T
+        return dense
+
+    def flush(self):
+        if isinstance(self.data, np.memmap):
+            self.data.flush()
+
+
+def is_condensed(distances):
+    return isinstance(distances, CondensedDistances)
+
+
+def rows(distances, idx):
+    if is_condensed(distances):
+        return distances.rows(idx)
+    return distances[idx, :]
+
+
+def columns(distances, idx):
+    # The matrix is symmetric so columns are rows, transposed.
+    if is_condensed(distances):
+        return distances.rows(idx).T
+    return distances[:, idx]
+
+
+def submatrix(distances, idx):
+    if is_condensed(distances):
+        return distances.submatrix(idx)
+    return distances[np.ix_(idx, idx)]
+
+
+def allocate(m, condensed=False, dtype=np.float64, filename=None, mode="w+"):
+    if condensed:
+        return CondensedDistances(m, dtype=dtype, filename=filename, mode=mode)
+    if filename is not None:
+        return np.memmap(filename, dtype=dtype, mode=mode, shape=(m, m))
+    return np.zeros((m, m), dtype=dtype)
+
+
+def empty_like(distances, suffix=""):
+    """New storage shaped like distances, in a memory-mapped file named after
+    its file with suffix added if distances is memory mapped."""
+    if is_condensed(distances):
+        return distances.empty_like(suffix=suffix)
+    filename = getattr(distances, "filename", None)
+    if filename is not None:
+        filename += suffix
+    return allocate(len(distances), dtype=distances.dtype, filename=filename)
+
+
+def allocate_shared(m, condensed=False, dtype=np.float64):
+    """In-memory storage whose buffer can be written by worker processes."""
+    dtype = np.dtype(dtype)
+    size = condensed_size(m) if condensed else m * m
+    buf = RawArray("d" if dtype == np.float64 else "f", size)
+    return buf, shared_view(buf, m, condensed, dtype)
+
+
+def shared_view(buf, m, condensed, dtype):
+    data = np.frombuffer(buf, dtype=dtype)
+    if condensed:
+        return CondensedDistances(m, dtype=dtype, data=data)
+    return data.reshape((m, m))
+
+
+def store_block(distances, start, stop, block):
+    if is_condensed(distances):
+        distances.set_block(start, stop, block)
+    else:
+        distances[start:stop, start:] = block
+        distances[start:, start:stop] = block.T
+
+
+def build_distance_matrix(data, normalize=False, metric="euclidean", block_size=BLOCK_SIZE,
+        condensed=False, dtype=np.float64, filename=None, workers=1):
+    """Builds the symmetric m x m matrix of distances between rows of data.
+
+    For backwards compatibility a metric callable may be passed in place of
+    normalize, as spectral.compute_distances_in_k used to do; it is then used
+    as the metric and the result is normalized, as before.
+
+    By default the result is a dense in-memory ndarray. With condensed=True
+    it is a CondensedDistances; dtype=float32 halves either representation;
+    filename backs it with a memory-mapped file. With workers > 1 the blocks
+    are filled by that many processes (0 means one per CPU).
+    """
+    if callable(normalize):
+        metric, normalize = normalize, True
+    metric = get_metric(metric)
+    X = as_matrix(data)
+    m = X.shape[0]
+    norms = np.einsum("ij,ij->i", X, X) if metric in NORM_METRICS else None
+    bounds = block_bounds(m, block_size)
+    workers = cpu_count() if workers == 0 else workers
+    if workers > 1 and len(bounds) > 1:
+        distances = fill_in_parallel(X, norms, metric, bounds, condensed, dtype, filename, workers)
+    else:
+        distances = allocate(m, condensed=condensed, dtype=dtype, filename=filename)
+        for (start, stop) in bounds:
+            block = compute_block(X, start, stop, metric, norms)
+            store_block(distances, start, stop, block)
+    if normalize:
+        max_distance = distances.max() if m > 0 else 0.
+        if max_distance > 0.:
+            if is_condensed(distances):
+                distances.divide(max_distance)
+            else:
+                distances /= max_distance
+    return distances
+
+
+# State shared with worker processes, set up once per worker by init_worker.
+WORKER = {}
+
+
+def fill_in_parallel(X, norms, metric, bounds, condensed, dtype, filename, workers):
+    m, d = X.shape
+    shared_X = RawArray("d", m * d)
+    np.frombuffer(shared_X, dtype=np.float64)[:] = X.ravel()
+    shared_norms = None
+    if norms is not None:
+        shared_norms = RawArray("d", m)
+        np.frombuffer(shared_norms, dtype=np.float64)[:] = norms
+    if filename is not None:
+        # Workers reopen the file; the parent only creates it.
+        distances = allocate(m, condensed=condensed, dtype=dtype, filename=filename)
+        flush(distances)
+        out = None
+    else:
+        out, distances = allocate_shared(m, condensed=condensed, dtype=dtype)
+    initargs = (shared_X, (m, d), shared_norms, metric, out, condensed, np.dtype(dtype).str, filename)
+    pool = Pool(processes=workers, initializer=init_worker, initargs=initargs)
+    try:
+        pool.map(fill_block, bounds, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    return distances
+
+
+def init_worker(shared_X, shape, shared_norms, metric, out, condensed, dtype, filename):
+    m = shape[0]
+    WORKER["X"] = np.frombuffer(shared_X, dtype=np.float64).reshape(shape)
+    WORKER["norms"] = None
+    if shared_norms is not None:
+        WORKER["norms"] = np.frombuffer(shared_norms, dtype=np.float64)
+    WORKER["metric"] = metric
+    if filename is not None:
+        WORKER["distances"] = allocate(m, condensed=condensed, dtype=dtype, filename=filename, mode="r+")
+    else:
+        WORKER["distances"] = shared_view(out, m, condensed, np.dtype(dtype))
+
+
+def fill_block(bounds):
+    (start, stop) = bounds
+    distances = WORKER["distances"]
+    block = compute_block(WORKER["X"], start, stop, WORKER["metric"], WORKER["norms"])
+    store_block(distances, start, stop, block)
+    flush(distances)
+
+
+def flush(distances):
+    if is_condensed(distances):
+        distances.flush()
+    elif isinstance(distances, np.memmap):
+        distances.flush()
+
+
+def nearest_neighbors(data, n_neighbors, metric="euclidean"):
+    """The n_neighbors nearest other rows of each row, as (m, n_neighbors)
+    arrays of indices and distances sorted by distance. Rows are compared a
+    block at a time, so the full matrix is never held in memory."""
+    X = as_matrix(data)
+    m = X.shape[0]
+    n_neighbors = min(n_neighbors, m - 1)
+    indices = np.empty((m, n_neighbors), dtype=np.int64)
+    neighbor_distances = np.empty((m, n_neighbors))
+    for (start, stop) in block_bounds(m):
+        block = pairwise(X[start:stop], X, metric)
+        block[np.arange(stop - start), np.arange(start, stop)] = np.inf
+        r = np.arange(stop - start)[:, np.newaxis]
+        nearest = np.argpartition(block, n_neighbors - 1, axis=1)[:, :n_neighbors]
+        nearest = nearest[r, np.argsort(block[r, nearest], axis=1)]
+        indices[start:stop] = nearest
+        neighbor_distances[start:stop] = block[r, nearest]
+    return indices, neighbor_distances
+
+
+def radius_neighbors(data, epsilon, metric="euclidean"):
+    """All pairs of distinct rows within epsilon of each other, as arrays of
+    row indices, column indices and distances."""
+    X = as_matrix(data)
+    m = X.shape[0]
+    rows, cols, within = [], [], []
+    for (start, stop) in block_bounds(m):
+        block = pairwise(X[start:stop], X, metric)
+        block[np.arange(stop - start), np.arange(start, stop)] = np.inf
+        (r, c) = np.nonzero(block <= epsilon)
+        rows.append(r + start)
+        cols.append(c)
+        within.append(block[r, c])
+    if not rows:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0)
+    return np.concatenate(rows), np.concatenate(cols), np.concatenate(within)
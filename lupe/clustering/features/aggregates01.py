@@ -1,5 +1,6 @@
 from numpy import mean
 from string import digits
+from visitor import TreeVisitor, collect, first
 
 """
 This module featurizes only aggregate stages.
@@ -21,20 +22,29 @@ Features include:
 AGGREGATE_FUNCTIONS = []
 
 
+visitor = TreeVisitor()
+
+
 class Feature(object):
 
     def __init__(self):
         self.versions = ["aggregates01"]
+        self.command_index = visitor.register("command", self.is_command, first)
     
     def is_field(self, node):
         return node.role.find("FIELD") > -1
     
+    def is_command(self, node):
+        return node.role == "COMMAND"
+
     def get_command(self, tree):
-        for node in tree.itertree():
-            if node.role == "COMMAND": return node
+        return visitor.result(tree, self.command_index)
+
+    def is_function(self, node):
+        return node.role == "FUNCTION"
 
     def is_aggregate_function(self, node, function):
-        return node.role == "FUNCTION" and node.raw == function
+        return self.is_function(node) and node.raw == function
 
     def is_percentile_function(self, node):
         ptile = len(node.raw) > 1 and node.raw[0] == "p" and \
@@ -57,10 +67,10 @@ class NumberOfDistinctFieldsFeature(Feature):
     
     def __init__(self):
         super(NumberOfDistinctFieldsFeature, self).__init__()
+        self.index = visitor.register("field_raws", self.is_field, collect(lambda node: node.raw))
 
     def check(self, aggregate):
-        field_nodes = [node for node in aggregate.itertree() if self.is_field(node)]
-        return len(set([node.raw for node in field_nodes]))
+        return len(set(visitor.result(aggregate, self.index)))
 
 
 class SpecifiedCommandUsedFeature(Feature):
@@ -87,37 +97,41 @@ class NumberTimesAggregateFunctionUsedFeature(Feature):
     def __init__(self, function):
         super(NumberTimesAggregateFunctionUsedFeature, self).__init__()
         self.function = function
+        self.index = visitor.register("function_raws", self.is_function, collect(lambda node: node.raw))
 
     def check(self, aggregate):
-        return sum([1 if self.is_aggregate_function(node, self.function) else 0 for node in aggregate.itertree()]) 
+        return visitor.result(aggregate, self.index).count(self.function)
 
 
 class NumberTimesPercentileFunctionUsedFeature(Feature):
     
     def __init__(self):
         super(NumberTimesPercentileFunctionUsedFeature, self).__init__()
+        self.index = visitor.register("percentile_functions", self.is_percentile_function)
 
     def check(self, aggregate):
-        return sum([1 if self.is_percentile_function(node) else 0 for node in aggregate.itertree()]) 
+        return visitor.result(aggregate, self.index)
 
 
 class NumberOfFieldsAggregatedFeature(Feature):
     
     def __init__(self):
         super(NumberOfFieldsAggregatedFeature, self).__init__()
+        self.index = visitor.register("aggregated_field_raws", self.is_aggregated_field,
+            collect(lambda node: node.raw))
 
     def check(self, aggregate):
-        aggregated_fields = [node.raw for node in aggregate.itertree() if self.is_aggregated_field(node)]
-        return len(set(aggregated_fields))
+        return len(set(visitor.result(aggregate, self.index)))
 
 
 class NumberOfFieldsGroupedByFeature(Feature):
     
     def __init__(self):
         super(NumberOfFieldsGroupedByFeature, self).__init__()
+        self.index = visitor.register("grouping_fields", self.is_grouping_field)
 
     def check(self, aggregate):
-        return sum([1 if self.is_grouping_field(node) else 0 for node in aggregate.itertree()])
+        return visitor.result(aggregate, self.index)
 
 
 class ReordersAndLimitsResultsFeature(Feature):
@@ -1,4 +1,5 @@
 from numpy import mean
+from visitor import TreeVisitor, collect, first
 
 """
 This module featurizes only aggregate stages.
@@ -32,30 +33,40 @@ FNTYPE_GROUPS = {
     "CONDITIONAL_FUNCTIONS": ["case", "if", "ifnull"]
 }
 
+visitor = TreeVisitor()
+
+
 class Feature(object):
 
     def __init__(self):
         self.versions = ["augments01"]
+        self.command_index = visitor.register("command", self.is_command, first)
     
     def is_field(self, node):
         return node.role.find("FIELD") > -1
     
+    def is_command(self, node):
+        return node.role == "COMMAND"
+
     def get_command(self, tree):
-        for node in tree.itertree():
-            if node.role == "COMMAND": return node
+        return visitor.result(tree, self.command_index)
     
     def is_function(self, node):
         return node.role.find("FUNCTION") > -1
 
+    def register_functions(self):
+        """Registers the collection of the names of the functions used."""
+        return visitor.register("function_raws", self.is_function, collect(lambda node: node.raw))
+
 
 class NumberOfDistinctFieldsFeature(Feature):
     
     def __init__(self):
         super(NumberOfDistinctFieldsFeature, self).__init__()
+        self.index = visitor.register("field_raws", self.is_field, collect(lambda node: node.raw))
 
     def check(self, augment):
-        field_nodes = [node for node in augment.itertree() if self.is_field(node)]
-        return len(set([node.raw for node in field_nodes]))
+        return len(set(visitor.result(augment, self.index)))
 
 
 class SpecifiedCommandUsedFeature(Feature):
@@ -81,18 +92,20 @@ class NumberOfFunctionsFeature(Feature):
     
     def __init__(self):
         super(NumberOfFunctionsFeature, self).__init__()
+        self.index = self.register_functions()
 
     def check(self, augment):
-        return len([node for node in augment.itertree() if self.is_function(node)])
+        return len(visitor.result(augment, self.index))
 
 
 class NumberOfDistinctFunctionsFeature(Feature):
     
     def __init__(self):
         super(NumberOfDistinctFunctionsFeature, self).__init__()
+        self.index = self.register_functions()
 
     def check(self, augment):
-        functions = [node.raw for node in augment.itertree() if self.is_function(node)]
+        functions = visitor.result(augment, self.index)
         return len(set(functions))
 
 
@@ -101,9 +114,10 @@ class NumberOfTimesSpecificFunctionUsedFeature(Feature):
     def __init__(self, function):
         super(NumberOfTimesSpecificFunctionUsedFeature, self).__init__()
         self.function = function
+        self.index = self.register_functions()
 
     def check(self, augment):
-        functions = [node.raw for node in augment.itertree() if self.is_function(node)]
+        functions = visitor.result(augment, self.index)
         functions = [fn for fn in functions if fn == self.function] # TODO: canonical function names?
         return len(functions)
 
@@ -131,10 +145,11 @@ class NumberSpecificTypeFunctionsFeature(Feature):
     def __init__(self, typekey):
         super(NumberSpecificTypeFunctionsFeature, self).__init__()
         self.typekey = typekey
+        self.index = self.register_functions()
 
     def check(self, augment):
         key_functions = FNTYPE_GROUPS[self.typekey]
-        functions = [node.raw for node in augment.itertree() if self.is_function(node)]
+        functions = visitor.result(augment, self.index)
         functions = [fn for fn in functions if fn in key_functions]
         return len(functions)
 
@@ -144,10 +159,11 @@ class PercentSpecificTypeFunctionsFeature(Feature):
     def __init__(self, typekey):
         super(PercentSpecificTypeFunctionsFeature, self).__init__()
         self.typekey = typekey
+        self.index = self.register_functions()
 
     def check(self, augment):
         key_functions = FNTYPE_GROUPS[self.typekey]
-        functions = [node.raw for node in augment.itertree() if self.is_function(node)]
+        functions = visitor.result(augment, self.index)
         matching_functions = [fn for fn in functions if fn in key_functions]
         if len(functions) > 0: 
             return float(len(matching_functions))/float(len(functions))
@@ -1,4 +1,5 @@
 from numpy import mean
+from visitor import TreeVisitor, collect, first
 
 """
 This module featurizes only filter stages.
@@ -29,10 +30,17 @@ Features include:
 
 
 
+visitor = TreeVisitor()
+
+
 class Feature(object):
 
     def __init__(self):
         self.versions = ["filters01"]
+        self.command_index = visitor.register("command", self.is_command, first)
+
+    def is_argument(self, node):
+        return node.role == "FUNCTION"
     
     def is_wildcard_match(self, node, specific=""):
         return node.raw.find('*') > -1
@@ -87,36 +95,44 @@ class Feature(object):
     def is_default_datetime(self, node):
         return node.role == "DEFAULT_DATETIME_FIELD" or (node.role == "DEFAULT_FIELD" and node.raw == "timestamp")
 
+    def is_time_search(self, node):
+        return self.is_time_modifier(node) or self.is_default_datetime(node)
+
+    def is_command(self, node):
+        return node.role == "COMMAND"
+
     def get_command(self, tree):
-        for node in tree.itertree():
-            if node.role == "COMMAND": return node
+        return visitor.result(tree, self.command_index)
 
 
 class NumberOfArgumentsFeature(Feature):
 
     def __init__(self):
         super(NumberOfArgumentsFeature, self).__init__()
+        self.index = visitor.register("arguments", self.is_argument)
 
     def check(self, filter):
-        return sum([1 if node.role == "FUNCTION" else 0 for node in filter.itertree()])
+        return visitor.result(filter, self.index)
 
 
 class NumberOfWildcardMatchesFeature(Feature):
     
     def __init__(self):
         super(NumberOfWildcardMatchesFeature, self).__init__()
+        self.index = visitor.register("wildcard_matches", self.is_wildcard_match)
 
     def check(self, filter):
-        return sum([1 if self.is_wildcard_match(node) else 0 for node in filter.itertree()])
+        return visitor.result(filter, self.index)
 
 
 class NumberOfConditionalsFeature(Feature):
     
     def __init__(self):
         super(NumberOfConditionalsFeature, self).__init__()
+        self.index = visitor.register("conditionals", self.is_conditional)
 
     def check(self, filter):
-        return sum([1 if self.is_conditional(node) else 0 for node in filter.itertree()])
+        return visitor.result(filter, self.index)
 
 
 class NumberOfSpecificConditionalsFeature(Feature):
@@ -124,48 +140,52 @@ class NumberOfSpecificConditionalsFeature(Feature):
     def __init__(self, conditional):
         super(NumberOfSpecificConditionalsFeature, self).__init__()
         self.conditional = conditional
+        self.index = visitor.register(("conditionals", conditional),
+            lambda node: self.is_conditional(node, specific=conditional))
 
     def check(self, filter):
-        return sum([1 if self.is_conditional(node, specific=self.conditional) else 0 for node in filter.itertree()])
+        return visitor.result(filter, self.index)
 
 
 class NumberOfFieldSearchesFeature(Feature):
     
     def __init__(self):
         super(NumberOfFieldSearchesFeature, self).__init__()
+        self.index = visitor.register("field_searches", self.is_field_search)
 
     def check(self, filter):
-        return sum([1 if self.is_field_search(node) else 0 for node in filter.itertree()])
+        return visitor.result(filter, self.index)
 
 
 class NumberOfOptionSearchesFeature(Feature):
     
     def __init__(self):
         super(NumberOfOptionSearchesFeature, self).__init__()
+        self.index = visitor.register("option_searches", self.is_option_search)
 
     def check(self, filter):
-        return sum([1 if self.is_option_search(node) else 0 for node in filter.itertree()])
+        return visitor.result(filter, self.index)
 
 
 class NumberOfStringSearchesFeature(Feature):
     
     def __init__(self):
         super(NumberOfStringSearchesFeature, self).__init__()
+        self.index = visitor.register("string_searches", self.is_string_search)
 
     def check(self, filter):
-        return sum([1 if self.is_string_search(node) else 0 for node in filter.itertree()])
+        return visitor.result(filter, self.index)
 
 
 class AverageLengthOfStringSearchesFeature(Feature):
     
     def __init__(self):
         super(AverageLengthOfStringSearchesFeature, self).__init__()
+        self.index = visitor.register("string_search_lengths", self.is_string_search,
+            collect(lambda node: len(node.children[0].raw)))
 
     def check(self, filter):
-        lengths = []
-        for node in filter.itertree():
-            if self.is_string_search(node):
-                lengths.append(len(node.children[0].raw))
+        lengths = visitor.result(filter, self.index)
         if not lengths:
             return 0. # Should this be 0 or -1?
         return mean(lengths)
@@ -175,55 +195,60 @@ class NumberOfLogicalOperatorsFeature(Feature):
     
     def __init__(self):
         super(NumberOfLogicalOperatorsFeature, self).__init__()
+        self.index = visitor.register("logical_operators", self.is_logical_operator)
 
     def check(self, filter):
-        return sum([1 if self.is_logical_operator(node) else 0 for node in filter.itertree()])
+        return visitor.result(filter, self.index)
 
 
 class NumberOfTimeSearchesFeature(Feature):
     
     def __init__(self):
         super(NumberOfTimeSearchesFeature, self).__init__()
+        self.index = visitor.register("time_searches", self.is_time_search)
 
     def check(self, filter):
-        return sum([1 if (self.is_time_modifier(node) or self.is_default_datetime(node)) else 0 for node in filter.itertree()])
+        return visitor.result(filter, self.index)
 
 
 class NumberOfSubsearchesFeature(Feature):
     
     def __init__(self):
         super(NumberOfSubsearchesFeature, self).__init__()
+        self.index = visitor.register("subsearches", self.is_subsearch)
 
     def check(self, filter):
-        return sum([1 if self.is_subsearch(node) else 0 for node in filter.itertree()])
+        return visitor.result(filter, self.index)
 
 
 class NumberOfInternalDataSearchesFeature(Feature):
     
     def __init__(self):
         super(NumberOfInternalDataSearchesFeature, self).__init__()
+        self.index = visitor.register("internal_data", self.is_internal_data)
 
     def check(self, filter):
-        return sum([1 if self.is_internal_data(node) else 0 for node in filter.itertree()])
+        return visitor.result(filter, self.index)
 
 
 class NumberOfDefaultFieldSearchesFeature(Feature):
     
     def __init__(self):
         super(NumberOfDefaultFieldSearchesFeature, self).__init__()
+        self.index = visitor.register("default_fields", self.is_default_field)
 
     def check(self, filter):
-        return sum([1 if self.is_default_field(node) else 0 for node in filter.itertree()])
+        return visitor.result(filter, self.index)
 
 
 class NumberOfDistinctFieldsFeature(Feature):
     
     def __init__(self):
         super(NumberOfDistinctFieldsFeature, self).__init__()
+        self.index = visitor.register("field_raws", self.is_field, collect(lambda node: node.raw))
 
     def check(self, filter):
-        field_nodes = [node for node in filter.itertree() if self.is_field(node)]
-        return len(set([node.raw for node in field_nodes]))
+        return len(set(visitor.result(filter, self.index)))
 
 
 class SpecifiedCommandUsedFeature(Feature):
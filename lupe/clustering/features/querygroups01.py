@@ -58,6 +58,7 @@ class DescribeInterarrivalIntervalsFeature(Feature):
     
     def __init__(self):
         super(DescribeInterarrivalIntervalsFeature, self).__init__()
+        self.width = 7
 
     def check(self, querygroup):
         if len(querygroup.interarrivals) == 0:
@@ -1,8 +1,8 @@
 from json import load
 from Levenshtein import ratio
 from os import path
-from queryutils.splunktypes import lookup_category 
 from scipy.stats import describe
+from views import get_category, is_command, is_stage, session_views
 
 """
 Features include:
@@ -53,18 +53,17 @@ class Feature(object):
     def __init__(self):
         self.versions = ["sessions02"]
 
+    def views(self, session):
+        return session_views(session)
+
     def is_stage(self, node):
-        return node.role == "STAGE" 
+        return is_stage(node)
 
     def get_commands(self, tree):
-        return [node for node in tree.itertree() 
-            if node.role.find("COMMAND") > -1 or node.role == "MACRO"] 
+        return [node for node in tree.itertree() if is_command(node)]
     
     def get_category(self, node):
-        if node.role == "COMMAND":
-            return lookup_category(node.raw)
-        if node.role in ["USER_DEFINED_COMMAND", "MACRO"]:
-            return node.role
+        return get_category(node)
 
     def get_categories(self, tree):
         commands = self.get_commands(tree)
@@ -110,8 +109,7 @@ class NumberOfUniqueTemplatesFeature(Feature):
         super(NumberOfUniqueTemplatesFeature, self).__init__()
 
     def check(self, session):
-        return len(set([query.parsetree.template().str_tree() 
-                        for query in session.queries]))
+        return len(set([query.template for query in self.views(session)]))
 
 
 class NumberOfDuplicateTemplatesFeature(Feature):
@@ -121,8 +119,7 @@ class NumberOfDuplicateTemplatesFeature(Feature):
 
     def check(self, session):
         ntemplates = len(session.queries)
-        nduplicates = len(set([query.parsetree.template().str_tree() 
-                        for query in session.queries]))
+        nduplicates = len(set([query.template for query in self.views(session)]))
         return ntemplates - nduplicates
 
 
@@ -132,8 +129,7 @@ class NumberOfUniqueSkeletonsFeature(Feature):
         super(NumberOfUniqueSkeletonsFeature, self).__init__()
 
     def check(self, session):
-        return len(set([query.parsetree.skeleton().str_tree() 
-                        for query in session.queries]))
+        return len(set([query.skeleton for query in self.views(session)]))
 
 
 class NumberOfDuplicateSkeletonsFeature(Feature):
@@ -143,8 +139,7 @@ class NumberOfDuplicateSkeletonsFeature(Feature):
 
     def check(self, session):
         nskeletons = len(session.queries)
-        nduplicates = len(set([query.parsetree.skeleton().str_tree() 
-                        for query in session.queries]))
+        nduplicates = len(set([query.skeleton for query in self.views(session)]))
         return nskeletons - nduplicates
 
 
@@ -155,9 +150,8 @@ class NumberOfStagesFeature(Feature):
 
     def check(self, session):
         nstages = 0.
-        for query in session.queries:
-            for node in query.parsetree.itertree():
-                nstages += 1. if self.is_stage(node) else 0.
+        for query in self.views(session):
+            nstages += query.nstages
         return nstages
 
 
@@ -165,14 +159,10 @@ class DescribeNumberOfStagesFeature(Feature):
 
     def __init__(self):
         super(DescribeNumberOfStagesFeature, self).__init__()
+        self.width = 7
 
     def check(self, session):
-        all_nstages = []
-        for query in session.queries:
-            nstages = 0.
-            for node in query.parsetree.itertree():
-                nstages += 1. if self.is_stage(node) else 0.
-            all_nstages.append(nstages) 
+        all_nstages = [query.nstages for query in self.views(session)]
         size, (min, max), mean, var, skew, kurt = describe(all_nstages)
         return [size, min, max, mean, var, skew, kurt]
 
@@ -181,6 +171,7 @@ class DescribeQueryLengthFeature(Feature):
 
     def __init__(self):
         super(DescribeQueryLengthFeature, self).__init__()
+        self.width = 7
 
     def check(self, session):
         lengths = [len(query.text) for query in session.queries]
@@ -195,12 +186,7 @@ class EndsWithCategoryFeature(Feature):
         self.category = category
 
     def check(self, session):
-        last_stage = None
-        for node in session.queries[-1].parsetree.itertree():
-            if self.is_stage(node):
-                last_stage = node
-        command = last_stage.children[0]
-        category = self.get_category(command)
+        category = self.views(session)[-1].last_category
         return category == self.category
 
 
@@ -210,21 +196,20 @@ class NumberOfDistinctCommandsFeature(Feature):
         super(NumberOfDistinctCommandsFeature, self).__init__()
 
     def check(self, session):
-        commands = []
-        for query in session.queries:
-            commands += [node.raw for node in query.parsetree.itertree()]            
-        return len(set(commands))
+        commands = set()
+        for query in self.views(session):
+            commands.update(query.raws)
+        return len(commands)
 
 
 class DescribeNumberOfDistinctCommandsFeature(Feature):
 
     def __init__(self):
         super(DescribeNumberOfDistinctCommandsFeature, self).__init__()
+        self.width = 7
 
     def check(self, session):
-        ncommands = []
-        for query in session.queries:
-            ncommands.append(len(set([node.raw for node in query.parsetree.itertree()])))
+        ncommands = [query.ndistinct_raws for query in self.views(session)]
         size, (min, max), mean, var, skew, kurt = describe(ncommands)
         return [size, min, max, mean, var, skew, kurt]
 
@@ -233,6 +218,7 @@ class DescribeInterarrivalTimesFeature(Feature):
 
     def __init__(self):
         super(DescribeInterarrivalTimesFeature, self).__init__()
+        self.width = 7
 
     def check(self, session):
         times = []
@@ -248,6 +234,7 @@ class DescribeInterQuerySimilarityFeature(Feature):
 
     def __init__(self):
         super(DescribeInterQuerySimilarityFeature, self).__init__()
+        self.width = 7
 
     def check(self, session):
         ratios = []
@@ -279,9 +266,10 @@ class TemplateSuperstringFeature(Feature):
         super(TemplateSuperstringFeature, self).__init__()
 
     def check(self, session):
-        for idx, query in enumerate(session.queries[:-1]):
-            curr = query.parsetree.template().str_tree()
-            next = session.queries[idx+1].parsetree.template().str_tree()
+        queries = self.views(session)
+        for idx, query in enumerate(queries[:-1]):
+            curr = query.template
+            next = queries[idx+1].template
             if not curr in next:
                 return 0.
         return 1.
@@ -293,9 +281,10 @@ class SkeletonSuperstringFeature(Feature):
         super(SkeletonSuperstringFeature, self).__init__()
 
     def check(self, session):
-        for idx, query in enumerate(session.queries[:-1]):
-            curr = query.parsetree.skeleton().str_tree()
-            next = session.queries[idx+1].parsetree.skeleton().str_tree()
+        queries = self.views(session)
+        for idx, query in enumerate(queries[:-1]):
+            curr = query.skeleton
+            next = queries[idx+1].skeleton
             if not curr in next:
                 return 0.
         return 1.
@@ -307,13 +296,10 @@ class CommandSequenceSuperstringFeature(Feature):
         super(CommandSequenceSuperstringFeature, self).__init__()
 
     def check(self, session):
-        for idx, query in enumerate(session.queries[:-1]):
-            curr_commands = self.get_commands(query.parsetree)
-            next_commands = self.get_commands(session.queries[idx+1].parsetree)
-            curr_commands = [node.raw for node in curr_commands]
-            next_commands = [node.raw for node in next_commands]
-            curr = " ".join(curr_commands)
-            next = " ".join(next_commands)
+        queries = self.views(session)
+        for idx, query in enumerate(queries[:-1]):
+            curr = query.command_sequence
+            next = queries[idx+1].command_sequence
             if not curr in next:
                 return 0.
         return 1.
@@ -325,13 +311,10 @@ class CategorySequenceSuperstringFeature(Feature):
         super(CategorySequenceSuperstringFeature, self).__init__()
 
     def check(self, session):
-        for idx, query in enumerate(session.queries[:-1]):
-            curr = query.parsetree
-            next = session.queries[idx+1].parsetree
-            curr_categories = self.get_categories(curr)
-            next_categories = self.get_categories(next)
-            curr = " ".join(curr_categories)
-            next = " ".join(next_categories)
+        queries = self.views(session)
+        for idx, query in enumerate(queries[:-1]):
+            curr = query.category_sequence
+            next = queries[idx+1].category_sequence
             if not curr in next:
                 return 0.
         return 1.
@@ -357,9 +340,10 @@ class TemplateSubstringFeature(Feature):
         super(TemplateSubstringFeature, self).__init__()
 
     def check(self, session):
-        for idx, query in enumerate(session.queries[:-1]):
-            curr = query.parsetree.template().str_tree()
-            next = session.queries[idx+1].parsetree.template().str_tree()
+        queries = self.views(session)
+        for idx, query in enumerate(queries[:-1]):
+            curr = query.template
+            next = queries[idx+1].template
             if not next in curr:
                 return 0.
         return 1.
@@ -371,9 +355,10 @@ class SkeletonSubstringFeature(Feature):
         super(SkeletonSubstringFeature, self).__init__()
 
     def check(self, session):
-        for idx, query in enumerate(session.queries[:-1]):
-            curr = query.parsetree.skeleton().str_tree()
-            next = session.queries[idx+1].parsetree.skeleton().str_tree()
+        queries = self.views(session)
+        for idx, query in enumerate(queries[:-1]):
+            curr = query.skeleton
+            next = queries[idx+1].skeleton
             if not next in curr:
                 return 0.
         return 1.
@@ -385,13 +370,10 @@ class CommandSequenceSubstringFeature(Feature):
         super(CommandSequenceSubstringFeature, self).__init__()
 
     def check(self, session):
-        for idx, query in enumerate(session.queries[:-1]):
-            curr_commands = self.get_commands(query.parsetree)
-            next_commands = self.get_commands(session.queries[idx+1].parsetree)
-            curr_commands = [node.raw for node in curr_commands]
-            next_commands = [node.raw for node in next_commands]
-            curr = " ".join(curr_commands)
-            next = " ".join(next_commands)
+        queries = self.views(session)
+        for idx, query in enumerate(queries[:-1]):
+            curr = query.command_sequence
+            next = queries[idx+1].command_sequence
             if not next in curr:
                 return 0.
         return 1.
@@ -403,13 +385,10 @@ class CategorySequenceSubstringFeature(Feature):
         super(CategorySequenceSubstringFeature, self).__init__()
 
     def check(self, session):
-        for idx, query in enumerate(session.queries[:-1]):
-            curr = query.parsetree
-            next = session.queries[idx+1].parsetree
-            curr_categories = self.get_categories(curr)
-            next_categories = self.get_categories(next)
-            curr = " ".join(curr_categories)
-            next = " ".join(next_categories)
+        queries = self.views(session)
+        for idx, query in enumerate(queries[:-1]):
+            curr = query.category_sequence
+            next = queries[idx+1].category_sequence
             if not next in curr:
                 return 0.
         return 1.
@@ -422,9 +401,9 @@ class EndsWithVisualizationFeature(Feature):
 
     def check(self, session):
         visualizations = ["chart", "gauge", "timechart", "table", "xyseries"]
-        last = session.queries[-1].parsetree
-        commands = [command.raw for command in self.get_commands(last)]
-        return commands and commands[-1] in visualizations
+        commands = self.views(session)[-1].command_raws
+        # A last query without commands does not end with a visualization.
+        return bool(commands) and commands[-1] in visualizations
 
 
 class NumberOfVisualizationsFeature(Feature):
@@ -435,8 +414,8 @@ class NumberOfVisualizationsFeature(Feature):
     def check(self, session):
         visualizations = ["chart", "gauge", "timechart", "table", "xyseries"]
         count = 0.
-        for query in session.queries:
-            commands = [cmd.raw for cmd in self.get_commands(query.parsetree)]
+        for query in self.views(session):
+            commands = query.command_raws
             count += len([cmd for cmd in commands if cmd in visualizations])
         return count
 
@@ -445,12 +424,12 @@ class DescribeCommandRarityFeature(Feature):
 
     def __init__(self):
         super(DescribeCommandRarityFeature, self).__init__()
+        self.width = 7
 
     def check(self, session):
         rarities = []
-        for query in session.queries:
-            commands = [cmd for cmd in self.get_commands(query.parsetree)]
-            for cmd in commands:
+        for query in self.views(session):
+            for cmd in query.commands:
                 if cmd.role == "COMMAND":
                     cmd_rarity = rarity.get(cmd.raw, 0.)
                     rarities.append(cmd_rarity)
@@ -467,7 +446,7 @@ class NumberOfGeneratorsFeature(Feature):
         super(NumberOfGeneratorsFeature, self).__init__()
 
     def check(self, session):
-        return sum([len(self.get_generators(query.parsetree)) for query in session.queries])
+        return sum([len(query.generators) for query in self.views(session)])
 
 
 class NumberOfSubstringQueriesOfPriorQueriesFeature(Feature):
@@ -0,0 +1,131 @@
+from queryutils.splunktypes import lookup_category
+
+"""
+Views of the parse trees of queries that many session features need, such as
+their templates, skeletons, commands and categories.
+
+Each view walks or copies the whole parse tree, and dozens of session features
+need the same ones. A QueryViews computes each view of a query the first time
+a feature asks for it and then keeps it, and session_views() keeps the
+QueryViews of the queries of the session being featurized, so every feature
+of every module shares them. The views of a session are dropped as soon as
+the features ask for another session's, so at most one session's views are
+held at a time.
+"""
+
+def is_stage(node):
+    return node.role == "STAGE"
+
+
+def is_command(node):
+    return node.role.find("COMMAND") > -1 or node.role == "MACRO"
+
+
+def get_category(node):
+    if node.role == "COMMAND":
+        return lookup_category(node.raw)
+    if node.role in ["USER_DEFINED_COMMAND", "MACRO"]:
+        return node.role
+
+
+def view(compute):
+    """Makes compute(self) a property of a QueryViews that is computed once.
+    A view whose computation raises is not kept, so it raises again the next
+    time it is asked for, as it would have without the cache."""
+    name = compute.__name__
+    def get(self):
+        if name not in self.cache:
+            self.cache[name] = compute(self)
+        return self.cache[name]
+    return property(get, doc=compute.__doc__)
+
+
+class QueryViews(object):
+
+    def __init__(self, query):
+        self.query = query
+        self.cache = {}
+
+    @view
+    def nodes(self):
+        """All of the nodes of the parse tree, in itertree() order."""
+        return list(self.query.parsetree.itertree())
+
+    @view
+    def raws(self):
+        return [node.raw for node in self.nodes]
+
+    @view
+    def ndistinct_raws(self):
+        return len(set(self.raws))
+
+    @view
+    def template(self):
+        return self.query.parsetree.template().str_tree()
+
+    @view
+    def skeleton(self):
+        return self.query.parsetree.skeleton().str_tree()
+
+    @view
+    def stages(self):
+        return [node for node in self.nodes if is_stage(node)]
+
+    @view
+    def nstages(self):
+        return float(len(self.stages))
+
+    @view
+    def last_category(self):
+        """The category of the command of the last stage."""
+        if not self.stages:
+            raise RuntimeError("Query has no stages: " + self.query.text)
+        return get_category(self.stages[-1].children[0])
+
+    @view
+    def commands(self):
+        return [node for node in self.nodes if is_command(node)]
+
+    @view
+    def command_raws(self):
+        return [node.raw for node in self.commands]
+
+    @view
+    def command_sequence(self):
+        return " ".join(self.command_raws)
+
+    @view
+    def categories(self):
+        return [get_category(node) for node in self.commands]
+
+    @view
+    def category_sequence(self):
+        return " ".join(self.categories)
+
+    @view
+    def generators(self):
+        roots = [node for node in self.nodes if node.role == "ROOT"]
+        firsts = [r.children[0].children[0] for r in roots]
+        return [node for node in firsts if node.raw != "search"]
+
+
+class SessionViews(object):
+    """Returns the QueryViews of the queries of a session, in order, reusing
+    them for as long as the same session is asked for."""
+
+    def __init__(self):
+        self.session = None
+        self.queries = []
+
+    def __call__(self, session):
+        if session is not self.session:
+            self.session = session
+            self.queries = [QueryViews(query) for query in session.queries]
+        return self.queries
+
+    def clear(self):
+        self.session = None
+        self.queries = []
+
+
+session_views = SessionViews()
@@ -0,0 +1,95 @@
+"""
+A walk over a parse tree that counts or collects nodes for many features at once.
+
+Most of the stage features look at every node of a tree for one kind of node,
+such as wildcards, conditionals or field searches. Instead of walking the
+tree themselves, they register a predicate and an accumulator with their
+module's TreeVisitor, which walks each tree once, feeds every node to the
+accumulators whose predicates it matches and keeps them until the features
+ask about a different tree.
+
+Features that register the same key share a predicate and accumulator, so
+features that count the same nodes do not count them twice.
+"""
+
+class Count(object):
+    """Counts the nodes it is given."""
+
+    def __init__(self):
+        self.value = 0
+
+    def add(self, node):
+        self.value += 1
+
+
+class Collect(object):
+    """Collects key(node) for the nodes it is given, in order."""
+
+    def __init__(self, key):
+        self.key = key
+        self.value = []
+
+    def add(self, node):
+        self.value.append(self.key(node))
+
+
+class First(object):
+    """Keeps the first node it is given, or None if it is given none."""
+
+    def __init__(self):
+        self.value = None
+
+    def add(self, node):
+        if self.value is None:
+            self.value = node
+
+
+def count():
+    return Count()
+
+
+def collect(key):
+    return lambda: Collect(key)
+
+
+def first():
+    return First()
+
+
+class TreeVisitor(object):
+
+    def __init__(self):
+        self.keys = {}
+        self.predicates = []
+        self.accumulators = []
+        self.tree = None
+        self.results = []
+
+    def register(self, key, predicate, accumulator=count):
+        """Registers predicate and accumulator, a function that returns a new
+        Count, Collect or First, under key, unless key is registered already,
+        and returns the index of key's result."""
+        if key not in self.keys:
+            self.keys[key] = len(self.predicates)
+            self.predicates.append(predicate)
+            self.accumulators.append(accumulator)
+            self.tree = None
+        return self.keys[key]
+
+    def visit(self, tree):
+        """Returns the values of all of the accumulators for tree, walking it
+        unless it is the tree visited last. If a predicate raises, so does
+        visit, as the feature that used it would have."""
+        if tree is not self.tree:
+            accumulators = [make() for make in self.accumulators]
+            visits = zip(self.predicates, accumulators)
+            for node in tree.itertree():
+                for (predicate, accumulator) in visits:
+                    if predicate(node):
+                        accumulator.add(node)
+            self.results = [accumulator.value for accumulator in accumulators]
+            self.tree = tree
+        return self.results
+
+    def result(self, tree, index):
+        return self.visit(tree)[index]
@@ -1,5 +1,12 @@
 from features import FEATURES
-from traceback import print_exc
+from logging import getLogger as get_logger
+from lupe.parsing.parallel import CHUNK_SIZE, map_ordered
+import numpy
+
+logger = get_logger("lupe")
+
+# The arguments that tell apart the features of the same class.
+FEATURE_ARGUMENTS = ["searchstr", "category", "command", "commands", "conditional", "function", "typekey"]
 
 def get_features(desired_versions):
     features = []
@@ -9,22 +16,98 @@ def get_features(desired_versions):
                 features.append(f)
     return features
 
-def featurize_obj(obj, features):
-    featvec = []
+def feature_width(feature):
+    """Returns the number of values feature computes, which it declares with
+    a width attribute if it computes more than one."""
+    return getattr(feature, "width", 1)
+
+def features_width(features):
+    return sum([feature_width(feature) for feature in features])
+
+def feature_name(feature):
+    name = type(feature).__name__
+    arguments = []
+    for argument in FEATURE_ARGUMENTS:
+        value = getattr(feature, argument, None)
+        if value is None:
+            continue
+        if type(value) == type([]):
+            value = "|".join(value)
+        arguments.append(str(value))
+    if arguments:
+        name += "(" + ",".join(arguments) + ")"
+    return name
+
+def feature_names(features):
+    """Returns the name of each column of the feature vectors of features."""
+    names = []
+    for feature in features:
+        name = feature_name(feature)
+        width = feature_width(feature)
+        if width == 1:
+            names.append(name)
+        else:
+            names += ["%s[%d]" % (name, idx) for idx in range(width)]
+    return names
+
+class FeatureError(Exception):
+    pass
+
+def compute_features(obj, features, row=None):
+    """Computes the feature vector of obj into row, a float64 array with a
+    column for each value of features, or into a new array, and returns the
+    row. Raises a FeatureError naming the object and the feature if a
+    feature could not be computed."""
+    if row is None:
+        row = numpy.empty(features_width(features))
+    column = 0
     for feature in features:
-        try: 
+        width = feature_width(feature)
+        try:
             f = feature.check(obj)
             if type(f) == type([]):
-                try:
-                    featvec += [float(x) for x in f]
-                except: 
-                    raise RuntimeError("Error computing feature: " + str(feature)) 
+                if len(f) != width:
+                    raise RuntimeError("computed %d values instead of %d" % (len(f), width))
+                for (idx, x) in enumerate(f):
+                    row[column + idx] = float(x)
             else:
-                try:
-                    featvec.append(float(f))
-                except:
-                    raise RuntimeError("Error computing feature: " + str(feature)) 
+                row[column] = float(f)
         except Exception as error:
-            print_exc()
-            return None
-    return featvec 
+            raise FeatureError("Error computing feature %s for object %s: %s: %s" %
+                (feature_name(feature), getattr(obj, "id", None), type(error).__name__, error))
+        column += width
+    return row
+
+def featurize_obj(obj, features, row=None):
+    """Computes the feature vector of obj like compute_features, but logs the
+    error and returns None if a feature could not be computed."""
+    try:
+        return compute_features(obj, features, row)
+    except FeatureError as error:
+        logger.warning("[pipeline] - " + str(error))
+        return None
+
+# The features of each feature code, looked up once in each worker process.
+WORKER_FEATURES = {}
+
+def featurize_task(task):
+    (featurecode, obj) = task
+    key = tuple(featurecode)
+    if key not in WORKER_FEATURES:
+        WORKER_FEATURES[key] = get_features(featurecode)
+    try:
+        return obj.id, compute_features(obj, WORKER_FEATURES[key]), None
+    except FeatureError as error:
+        return obj.id, None, str(error)
+
+def featurize_parallel(objects, featurecode, workers=0, chunk_size=CHUNK_SIZE):
+    """Featurizes objects with the features of featurecode in a pool of
+    workers processes, 0 meaning one per CPU, sending them chunk_size at a
+    time. Yields the id and the feature vector of each object, in order,
+    with None for the vector, after logging why, if a feature could not be
+    computed for the object."""
+    tasks = ((featurecode, obj) for obj in objects)
+    for (fid, row, error) in map_ordered(featurize_task, tasks, workers, chunk_size):
+        if error is not None:
+            logger.warning("[pipeline] - " + error)
+        yield fid, row
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+"""
+k-means clustering of the rows of a feature matrix.
+
+Centers are seeded with k-means++ and refined with Lloyd's algorithm. The
+whole run is repeated n_init times and the solution with the lowest inertia
+(sum of squared distances to the nearest center) is kept. Assignment is done
+a block of rows at a time with the Gram-matrix identity, so the only
+quadratic-size temporary is a block by k.
+
+MiniBatchKMeans instead learns the centers from a stream of chunks of rows,
+so the feature matrix never has to be in memory at once.
+"""
+
+from distances import BLOCK_SIZE, as_matrix
+import numpy as np
+
+N_INIT = 10
+MAX_ITERATIONS = 300
+TOLERANCE = 1e-4
+
+
+def cluster(points, k=3, n_init=N_INIT, max_iter=MAX_ITERATIONS, tol=TOLERANCE,
+        random_state=None):
+
+    X = as_matrix(points)
+    rng = np.random.RandomState(random_state)
+    k = min(k, X.shape[0])
+    # The tolerance is relative to the spread of the data, as in scikit-learn.
+    tol = tol * X.var(axis=0).mean() if X.shape[0] > 0 else 0.
+
+    best_labels = best_centers = None
+    best_inertia = np.inf
+    for _ in range(n_init):
+        centers = seed_centers(X, k, rng)
+        centers = lloyd(X, centers, max_iter, tol)
+        labels, inertia = assign(X, centers)
+        if inertia < best_inertia:
+            best_labels, best_centers, best_inertia = labels, centers, inertia
+
+    return best_labels, best_centers
+
+
+def seed_centers(X, k, rng):
+    """Picks k rows with k-means++: each new center is drawn with probability
+    proportional to its squared distance to the nearest center so far."""
+    m = X.shape[0]
+    chosen = [rng.randint(m)]
+    nearest = squared_distances(X, X[chosen])[:, 0]
+    while len(chosen) < k:
+        weights = np.cumsum(nearest)
+        if weights[-1] > 0.:
+            choice = np.searchsorted(weights, rng.uniform() * weights[-1], side="right")
+            choice = min(choice, m - 1)
+        else: # Every row coincides with a center.
+            choice = rng.randint(m)
+        chosen.append(choice)
+        np.minimum(nearest, squared_distances(X, X[[choice]])[:, 0], out=nearest)
+    return X[chosen].copy()
+
+
+def lloyd(X, centers, max_iter, tol):
+    for _ in range(max_iter):
+        labels, _ = assign(X, centers)
+        new_centers = compute_centers(X, labels, centers)
+        shift = ((new_centers - centers) ** 2).sum()
+        centers = new_centers
+        if shift <= tol:
+            break
+    return centers
+
+
+def compute_centers(X, labels, old_centers):
+    k, d = old_centers.shape
+    counts = np.bincount(labels, minlength=k).astype(np.float64)
+    sums = np.empty((k, d))
+    for col in range(d):
+        sums[:, col] = np.bincount(labels, weights=X[:, col], minlength=k)
+    centers = old_centers.copy()
+    nonempty = counts > 0
+    centers[nonempty] = sums[nonempty] / counts[nonempty, np.newaxis]
+    return centers
+
+
+def squared_distances(X, centers):
+    XX = np.einsum("ij,ij->i", X, X)
+    CC = np.einsum("ij,ij->i", centers, centers)
+    D = np.dot(X, centers.T)
+    D *= -2.
+    D += XX[:, np.newaxis]
+    D += CC[np.newaxis, :]
+    return np.maximum(D, 0., out=D)
+
+
+def assign(X, centers):
+    """The index of each row's nearest center, and the inertia."""
+    m = X.shape[0]
+    labels = np.empty(m, dtype=np.int64)
+    inertia = 0.
+    for start in range(0, m, BLOCK_SIZE):
+        D = squared_distances(X[start:start + BLOCK_SIZE], centers)
+        labels[start:start + BLOCK_SIZE] = D.argmin(axis=1)
+        inertia += D.min(axis=1).sum()
+    return labels, inertia
+
+
+class MiniBatchKMeans(object):
+    """Streaming k-means: each call to partial_fit moves every center to the
+    running mean of all rows assigned to it so far.
+
+    The centers are seeded with k-means++ from the first chunk (rows are held
+    back until at least k have been seen).
+    """
+
+    def __init__(self, k, random_state=None):
+        self.k = k
+        self.rng = np.random.RandomState(random_state)
+        self.centers = None
+        self.counts = None
+        self.pending = []
+
+    def partial_fit(self, points):
+        X = as_matrix(points)
+        if self.centers is None:
+            self.pending.append(X)
+            if sum(len(p) for p in self.pending) < self.k:
+                return self
+            X = np.vstack(self.pending)
+            self.pending = []
+            self.centers = seed_centers(X, self.k, self.rng)
+            self.counts = np.zeros(self.k)
+        labels, _ = assign(X, self.centers)
+        counts = np.bincount(labels, minlength=self.k).astype(np.float64)
+        sums = np.empty(self.centers.shape)
+        for col in range(X.shape[1]):
+            sums[:, col] = np.bincount(labels, weights=X[:, col], minlength=self.k)
+        self.counts += counts
+        seen = counts > 0
+        self.centers[seen] += (sums[seen] - counts[seen, np.newaxis] * self.centers[seen]) / \
+            self.counts[seen, np.newaxis]
+        return self
+
+    def finish(self):
+        """Seeds from whatever was held back if fewer than k rows were seen."""
+        if self.centers is None and self.pending:
+            X = np.vstack(self.pending)
+            self.pending = []
+            self.k = X.shape[0]
+            self.centers = X.copy()
+            self.counts = np.ones(self.k)
+        return self
+
+    def predict(self, points):
+        return assign(as_matrix(points), self.centers)[0]
+
+
+def minibatch_cluster(points, k=3, batch_size=BLOCK_SIZE, random_state=None):
+    X = as_matrix(points)
+    model = MiniBatchKMeans(k, random_state=random_state)
+    for start in range(0, X.shape[0], batch_size):
+        model.partial_fit(X[start:start + batch_size])
+    model.finish()
+    return model.predict(X), model.centers
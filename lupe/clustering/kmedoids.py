@@ -1,48 +1,230 @@
 #!/usr/bin/env python
+"""
+k-medoids clustering over a precomputed distance matrix.
 
+Medoids are seeded with k-medoids++ and refined in two phases:
+
+    1. Alternate: assign points to their nearest medoid and move each medoid
+       to the point with the lowest cost within its cluster. Only the
+       cluster's own submatrix is read.
+    2. Swap: try replacing medoids with non-medoids, FastPAM style. One row
+       of distances and the nearest and second nearest medoid distances give
+       the change in cost of swapping a candidate with every medoid at once.
+       If max_neighbors is set, each pass only tries that many randomly drawn
+       candidates, as in CLARANS.
+
+Both phases stop after max_iter passes or when a pass improves the total
+cost by no more than tol times the current cost.
+
+The distances can be a dense ndarray or any storage from distances.py.
+
+For data sets too large for any all-pairs matrix, clara() runs the above on
+several random subsamples of the feature matrix (CLARA). It assigns every
+point to the nearest medoid of each solution by streaming over the feature
+matrix, and keeps the solution with the lowest total cost.
+"""
+
+from distances import BLOCK_SIZE, as_matrix, build_distance_matrix, columns, pairwise, rows, submatrix
 import numpy as np
-import random
+
+MAX_ITERATIONS = 100
+TOLERANCE = 0.
+CLARA_SAMPLES = 5
 
 
-def cluster(distances, k=3):
+def cluster(distances, k=3, max_iter=MAX_ITERATIONS, tol=TOLERANCE,
+        max_neighbors=None, random_state=None):
 
     m = distances.shape[0]  # number of points
+    rng = np.random.RandomState(random_state)
+
+    if k >= m:
+        medoids = np.arange(m)
+    else:
+        medoids = seed_medoids(distances, k, rng)
+        medoids = alternate(distances, medoids, max_iter, tol)
+        medoids = swap(distances, medoids, max_iter, tol, max_neighbors, rng)
+
+    clusters = assign_points_to_clusters(medoids, distances)
+    return clusters, medoids
+
+
+def seed_medoids(distances, k, rng):
+    """Picks k distinct medoids with k-medoids++: each new medoid is drawn
+    with probability proportional to its squared distance to the nearest
+    medoid picked so far. Points already picked are never picked again,
+    even if every point left coincides with one of them."""
+    m = distances.shape[0]
+    medoids = [rng.randint(m)]
+    nearest = columns(distances, medoids)[:, 0].astype(np.float64)
+    while len(medoids) < k:
+        weights = np.cumsum(nearest ** 2)
+        choice = None
+        if weights[-1] > 0.:
+            choice = np.searchsorted(weights, rng.uniform() * weights[-1], side="right")
+            choice = min(choice, m - 1)
+        if choice is None or choice in medoids: # Every point coincides with a medoid.
+            choice = rng.choice(np.setdiff1d(np.arange(m), medoids))
+        medoids.append(choice)
+        np.minimum(nearest, columns(distances, [choice])[:, 0], out=nearest)
+    return np.array(medoids)
+
+
+def alternate(distances, medoids, max_iter, tol):
+    medoids = medoids.copy()
+    labels, nearest, _ = nearest_medoids(medoids, distances)
+    cost = nearest.sum()
+    for _ in range(max_iter):
+        new_medoids = medoids.copy()
+        for (i, medoid) in enumerate(medoids):
+            cluster = np.where(labels == i)[0]
+            if len(cluster) > 0: # Empty if another medoid is a duplicate point.
+                # Duplicate points can tie for the lowest cost; never move to
+                # a point that another medoid already is.
+                taken = np.delete(new_medoids, i)
+                new_medoids[i] = compute_new_medoid(cluster, distances, taken)
+        if (new_medoids == medoids).all():
+            break
+        new_labels, new_nearest, _ = nearest_medoids(new_medoids, distances)
+        new_cost = new_nearest.sum()
+        if new_cost > cost:
+            break
+        medoids, labels, nearest = new_medoids, new_labels, new_nearest
+        converged = cost - new_cost <= tol * cost
+        cost = new_cost
+        if converged:
+            break
+    return medoids
 
-    # Pick k random medoids.
-    curr_medoids = np.array([-1] * k)
-    while not len(np.unique(curr_medoids)) == k:
-        curr_medoids = np.array([random.randint(0, m - 1) for _ in range(k)])
-    # Doesn't matter what we initialize these to.
-    old_medoids = np.array([-1] * k)
-    new_medoids = np.array([-1] * k)
-    clusters = None
-    
-    # Until the medoids stop updating, do the following:
-    while not ((old_medoids == curr_medoids).all()):
-        # Assign each point to cluster with closest medoid.
-        clusters = assign_points_to_clusters(curr_medoids, distances)
 
-        # Update cluster medoids to be lowest cost point.
-        for curr_medoid in curr_medoids:
-            cluster = np.where(clusters == curr_medoid)[0]
-            new_medoids[curr_medoids == curr_medoid] = compute_new_medoid(
-                cluster, distances)
+def swap(distances, medoids, max_iter, tol, max_neighbors, rng):
+    m = distances.shape[0]
+    k = len(medoids)
+    medoids = medoids.copy()
+    is_medoid = np.zeros(m, dtype=bool)
+    is_medoid[medoids] = True
+    labels, nearest, second = nearest_medoids(medoids, distances)
+    for _ in range(max_iter):
+        start_cost = cost = nearest.sum()
+        candidates = np.where(~is_medoid)[0]
+        if max_neighbors is not None and max_neighbors < len(candidates):
+            candidates = rng.choice(candidates, max_neighbors, replace=False)
+        removal_loss = compute_removal_loss(labels, nearest, second, k)
+        for candidate in candidates:
+            if is_medoid[candidate]:
+                continue
+            delta = compute_swap_deltas(rows(distances, [candidate])[0],
+                labels, nearest, second, removal_loss)
+            i = delta.argmin()
+            if delta[i] < 0.:
+                is_medoid[medoids[i]] = False
+                is_medoid[candidate] = True
+                medoids[i] = candidate
+                labels, nearest, second = nearest_medoids(medoids, distances)
+                removal_loss = compute_removal_loss(labels, nearest, second, k)
+                cost = nearest.sum()
+        if start_cost - cost <= tol * start_cost:
+            break
+    return medoids
 
-        old_medoids[:] = curr_medoids[:]
-        curr_medoids[:] = new_medoids[:]
 
-    return clusters, curr_medoids
+def compute_removal_loss(labels, nearest, second, k):
+    """The increase in cost from removing each medoid, with its points moving
+    to their second nearest medoid."""
+    if k == 1:
+        return np.zeros(1)
+    return np.bincount(labels, weights=second - nearest, minlength=k)
+
+
+def compute_swap_deltas(candidate_distances, labels, nearest, second, removal_loss):
+    """The change in total cost from swapping the candidate with each medoid."""
+    k = len(removal_loss)
+    d = candidate_distances.astype(np.float64)
+    if k == 1: # Every point moves to the candidate.
+        return np.array([(d - nearest).sum()])
+    closer = d < nearest
+    # Points closer to the candidate than to their medoid move to it whichever
+    # medoid is removed, and so do not pay the removal loss of their medoid.
+    delta = removal_loss + (d - nearest)[closer].sum()
+    delta += np.bincount(labels[closer], weights=(nearest - second)[closer], minlength=k)
+    # Points between their nearest and second nearest medoid move to the
+    # candidate instead of the second nearest if their medoid is removed.
+    between = ~closer & (d < second)
+    delta += np.bincount(labels[between], weights=(d - second)[between], minlength=k)
+    return delta
+
+
+def nearest_medoids(medoids, distances):
+    """For each point, the position in medoids of its nearest medoid, and its
+    distances to the nearest and second nearest medoids."""
+    distances_to_medoids = columns(distances, medoids).astype(np.float64)
+    m = distances_to_medoids.shape[0]
+    labels = np.argmin(distances_to_medoids, axis=1)
+    everything = np.arange(m)
+    nearest = distances_to_medoids[everything, labels]
+    if len(medoids) == 1:
+        return labels, nearest, np.empty(m)
+    distances_to_medoids[everything, labels] = np.inf
+    second = distances_to_medoids.min(axis=1)
+    return labels, nearest, second
 
 
 def assign_points_to_clusters(medoids, distances):
-    distances_to_medoids = distances[:, medoids]
+    distances_to_medoids = columns(distances, medoids)
     return medoids[np.argmin(distances_to_medoids, axis=1)]
 
 
-def compute_new_medoid(cluster, distances):
-    mask = np.ones(distances.shape)
-    mask[np.ix_(cluster, cluster)] = 0.
-    cluster_distances = np.ma.masked_array(
-        data=distances, mask=mask, fill_value=10e9)
-    costs = cluster_distances.sum(axis=1)
-    return costs.argmin(axis=0, fill_value=10e9)
+def compute_new_medoid(cluster, distances, taken=()):
+    # Only the cluster's own submatrix is needed, so this also works when
+    # distances is condensed or memory-mapped.
+    costs = submatrix(distances, cluster).sum(axis=1).astype(np.float64)
+    costs[np.in1d(cluster, taken)] = np.inf
+    return cluster[costs.argmin()]
+
+
+def clara(points, k=3, samples=CLARA_SAMPLES, sample_size=None, metric="euclidean",
+        max_iter=MAX_ITERATIONS, tol=TOLERANCE, random_state=None):
+
+    X = as_matrix(points)
+    m = X.shape[0]
+    rng = np.random.RandomState(random_state)
+    if k >= m:
+        medoids = np.arange(m)
+        return medoids[assign_points_to_medoids(X, medoids, metric)[0]], medoids
+
+    if sample_size is None:
+        sample_size = 40 + 2 * k # As recommended by Kaufman and Rousseeuw.
+    sample_size = min(max(sample_size, k + 1), m)
+
+    best_medoids = best_labels = None
+    best_cost = np.inf
+    for _ in range(samples):
+        if best_medoids is None:
+            sample = rng.choice(m, sample_size, replace=False)
+        else: # Keep the best medoids so far in every later sample.
+            others = np.setdiff1d(np.arange(m), best_medoids)
+            others = rng.choice(others, sample_size - k, replace=False)
+            sample = np.concatenate([best_medoids, others])
+        distances = build_distance_matrix(X[sample], metric=metric)
+        _, sample_medoids = cluster(distances, k=k, max_iter=max_iter, tol=tol,
+            random_state=rng.randint(2**31 - 1))
+        medoids = sample[sample_medoids]
+        labels, cost = assign_points_to_medoids(X, medoids, metric)
+        if cost < best_cost:
+            best_medoids, best_labels, best_cost = medoids, labels, cost
+
+    return best_medoids[best_labels], best_medoids
+
+
+def assign_points_to_medoids(X, medoids, metric="euclidean"):
+    """Positions in medoids of each point's nearest medoid and the total cost,
+    computed a block of rows at a time from the feature matrix."""
+    m = X.shape[0]
+    labels = np.empty(m, dtype=np.int64)
+    cost = 0.
+    centers = X[medoids]
+    for start in range(0, m, BLOCK_SIZE):
+        block = pairwise(X[start:start + BLOCK_SIZE], centers, metric)
+        labels[start:start + BLOCK_SIZE] = block.argmin(axis=1)
+        cost += block.min(axis=1).sum()
+    return labels, cost
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+"""
+Principal component analysis with a solver chosen from the shape of the data.
+
+Solvers:
+    eigh: eigendecomposition of the symmetric d x d covariance matrix.
+    randomized: randomized truncated SVD of the centered data (Halko,
+        Martinsson and Tropp), which only finds the requested components.
+    incremental: the mean and covariance are accumulated over chunks of rows
+        and then decomposed with eigh, so the centered data is never copied.
+        fit_chunks does the same for a stream of chunks.
+
+Component signs are fixed so that the largest entry of each is positive, and
+the randomized solver uses a fixed seed, so results are deterministic.
+"""
+
+import numpy as np
+
+CHUNK_SIZE = 10000 # rows per chunk
+INCREMENTAL_MIN_ELEMENTS = 1 << 26 # use chunks above this many entries
+RANDOMIZED_MIN_SIZE = 500 # smallest min(n, d) worth a randomized SVD
+RANDOMIZED_MAX_FRACTION = .5 # largest share of min(n, d) to find randomized
+OVERSAMPLES = 10
+POWER_ITERATIONS = 4
+
+
+def project(data, dimensions, solver="auto", random_state=0):
+    """Projects the rows of data onto their first principal components."""
+    X = np.asarray(data, dtype=np.float64)
+    (n, d) = X.shape
+    dimensions = min(dimensions, d)
+    if solver == "auto":
+        solver = choose_solver(n, d, dimensions)
+    if solver == "incremental":
+        mean, components = fit_chunks(chunk_rows(X), dimensions)
+    else:
+        mean = X.mean(axis=0)
+        if solver == "eigh":
+            components = fit_eigh(X - mean, dimensions)
+        elif solver == "randomized":
+            components = fit_randomized(X - mean, dimensions, random_state)
+        else:
+            raise RuntimeError("No such PCA solver: " + str(solver))
+    return transform(X, mean, components)
+
+
+def choose_solver(n, d, dimensions):
+    if n * d >= INCREMENTAL_MIN_ELEMENTS:
+        return "incremental"
+    smallest = min(n, d)
+    if smallest >= RANDOMIZED_MIN_SIZE and dimensions <= RANDOMIZED_MAX_FRACTION * smallest:
+        return "randomized"
+    return "eigh"
+
+
+def chunk_rows(X, chunk_size=CHUNK_SIZE):
+    for start in range(0, X.shape[0], chunk_size):
+        yield X[start:start + chunk_size]
+
+
+def fit_eigh(centered, dimensions):
+    covariance = np.dot(centered.T, centered) / max(centered.shape[0] - 1, 1)
+    return top_eigenvectors(covariance, dimensions)
+
+
+def fit_chunks(chunks, dimensions):
+    """The mean and top principal components of the rows of a stream of
+    chunks. Rows are shifted by the first chunk's mean before accumulating to
+    limit cancellation."""
+    shift = None
+    n = 0
+    total = scatter = None
+    for chunk in chunks:
+        chunk = np.asarray(chunk, dtype=np.float64)
+        if shift is None:
+            shift = chunk.mean(axis=0)
+            total = np.zeros(chunk.shape[1])
+            scatter = np.zeros((chunk.shape[1], chunk.shape[1]))
+        shifted = chunk - shift
+        n += chunk.shape[0]
+        total += shifted.sum(axis=0)
+        scatter += np.dot(shifted.T, shifted)
+    if n == 0:
+        raise RuntimeError("Cannot compute principal components of no data.")
+    offset = total / n
+    covariance = (scatter - n * np.outer(offset, offset)) / max(n - 1, 1)
+    dimensions = min(dimensions, covariance.shape[0])
+    return shift + offset, top_eigenvectors(covariance, dimensions)
+
+
+def top_eigenvectors(covariance, dimensions):
+    (eig_values, eig_vectors) = np.linalg.eigh(covariance)
+    order = np.argsort(-eig_values)[:dimensions]
+    return flip_signs(eig_vectors[:, order])
+
+
+def fit_randomized(centered, dimensions, random_state=0):
+    rng = np.random.RandomState(random_state)
+    (n, d) = centered.shape
+    size = min(dimensions + OVERSAMPLES, n, d)
+    Q = np.dot(centered, rng.normal(size=(d, size)))
+    Q = np.linalg.qr(Q)[0]
+    for _ in range(POWER_ITERATIONS):
+        Q = np.linalg.qr(np.dot(centered.T, Q))[0]
+        Q = np.linalg.qr(np.dot(centered, Q))[0]
+    B = np.dot(Q.T, centered)
+    Vt = np.linalg.svd(B, full_matrices=False)[2]
+    return flip_signs(Vt[:dimensions].T)
+
+
+def flip_signs(components):
+    largest = np.abs(components).argmax(axis=0)
+    signs = np.sign(components[largest, np.arange(components.shape[1])])
+    signs[signs == 0.] = 1.
+    return components * signs
+
+
+def transform(X, mean, components):
+    projected = np.empty((X.shape[0], components.shape[1]))
+    for start in range(0, X.shape[0], CHUNK_SIZE):
+        projected[start:start + CHUNK_SIZE] = np.dot(X[start:start + CHUNK_SIZE] - mean, components)
+    return projected
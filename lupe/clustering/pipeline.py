@@ -4,9 +4,14 @@ from time import time
 logger = get_logger("lupe")
 start = time()
 
-from clustering import spectral, kmedoids
+from clustering import spectral, sparse_spectral, kmedoids, clara, minibatch
+from clustering import CLARA_SETTINGS, DISTANCE_SETTINGS, SPECTRAL_SETTINGS
 from numpy import linalg, cov, argsort, dot, empty, zeros, array, max, abs, isnan
+from store import FeatureMatrix, fetch_store, is_store
 from tsnewrapper import calc_tsne
+from bhtsne import THETA
+
+import pca as pca_module
 
 import csv
 import json
@@ -16,22 +21,32 @@ elapsed = time() - start
 logger.debug("[pipeline] - Time to import (seconds): " + str(elapsed))
 
 PERPLEXITY = 50
+TSNE_SETTINGS = {
+    'perplexity': PERPLEXITY,
+    'theta': THETA, # Barnes-Hut accuracy; 0 computes the exact gradient
+}
 NON_PCA_PIPELINES = [1, 5, 6, 8]
 PCA_PIPELINES = [2, 3, 4, 7, 9]
 
 
 def main(inputpoints, inputmouseovers, outputclusters, pipeline, nclusters, clusterer, pcadims, normalize):
-    features = read_points(inputpoints)
-    points = [feature[1:] for feature in features]  # Exclude the object ID.
-    ids = [feature[0] for feature in features] # The object IDs.
+    if is_store(inputpoints):
+        features, mouseovers, meta = fetch_store(inputpoints)
+        if inputmouseovers is not None:
+            mouseovers = read_mouseovers(inputmouseovers)
+    else:
+        rows = array(read_points(inputpoints))
+        features = FeatureMatrix(rows[:, 0], rows[:, 1:])  # The first column is the object ID.
+        mouseovers = read_mouseovers(inputmouseovers) 
+    points = features.vectors
+    ids = features.ids.tolist()
     if normalize:
         points = normalize_points(points)
-    mouseovers = read_mouseovers(inputmouseovers) 
     clusters, projected_points = run_pipeline(pipeline, nclusters, points, outputclusters, clusterer, pcadims)
     output_clusters(ids, clusters, outputclusters)
     plot(projected_points, clusters, outputclusters)
     output_visualization_data(projected_points, clusters, mouseovers, outputclusters)
-    output_projected_points(ids, projected_points, features, outputclusters)
+    output_projected_points(ids, projected_points, features.rows(), outputclusters)
 
 def read_points(input):
     points = []
@@ -67,6 +82,32 @@ def normalize_points(points):
     return p
 
 
+def configure_distances(condensed=False, float32=False, filename=None, workers=1):
+    DISTANCE_SETTINGS['condensed'] = condensed
+    DISTANCE_SETTINGS['dtype'] = 'float32' if float32 else 'float64'
+    DISTANCE_SETTINGS['filename'] = filename
+    DISTANCE_SETTINGS['workers'] = workers
+
+
+def configure_clara(samples=None, sample_size=None):
+    if samples is not None:
+        CLARA_SETTINGS['samples'] = samples
+    CLARA_SETTINGS['sample_size'] = sample_size
+
+
+def configure_spectral(neighbors=None, epsilon=None):
+    if neighbors is not None:
+        SPECTRAL_SETTINGS['neighbors'] = neighbors
+    SPECTRAL_SETTINGS['epsilon'] = epsilon
+
+
+def configure_tsne(perplexity=None, theta=None):
+    if perplexity is not None:
+        TSNE_SETTINGS['perplexity'] = perplexity
+    if theta is not None:
+        TSNE_SETTINGS['theta'] = theta
+
+
 def run_pipeline(pipeline, nclusters, points, outputclusters, clusterer, pcadims):
     pipelines = {
         1: pipeline1,
@@ -148,27 +189,26 @@ def pipeline9(points, outputclusters, *args, **kwargs):
 def cluster(points, k, clusterer):
     if clusterer == "spectral":
         return spectral(points, k)
+    elif clusterer == "sparsespectral":
+        return sparse_spectral(points, k)
     elif clusterer == "kmedoids":
         return kmedoids(points, k)
+    elif clusterer == "clara":
+        return clara(points, k)
+    elif clusterer == "minibatch":
+        return minibatch(points, k)
     else:
         raise RuntimeError("No valid clustering method chosen.")
 
 
 def pca(data, dimensions):
-    data = array(data)
-    new = data - data.mean(axis=0)
-    if new.shape[1] < dimensions:
-        dimensions = new.shape[1]
-    (eig_values, eig_vectors) = linalg.eig(cov(new.T))
-    perm = argsort(-eig_values)
-    eig_vectors = eig_vectors[:, perm[0:dimensions]]
-    new = dot(new, eig_vectors)
-    return new
+    return pca_module.project(data, dimensions)
 
 
 def tsne(points):
     points = array(points)  # Make sure that points is a numpy array.
-    return calc_tsne(points, no_dims=2, perplexity=PERPLEXITY, landmarks=1)
+    return calc_tsne(points, no_dims=2, perplexity=TSNE_SETTINGS['perplexity'], landmarks=1,
+        theta=TSNE_SETTINGS['theta'])
 
 
 def output_clusters(ids, clusters, filename):
@@ -210,9 +250,9 @@ if __name__ == "__main__":
     from argparse import ArgumentParser
     parser = ArgumentParser("Project and cluster points.")
     parser.add_argument("-i", "--points",
-                        help="REQUIRED: the data points in .csv format to project and cluster (first column is id)")
+                        help="REQUIRED: the feature store, or the data points in .csv format (first column is id), to project and cluster")
     parser.add_argument("-m", "--mouseovers",
-                        help="REQUIRED: the mouseover labels in .csv format for the data points")
+                        help="the mouseover labels in .csv format for the data points (REQUIRED unless the points are a feature store)")
     parser.add_argument("-o", "--clusters",
                         help="the output filename to write the cluster assingments (default: clusters)")
     parser.add_argument("-p", "--pipeline", type=int,
@@ -230,11 +270,32 @@ if __name__ == "__main__":
     parser.add_argument("-k", "--nclusters", type=int,
                         help="number of clusters to look for (default: 4)")
     parser.add_argument("-c", "--clusterer",
-                        help="method to use for clustering (options: spectral, kmedoids; default: kmedoids)")
+                        help="method to use for clustering (options: spectral, sparsespectral, kmedoids, clara, minibatch; default: kmedoids)")
     parser.add_argument("-d", "--pcadims", type=int,
                         help="dimensions to reduce to via PCA (default: None)")
     parser.add_argument("-n", "--normalize", action="store_true",
                         help="whether or not to normalize (default: False)")
+    parser.add_argument("--condensed", action="store_true",
+                        help="store only the upper triangle of the distance matrix (default: False)")
+    parser.add_argument("--float32", action="store_true",
+                        help="store distances in single precision (default: False)")
+    parser.add_argument("--distancefile",
+                        help="back the distance matrix with a memory-mapped file of this name (default: None)")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of processes to compute distances with; 0 means one per CPU (default: 1)")
+    parser.add_argument("--clarasamples", type=int,
+                        help="number of subsamples to cluster with clara (default: 5)")
+    parser.add_argument("--clarasize", type=int,
+                        help="number of points in each clara subsample (default: 40 + 2k)")
+    parser.add_argument("--neighbors", type=int,
+                        help="neighbours per point in the sparsespectral graph (default: 10)")
+    parser.add_argument("--epsilon", type=float,
+                        help="connect points within this distance in the sparsespectral graph \
+                            instead of nearest neighbours (default: None)")
+    parser.add_argument("--perplexity", type=float,
+                        help="perplexity of tsne (default: 50)")
+    parser.add_argument("--theta", type=float,
+                        help="Barnes-Hut accuracy of tsne; 0 is exact (default: 0.5)")
     
     args = parser.parse_args()
     if all([arg is None for arg in vars(args).values()]):
@@ -243,7 +304,7 @@ if __name__ == "__main__":
 
     if not args.points:
         raise RuntimeError("You must specify input points.")
-    if not args.mouseovers:
+    if not args.mouseovers and not is_store(args.points):
         raise RuntimeError("You must specify mouse-over points.")
     if not args.pipeline:
         raise RuntimeError("You must specify a pipeline to run.")
@@ -259,5 +320,9 @@ if __name__ == "__main__":
         raise RuntimeWarning(
             "You need to specify the number of dimensions to reduce to using PCA (using the -d flag).")
 
+    configure_distances(args.condensed, args.float32, args.distancefile, args.jobs)
+    configure_clara(args.clarasamples, args.clarasize)
+    configure_spectral(args.neighbors, args.epsilon)
+    configure_tsne(args.perplexity, args.theta)
     main(args.points, args.mouseovers, args.clusters, 
         args.pipeline, args.nclusters, args.clusterer, args.pcadims, args.normalize)
@@ -16,8 +16,10 @@ logger.addHandler(handler)
 
 from argparse import ArgumentParser
 from data import *
+from kmeans import MiniBatchKMeans
 from pipeline import *
 from queryutils.arguments import lookup, SOURCES
+from store import StoreWriter, fetch_store, is_store, output_store, source_settings, store_name
 
 # Uncomment to debug:
 # from numpy import seterr
@@ -25,6 +27,9 @@ from queryutils.arguments import lookup, SOURCES
 
 NON_PCA_PIPELINES = [1, 5, 6, 8]
 PCA_PIPELINES = [2, 3, 4, 7, 9]
+BATCH_SIZE = 1000
+# Modules in the features directory that hold no features of their own.
+NON_FEATURE_MODULES = ["__init__.py", "views.py", "visitor.py"]
 
 def get_args():
 
@@ -63,7 +68,11 @@ def get_args():
                             This should be compatible with the choice of features. \
                             Can be one of: " + object_options)
     parser.add_argument("-c", "--clusterer",
-                        help="Method used to cluster. Default is spectral clustering.")
+                        help="Method used to cluster. Can be one of: \
+                            spectral, sparsespectral, kmedoids, clara, minibatch. \
+                            With minibatch, objects are clustered while they are \
+                            fetched and only the cluster assignments are output. \
+                            Default is spectral clustering.")
     parser.add_argument("-d", "--pcadimension", type=int,
                         help="Dimension to reduce feature space down to when using PCA. \
                             Not applicable for all pipelines.")
@@ -76,17 +85,58 @@ def get_args():
                             cluster assignments (.csv format). \
                             Default name is 'output' with appropriate extensions.")
     parser.add_argument("-t", "--outputfeatures",
-                        help="Name of the output file containing \
-                            raw features vectors (.csv format).")
+                        help="Name of the output feature store containing \
+                            raw features vectors and mouseovers \
+                            (a directory; the .features extension is added \
+                            unless the name already ends with it).")
+    parser.add_argument("--csv", action="store_true",
+                        help="Whether to also write the raw features vectors \
+                            to a file named by -t (.csv format). \
+                            Default is false.")
     parser.add_argument("-u", "--outputmouseovers",
                         help="Name of the output file containing \
                             raw mouseovers vectors (.csv format).")
     parser.add_argument("-i", "--inputfeatures",
-                        help="Name of the input file containing \
-                            raw features vectors (.csv format).")
+                        help="Name of the input feature store, or of the input \
+                            file containing raw features vectors (.csv format).")
     parser.add_argument("-m", "--inputmouseovers",
                         help="Name of the input file containing \
-                            raw mouseovers vectors (.csv format).")
+                            raw mouseovers vectors (.csv format). \
+                            Not needed with a feature store.")
+    parser.add_argument("--condensed", action="store_true",
+                        help="Whether to store only the upper triangle of the \
+                            distance matrix, which halves its size. Default is false.")
+    parser.add_argument("--float32", action="store_true",
+                        help="Whether to store distances in single precision. \
+                            Default is false.")
+    parser.add_argument("--distancefile",
+                        help="Name of a file to back the distance matrix with \
+                            via a memory map, for matrices larger than memory.")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of processes to use when featurizing \
+                            and computing distances. \
+                            0 means one per CPU. Default is 1.")
+    parser.add_argument("--clarasamples", type=int,
+                        help="Number of subsamples to cluster when using clara. \
+                            Default is 5.")
+    parser.add_argument("--clarasize", type=int,
+                        help="Number of objects in each clara subsample. \
+                            Default is 40 + 2k.")
+    parser.add_argument("--batchsize", type=int, default=BATCH_SIZE,
+                        help="Number of objects per batch when using minibatch. \
+                            Default is 1000.")
+    parser.add_argument("--neighbors", type=int,
+                        help="Number of nearest neighbours each object is connected \
+                            to when using sparsespectral. Default is 10.")
+    parser.add_argument("--epsilon", type=float,
+                        help="If given, sparsespectral connects all objects within \
+                            this distance instead of nearest neighbours.")
+    parser.add_argument("--perplexity", type=float,
+                        help="Perplexity of t-SNE in the pipelines that use it. \
+                            Default is 50.")
+    parser.add_argument("--theta", type=float,
+                        help="Barnes-Hut accuracy of t-SNE; smaller is more exact \
+                            and 0 computes the exact gradient. Default is 0.5.")
     args = queryutils.arguments.get_arguments(parser)
    
     if all([arg is None for arg in vars(args).values()]):
@@ -100,7 +150,7 @@ def get_feature_modules():
     features = []
     for (dirpath, dirnames, filenames) in walk(features_dir):
         for filename in filenames:
-            if not filename == "__init__.py" and filename[-3:] == ".py":
+            if not filename in NON_FEATURE_MODULES and filename[-3:] == ".py":
                 features.append(filename[:-3])
     return features
 
@@ -134,7 +184,7 @@ def run(source, pipeline, nclusters, featurecode,
         clusterees, clusterer,
         outputclusters, outputfeatures, outputmouseovers,
         inputfeatures, inputmouseovers,
-        pcadims, normalize):
+        pcadims, normalize, batchsize=BATCH_SIZE, exportcsv=False, settings=None, workers=1):
 
     logger.debug("[run] - Beginning execution.")
     logger.debug("[run] - Parameter: source = " + str(source))
@@ -148,6 +198,7 @@ def run(source, pipeline, nclusters, featurecode,
     logger.debug("[run] - Parameter: inputfeatures = " + str(inputfeatures))
     logger.debug("[run] - Parameter: pcadims = " + str(pcadims))
     logger.debug("[run] - Parameter: normalize = " + str(normalize))
+    logger.debug("[run] - Parameter: workers = " + str(workers))
 
     if (pipeline in NON_PCA_PIPELINES) and pcadims is not None:
         raise RuntimeWarning(
@@ -156,18 +207,34 @@ def run(source, pipeline, nclusters, featurecode,
         raise RuntimeWarning(
             "You need to specify the number of dimensions to reduce to using PCA (using the -d flag).")
 
-    if inputfeatures is None or inputmouseovers is None:
+    inputstore = inputfeatures is not None and is_store(inputfeatures)
+    if inputfeatures is None or (inputmouseovers is None and not inputstore):
+        inputfeatures = None
+
+    if clusterer == "minibatch" and inputfeatures is None:
+        run_minibatch(source, nclusters, featurecode, clusterees,
+            outputclusters, outputfeatures, outputmouseovers, normalize, batchsize,
+            exportcsv, settings, workers)
+        return
+
+    if inputfeatures is None:
         data, mouseovers = fetch_data(source, clusterees)
         output_mouseovers(mouseovers, outputmouseovers)
         start = time()
-        features = featurize(data, featurecode)
-        output_features(features, outputfeatures)
+        features = featurize(data, featurecode, workers)
+        output_store(features, mouseovers, store_name(outputfeatures), featurecode, settings)
+        if exportcsv:
+            output_features(features, outputfeatures)
+    elif inputstore:
+        features, mouseovers, meta = fetch_store(inputfeatures, featurecode, settings)
+        if inputmouseovers is not None:
+            mouseovers = fetch_mouseovers(inputmouseovers)
     else:
         features = fetch_features(inputfeatures)
         mouseovers = fetch_mouseovers(inputmouseovers)
 
-    points = [feature[1:] for feature in features]  # Exclude the object ID.
-    ids = [feature[0] for feature in features] # The object IDs.
+    points = features.vectors
+    ids = features.ids.tolist()
     if normalize:
         points = normalize_points(points)
 
@@ -175,15 +242,84 @@ def run(source, pipeline, nclusters, featurecode,
     output_clusters(ids, clusters, outputclusters)
     plot(projected_points, clusters, outputclusters)
     output_visualization_data(projected_points, clusters, mouseovers, outputclusters)
-    output_projected_points(ids, projected_points, features, outputclusters)
+    output_projected_points(ids, projected_points, features.rows(), outputclusters)
+
+
+def run_minibatch(source, nclusters, featurecode, clusterees,
+        outputclusters, outputfeatures, outputmouseovers, normalize, batchsize,
+        exportcsv=False, settings=None, workers=1):
+    """Clusters with mini-batch k-means as objects are fetched and featurized.
+
+    Feature vectors are written to the feature store chunk by chunk as they
+    are computed, so memory use depends on the batch size and not on the
+    number of objects. A second pass over the memory-mapped store assigns
+    the clusters. If the features are normalized, the centers are fitted in
+    an extra pass once the maximum of each feature is known.
+    """
+    logger.debug("[run] - Clustering with mini-batch k-means.")
+    start = time()
+    model = MiniBatchKMeans(nclusters)
+    names = feature_names(get_features(featurecode))
+    storename = store_name(outputfeatures)
+    writer = StoreWriter(storename, names, featurecode, settings)
+    csvfile = open(".".join([outputfeatures, "csv"]), 'w') if exportcsv else None
+    max_abs = numpy.zeros(len(names))
+    try:
+        objects = stream_data(source, clusterees, outputmouseovers)
+        for (ids, vectors) in featurize_chunks(objects, featurecode, batchsize, workers):
+            writer.append(ids, vectors)
+            if csvfile is not None:
+                write_features(FeatureMatrix(numpy.array(ids), vectors), csvfile)
+            numpy.maximum(max_abs, numpy.abs(vectors).max(axis=0), out=max_abs)
+            if not normalize:
+                model.partial_fit(vectors)
+        if writer.count == 0:
+            raise RuntimeError(
+                "Featurizing was unsuccessful -- no features computed.")
+        writer.close(".".join([outputmouseovers, "json"]))
+    finally:
+        writer.discard()
+        if csvfile is not None:
+            csvfile.close()
+
+    features, _, _ = fetch_store(storename)
+    scale = numpy.where(max_abs > 0., max_abs, 1.)
+    if normalize:
+        for (ids, vectors) in store_chunks(features, batchsize):
+            model.partial_fit(vectors / scale)
+    model.finish()
+
+    with open(".".join([outputclusters, "csv"]), 'w') as clusterfile:
+        clusterwriter = csv.writer(clusterfile)
+        for (ids, vectors) in store_chunks(features, batchsize):
+            if normalize:
+                vectors = vectors / scale
+            for (point_id, cluster_id) in zip(ids, model.predict(vectors)):
+                clusterwriter.writerow([point_id, cluster_id])
+    elapsed = time() - start
+    logger.debug("[run] - Time to cluster with mini-batch k-means (seconds): " + str(elapsed))
+    logger.debug("[run] - Objects clustered: " + str(len(features)))
+
+
+def store_chunks(features, chunk_size):
+    """Yields the ids and the feature vectors of a FeatureMatrix chunk_size
+    rows at a time."""
+    for begin in range(0, len(features), chunk_size):
+        yield (features.ids[begin:begin + chunk_size].tolist(),
+            numpy.asarray(features.vectors[begin:begin + chunk_size]))
 
 
 if __name__ == "__main__":
     args = get_args()
     check_args(args)
     source = queryutils.arguments.initialize_source(args.source, args)
+    configure_distances(args.condensed, args.float32, args.distancefile, args.jobs)
+    configure_clara(args.clarasamples, args.clarasize)
+    configure_spectral(args.neighbors, args.epsilon)
+    configure_tsne(args.perplexity, args.theta)
     run(source, int(args.pipeline), args.nclusters, args.features,
         args.clusterees, args.clusterer,
         args.outputclusters, args.outputfeatures, args.outputmouseovers,
         args.inputfeatures, args.inputmouseovers,
-        args.pcadimension, args.normalize)
+        args.pcadimension, args.normalize, args.batchsize, args.csv,
+        source_settings(args, args.clusterees), args.jobs)
@@ -1,7 +1,7 @@
 from queryutils.arguments import lookup, SOURCES
 from queryutils.query import QueryType
-from queryutils.parse import tokenize_query, split_query_into_stages, parse_query
-from queryutils.splunktypes import lookup_categories
+from queryutils.parse import tokenize_query
+from lupe.parsing.cache import lookup_categories, parse_query, split_query_into_stages
 from featurize import get_features, featurize_obj
 import json
 import csv
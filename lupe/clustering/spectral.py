@@ -1,17 +1,21 @@
 #!/usr/bin/env python
 
-import clustering
-import kmedoids
+import kmeans
 import numpy as np
+import scipy.sparse as sparse
+from distances import BLOCK_ELEMENTS, block_bounds, empty_like, is_condensed, nearest_neighbors, radius_neighbors
 import scipy
 import scipy.linalg as la
-from scipy.sparse.linalg import eigsh
+from scipy.sparse.linalg import eigsh, LinearOperator
 from scipy.sparse.linalg import svds
 
-from scipy.cluster.vq import whiten, kmeans
+from scipy.cluster.vq import whiten
 
 import matplotlib.pyplot as plt
 
+NEIGHBORS = 10
+LOCAL_SCALE_NEIGHBOR = 7 # Zelnik-Manor and Perona's choice for self-tuning.
+
 def cluster(distances, k=4, sigma=1.):
     np.seterr(all='print')
     L = compute_special_L(distances, sigma)
@@ -19,9 +23,64 @@ def cluster(distances, k=4, sigma=1.):
     Y = renormalize(X)
     return cluster_rows_in_k(Y, k)
 
+def cluster_sparse(points, k=4, neighbors=NEIGHBORS, epsilon=None, sigma=None,
+        metric="euclidean"):
+    """Spectral clustering on a sparse neighbourhood graph of the points.
+
+    Only the k nearest neighbours of each point (or, if epsilon is given, all
+    points within epsilon) get a nonzero affinity, so memory is proportional
+    to the number of edges rather than m^2. Unless sigma is given, each point
+    gets its own scale, the distance to its LOCAL_SCALE_NEIGHBOR-th neighbour
+    (self-tuning spectral clustering).
+    """
+    np.seterr(all='print')
+    affinity = compute_sparse_affinity(points, neighbors, epsilon, sigma, metric)
+    L = compute_sparse_L(affinity)
+    X = eigsh(L, k=k, which="LA")[1]
+    Y = renormalize(X)
+    return cluster_rows_in_k(Y, k)
+
+def compute_sparse_affinity(points, neighbors, epsilon, sigma, metric):
+    m = len(points)
+    if epsilon is None:
+        indices, neighbor_distances = nearest_neighbors(points, neighbors, metric)
+        rows = np.repeat(np.arange(m), indices.shape[1])
+        cols = indices.ravel()
+        dists = neighbor_distances.ravel()
+    else:
+        rows, cols, dists = radius_neighbors(points, epsilon, metric)
+    if sigma is None:
+        scale = compute_local_scale(rows, dists, m)
+        weights = np.exp(-1.*(dists * dists) / (scale[rows] * scale[cols]))
+    else:
+        weights = np.exp(-1.*(dists * dists) / (2.*(sigma**2.)))
+    affinity = sparse.csr_matrix((weights, (rows, cols)), shape=(m, m))
+    # The neighbour relation is not symmetric; keep an edge if either end has it.
+    return affinity.maximum(affinity.T).tocsr()
+
+def compute_local_scale(rows, dists, m, neighbor=LOCAL_SCALE_NEIGHBOR):
+    order = np.lexsort((dists, rows))
+    rows = rows[order]
+    dists = dists[order]
+    counts = np.bincount(rows, minlength=m)
+    starts = np.searchsorted(rows, np.arange(m))
+    scale = np.ones(m)
+    has_neighbors = counts > 0
+    picks = starts + np.minimum(counts, neighbor) - 1
+    scale[has_neighbors] = dists[picks[has_neighbors]]
+    # Duplicate points have a zero scale; fall back to the smallest nonzero one.
+    nonzero = scale[scale > 0.]
+    scale[scale <= 0.] = nonzero.min() if len(nonzero) > 0 else 1.
+    return scale
+
+def compute_sparse_L(affinity):
+    s = np.asarray(affinity.sum(axis=1)).ravel() + 1e-10
+    Dinvsqrt = sparse.diags(np.sqrt(1./s), 0)
+    return Dinvsqrt.dot(affinity).dot(Dinvsqrt).tocsr()
+
 def compute_special_L(distances, sigma):
     affinity = compute_affinity(distances, sigma)
-    s = affinity.sum(axis=1) + 1e-10
+    s = degrees(affinity) + 1e-10
     
     # While seemingly sensible, the exponentiation of a large negative number
     # and underflow results in a singular matrix. So instead we rely on the 
@@ -30,32 +89,49 @@ def compute_special_L(distances, sigma):
     # Also note that D = np.diagflat(s) but we don't need this, we compute 
     # D^(-1/2) directly below.
     
-    Dinvsqrt = np.diagflat(np.sqrt(1./s))
-    
-    # If you don't cast those to matrices first, and the matrices are stored
-    # as ndarrays, it will multiply pairwise.
-    return np.mat(Dinvsqrt) * np.mat(affinity) * np.mat(Dinvsqrt)
+    dinvsqrt = np.sqrt(1./s)
+
+    # Multiplying by a diagonal matrix on both sides is just scaling the rows
+    # and columns, so there is no need to form D^(-1/2) or multiply matrices.
+    if is_condensed(affinity):
+        m = affinity.m
+        return LinearOperator((m, m), dtype=np.float64,
+            matvec=lambda x: dinvsqrt * affinity.dot(dinvsqrt * np.ravel(x)))
+    affinity *= dinvsqrt[:, np.newaxis]
+    affinity *= dinvsqrt[np.newaxis, :]
+    return affinity
 
 def compute_affinity(distances, sigma):
-    affinity = np.exp(-1.*(np.multiply(distances, distances)) / (2.*(sigma**2.)))
-    np.fill_diagonal(affinity, 0.)
-    return affinity 
+    scale = -1. / (2.*(sigma**2.))
+    if is_condensed(distances):
+        affinity = distances.empty_like(suffix=".affinity")
+        for start in range(0, len(affinity.data), BLOCK_ELEMENTS):
+            chunk = distances.data[start:start + BLOCK_ELEMENTS].astype(np.float64)
+            affinity.data[start:start + BLOCK_ELEMENTS] = np.exp(scale * chunk * chunk)
+        return affinity # The diagonal is implicitly 0.
+    # Fill the affinity a block of rows at a time, so that a memory-mapped
+    # distance matrix gets a memory-mapped affinity and is never loaded whole.
+    affinity = empty_like(distances, suffix=".affinity")
+    for (start, stop) in block_bounds(len(distances)):
+        block = np.asarray(distances[start:stop], dtype=np.float64)
+        block = np.exp(scale * block * block)
+        block[:, start:stop][np.diag_indices(stop - start)] = 0.
+        affinity[start:stop] = block
+    return affinity
+
+def degrees(affinity):
+    if is_condensed(affinity):
+        return affinity.dot(np.ones(affinity.m))
+    return affinity.sum(axis=1)
 
 def compute_special_eigenmatrix(L, k):
-    return eigsh(scipy.real(L), k=k)[1] # Freakin' magic ...
+    return eigsh(L, k=k)[1] # Freakin' magic ...
 
 def renormalize(X):
-    Xnorm = (np.sqrt(X**2)).sum(axis=1)
-    for row in range(X.shape[0]): # TODO(salspaugh): Change this implementation -- looping is inefficient.
-        X[row,:] = X[row,:] / Xnorm[row]
-    return X
+    # Scale each row to unit length; rows that are all zero are left alone.
+    Xnorm = np.sqrt((X**2).sum(axis=1))
+    Xnorm[Xnorm == 0.] = 1.
+    return X / Xnorm[:, np.newaxis]
 
 def cluster_rows_in_k(kdata, k):
-    distances = compute_distances_in_k(kdata)
-    return kmedoids.cluster(distances, k=k)
-
-def l2norm(a, b):
-    return np.linalg.norm(a - b)
-
-def compute_distances_in_k(data):
-    return clustering.build_distance_matrix(data, l2norm)
+    return kmeans.cluster(kdata, k=k)
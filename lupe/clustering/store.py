@@ -0,0 +1,221 @@
+"""Stores feature vectors in binary files that load in no time however many there are.
+
+A feature store is a directory holding:
+
+    vectors.npy       the feature vectors, one per row, as float64
+    ids.npy           the id of the object of each row
+    mouseovers.json   the mouseover labels of the objects
+    meta.json         the names of the features, the feature modules used and
+                      the version of their code, and what data they were
+                      computed from
+
+The vectors are loaded with a memory map, so only the parts of them that are
+used are ever read from disk. The code version and the source fingerprint
+tell when a store is out of date: run.py warns when it loads a store that
+was computed by different feature code or from different data than it was
+asked to use.
+
+A StoreWriter builds a store a chunk of vectors at a time, for featurizing
+more objects than fit in memory.
+
+CSV files of the features can still be written, for other tools to read.
+"""
+from hashlib import sha1
+from json import dump, dumps, load, loads
+from logging import getLogger as get_logger
+from numpy.lib.format import open_memmap
+from os import makedirs, path, remove
+from shutil import copyfile
+from time import time
+import numpy
+
+logger = get_logger("lupe")
+
+STORE_SUFFIX = "features"
+VECTORS = "vectors.npy"
+IDS = "ids.npy"
+MOUSEOVERS = "mouseovers.json"
+META = "meta.json"
+PARTIAL_SUFFIX = "partial"
+COPY_ROWS = 10000 # rows copied at a time when a StoreWriter is closed
+
+# Modules in the features directory that the feature modules share.
+SHARED_FEATURE_MODULES = ["views", "visitor"]
+
+# The arguments that say which data a source holds; passwords are left out.
+SOURCE_ARGUMENTS = ["source", "path", "version", "user", "database"]
+
+
+class FeatureMatrix(object):
+    """The feature vectors of objects: an array of their ids, a float64 array
+    with the feature vector of each object in the same row and the name of
+    each column, or None if the names are not known."""
+
+    def __init__(self, ids, vectors, names=None):
+        self.ids = ids
+        self.vectors = vectors
+        self.names = names
+
+    def __len__(self):
+        return len(self.ids)
+
+    def rows(self):
+        """Yields the id of each object followed by its feature vector, as
+        output_features writes them."""
+        for (fid, vector) in zip(self.ids.tolist(), self.vectors):
+            yield [fid] + vector.tolist()
+
+
+def is_store(filename):
+    return path.isdir(filename) and path.exists(path.join(filename, META))
+
+
+def store_name(filename):
+    """Returns filename with the .features extension, unless it has it."""
+    if filename.endswith("." + STORE_SUFFIX):
+        return filename
+    return ".".join([filename, STORE_SUFFIX])
+
+
+def code_version(featurecode):
+    """Returns a digest of the code of the feature modules named in
+    featurecode and of the modules they share."""
+    features_dir = path.join(path.dirname(path.realpath(__file__)), "features")
+    digest = sha1()
+    for module in sorted(featurecode) + SHARED_FEATURE_MODULES:
+        filename = path.join(features_dir, module + ".py")
+        if path.exists(filename):
+            with open(filename, 'rb') as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
+
+def source_settings(args, clusterees):
+    """Returns the command-line arguments that say which data the objects
+    were fetched from, and the type of the objects."""
+    settings = dict((argument, getattr(args, argument, None)) for argument in SOURCE_ARGUMENTS)
+    settings["clusterees"] = clusterees
+    return settings
+
+
+def fingerprint(settings):
+    return sha1(dumps(settings, sort_keys=True)).hexdigest()
+
+
+def output_store(features, mouseovers, filename, featurecode=None, settings=None):
+    """Writes features, a FeatureMatrix, and the mouseovers of its objects to
+    the feature store filename, creating it if need be."""
+    logger.debug("[pipeline] - Writing feature store.")
+    start = time()
+    if not path.isdir(filename):
+        makedirs(filename)
+    numpy.save(path.join(filename, VECTORS), numpy.ascontiguousarray(features.vectors, dtype=numpy.float64))
+    numpy.save(path.join(filename, IDS), numpy.asarray(features.ids))
+    with open(path.join(filename, MOUSEOVERS), 'w') as f:
+        dump(mouseovers, f)
+    output_meta(filename, len(features), features.names, featurecode, settings)
+    elapsed = time() - start
+    logger.debug("[pipeline] - Time to write feature store (seconds): " + str(elapsed))
+
+
+def output_meta(filename, count, names, featurecode=None, settings=None):
+    meta = {
+        "count": count,
+        "names": names,
+        "featurecode": featurecode,
+        "code_version": code_version(featurecode) if featurecode is not None else None,
+        "source": settings,
+        "fingerprint": fingerprint(settings) if settings is not None else None,
+    }
+    with open(path.join(filename, META), 'w') as f:
+        dump(meta, f, sort_keys=True, indent=4, separators=(',', ': '))
+
+
+class StoreWriter(object):
+    """Writes the feature store filename a chunk of feature vectors at a
+    time. The vectors and ids are appended to partial files in the store as
+    they come, so memory use depends on the chunk size and not on the number
+    of objects. close() copies them into vectors.npy and ids.npy a block of
+    rows at a time and writes the rest of the store."""
+
+    def __init__(self, filename, names, featurecode=None, settings=None):
+        if not path.isdir(filename):
+            makedirs(filename)
+        self.filename = filename
+        self.names = names
+        self.featurecode = featurecode
+        self.settings = settings
+        self.vectors = open(self.partial(VECTORS), 'w+b')
+        self.ids = open(self.partial(IDS), 'w+')
+        self.id_dtype = None
+        self.count = 0
+
+    def partial(self, name):
+        return path.join(self.filename, ".".join([name, PARTIAL_SUFFIX]))
+
+    def append(self, ids, vectors):
+        numpy.ascontiguousarray(vectors, dtype=numpy.float64).tofile(self.vectors)
+        for fid in ids:
+            self.ids.write(dumps(fid) + "\n")
+        dtype = numpy.asarray(ids).dtype
+        self.id_dtype = dtype if self.id_dtype is None else numpy.promote_types(self.id_dtype, dtype)
+        self.count += len(ids)
+
+    def close(self, mouseovers_filename):
+        """Finishes the store, taking its mouseovers from the JSON file
+        mouseovers_filename, and removes the partial files."""
+        logger.debug("[pipeline] - Writing feature store.")
+        start = time()
+        self.vectors.flush()
+        self.ids.flush()
+        self.vectors.seek(0)
+        self.ids.seek(0)
+        width = len(self.names)
+        vectors = open_memmap(path.join(self.filename, VECTORS), mode='w+',
+            dtype=numpy.float64, shape=(self.count, width))
+        ids = open_memmap(path.join(self.filename, IDS), mode='w+',
+            dtype=self.id_dtype, shape=(self.count,))
+        for begin in range(0, self.count, COPY_ROWS):
+            n = min(COPY_ROWS, self.count - begin)
+            chunk = numpy.fromfile(self.vectors, dtype=numpy.float64, count=n * width)
+            vectors[begin:begin + n] = chunk.reshape((n, width))
+            ids[begin:begin + n] = [loads(self.ids.readline()) for _ in range(n)]
+        vectors.flush()
+        ids.flush()
+        del vectors, ids
+        copyfile(mouseovers_filename, path.join(self.filename, MOUSEOVERS))
+        output_meta(self.filename, self.count, self.names, self.featurecode, self.settings)
+        self.discard()
+        elapsed = time() - start
+        logger.debug("[pipeline] - Time to write feature store (seconds): " + str(elapsed))
+
+    def discard(self):
+        """Removes the partial files, leaving the store unfinished if close()
+        was not called."""
+        for f in [self.vectors, self.ids]:
+            f.close()
+            if path.exists(f.name):
+                remove(f.name)
+
+
+def fetch_store(filename, featurecode=None, settings=None):
+    """Loads a feature store, memory mapping its vectors, and returns a
+    FeatureMatrix, the mouseovers and the metadata. If featurecode or
+    settings are given, warns if the store was computed with other feature
+    code or from other data."""
+    logger.debug("[pipeline] - Fetching feature store.")
+    start = time()
+    with open(path.join(filename, META)) as f:
+        meta = load(f)
+    vectors = numpy.load(path.join(filename, VECTORS), mmap_mode='r')
+    ids = numpy.load(path.join(filename, IDS))
+    with open(path.join(filename, MOUSEOVERS)) as f:
+        mouseovers = load(f)
+    if featurecode is not None and meta["code_version"] != code_version(featurecode):
+        logger.warning("[pipeline] - Features in " + filename + " were computed by different feature code.")
+    if settings is not None and meta["fingerprint"] != fingerprint(settings):
+        logger.warning("[pipeline] - Features in " + filename + " were computed from different data.")
+    elapsed = time() - start
+    logger.debug("[pipeline] - Time to fetch feature store (seconds): " + str(elapsed))
+    logger.debug("[pipeline] - Number of vectors fetched: " + str(vectors.shape[0]))
+    return FeatureMatrix(ids, vectors, meta["names"]), mouseovers, meta
@@ -0,0 +1,35 @@
+"""Streams the rows of a query without holding the whole result.
+
+This module does not import a database driver, so scripts that only stream
+rows from a queryutils PostgresDB or SQLite3DB source do not need psycopg2
+installed when they read from SQLite.
+"""
+import os
+from itertools import count
+
+ITERSIZE = 10000 # rows fetched from the server at a time
+
+CURSOR_NAMES = count()
+
+def stream_query(database, query, params=(), itersize=None):
+    """Yields the rows of query one at a time from a connected database, which
+    can also be a queryutils PostgresDB or SQLite3DB source.
+
+    On Postgres the rows come from a named server-side cursor, itersize rows
+    per round trip, so the client never holds the whole result. SQLite cursors
+    already step through their results as they are iterated.
+    """
+    if itersize is None:
+        itersize = ITERSIZE
+    if database.is_postgres():
+        name = "lupe_stream_%d_%d" % (os.getpid(), next(CURSOR_NAMES))
+        cursor = database.connection.cursor(name)
+        cursor.itersize = itersize
+        cursor.execute(query, params)
+    else:
+        cursor = database.execute(query, params)
+    try:
+        for row in cursor:
+            yield row
+    finally:
+        cursor.close()
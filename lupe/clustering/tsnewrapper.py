@@ -1,18 +1,23 @@
 #! /usr/bin/env python
 """
-Python wrapper to execute c++ tSNE implementation
+Python wrapper for tSNE
 for more information on tSNE, go to :
 http://ticc.uvt.nl/~lvdrmaaten/Laurens_van_der_Maaten/t-SNE.html
 
 HOW TO USE
 Just call the method calc_tsne(dataMatrix)
 
+calc_tsne runs the Barnes-Hut implementation in bhtsne.py in-process.
+calc_tsne_external still calls the c++ tSNE_maci binary where it exists.
+
 Created by Philippe Hamel
 hamelphi@iro.umontreal.ca
 October 24th 2008
 """
 import sys
 import os
+import shutil
+import subprocess
 import pylab
 import numpy
 import csv
@@ -20,53 +25,68 @@ import argparse
 
 from os import getcwd, path
 from numpy import linalg, cov, argsort, dot, empty, zeros
-from struct import pack, unpack, calcsize
+from struct import pack
+from tempfile import mkdtemp
+
+import bhtsne
 
 
-def calc_tsne(data_matrix, no_dims=2, perplexity=30, landmarks=1):
+def calc_tsne(data_matrix, no_dims=2, perplexity=30, landmarks=1, theta=bhtsne.THETA):
     """
     This is the main function.
     dataMatrix is a 2D numpy array containing your data (each row is a data point)
     Remark : landmarks is a ratio (0<landmarks<=1)
     If landmarks == 1 , it returns the list of points in the same order as the input
+    Otherwise only a random sample of that ratio of the points is embedded,
+    and it returns the embedding and the indices of the sampled points
+    theta trades accuracy for speed; 0 computes the exact gradient
     """
-
-    write_dat(data_matrix, no_dims, perplexity, landmarks)
-    tSNE()
-    xmat, lm, costs = read_result()
-    clear_data()
+    data_matrix = numpy.asarray(data_matrix, dtype=numpy.float64)
     if landmarks == 1:
-        x = re_order(xmat, lm)
-        return x
+        return bhtsne.embed(data_matrix, no_dims, perplexity, theta)
+    n = data_matrix.shape[0]
+    lm = numpy.sort(numpy.random.permutation(n)[:max(1, int(round(landmarks * n)))])
+    xmat = bhtsne.embed(data_matrix[lm], no_dims, perplexity, theta)
     return xmat, lm
 
 
-def readbin(type, file):
+def calc_tsne_external(data_matrix, no_dims=2, perplexity=30, landmarks=1):
     """
-    used to read binary data from a file
+    Same as calc_tsne, but calls the c++ tSNE binary
+    Each call works in its own temporary directory, so concurrent runs are safe
     """
-    return unpack(type, file.read(calcsize(type)))
+    workdir = mkdtemp(prefix='tsne')
+    try:
+        write_dat(data_matrix, no_dims, perplexity, landmarks, workdir)
+        tSNE(workdir)
+        xmat, lm, costs = read_result(workdir)
+    finally:
+        clear_data(workdir)
+    if landmarks == 1:
+        x = re_order(xmat, lm)
+        return x
+    return xmat, lm
 
 
-def write_dat(data_matrix, no_dims, perplexity, landmarks):
+def write_dat(data_matrix, no_dims, perplexity, landmarks, workdir):
     """
-    Generates data.dat
+    Generates data.dat in workdir
     """
     print 'Writing data.dat'
     print 'Dimension of projection : %i \nPerplexity : %i \nLandmarks(ratio) : %f' % (no_dims, perplexity, landmarks)
+    data_matrix = numpy.asarray(data_matrix)
     n, d = data_matrix.shape
-    f = open('data.dat', 'wb')
-    f.write(pack('=iiid', n, d, no_dims, perplexity))
-    f.write(pack('=d', landmarks))
-    for inst in data_matrix:
-        for el in inst:
-            f.write(pack('=d', el))
-    f.close()
+    with open(path.join(workdir, 'data.dat'), 'wb') as f:
+        f.write(pack('=iiid', n, d, no_dims, perplexity))
+        f.write(pack('=d', landmarks))
+        numpy.ascontiguousarray(data_matrix, dtype='<f8').tofile(f)
 
 
-def tSNE():
+def tSNE(workdir):
     """
     Calls the tsne c++ implementation depending on the platform
+    The binary reads and writes its files in the current directory, so it
+    is run from workdir
     """
     platform = sys.platform
     print'Platform detected : %s' % platform
@@ -75,24 +95,22 @@ def tSNE():
     else:
         raise RuntimeError('You are not in right platform.')
     print 'Calling executable "%s"' % cmd
-    cmd = path.join(path.dirname(__file__), cmd)
-    os.system(cmd)
+    cmd = path.join(path.dirname(path.abspath(__file__)), cmd)
+    returncode = subprocess.call([cmd], cwd=workdir)
+    if returncode != 0:
+        raise RuntimeError('%s failed with exit status %i.' % (cmd, returncode))
 
 
-def read_result():
+def read_result(workdir):
     """
-    Reads result from result.dat
+    Reads result from result.dat in workdir
     """
     print 'Reading result.dat'
-    f = open('result.dat', 'rb')
-    n, nd = readbin('ii', f)
-    xmat = empty((n, nd))
-    for i in range(n):
-        for j in range(nd):
-            xmat[i, j] = readbin('d', f)[0]
-    lm = readbin('%ii' % n, f)
-    costs = readbin('%id' % n, f)
-    f.close()
+    with open(path.join(workdir, 'result.dat'), 'rb') as f:
+        n, nd = numpy.fromfile(f, dtype='<i4', count=2)
+        xmat = numpy.fromfile(f, dtype='<f8', count=n * nd).reshape((n, nd))
+        lm = numpy.fromfile(f, dtype='<i4', count=n)
+        costs = numpy.fromfile(f, dtype='<f8', count=n)
     return (xmat, lm, costs)
 
 
@@ -103,18 +121,16 @@ def re_order(xmat, lm):
     """
     print 'Reordering results'
     x = zeros(xmat.shape)
-    for i, lm in enumerate(lm):
-        x[lm] = xmat[i]
+    x[lm] = xmat
     return x
 
 
-def clear_data():
+def clear_data(workdir):
     """
-    Clears files data.dat and result.dat
+    Removes workdir with data.dat and result.dat
     """
     print 'Clearing data.dat and result.dat'
-    os.system('rm data.dat')
-    os.system('rm result.dat')
+    shutil.rmtree(workdir, ignore_errors=True)
 
 if __name__ == "__main__":
     ap = argparse.ArgumentParser()
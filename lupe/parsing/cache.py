@@ -0,0 +1,322 @@
+"""Persistent cache of what the analyses derive from the text of a query.
+
+Every script looks up the categories, commands, stages or parse tree of the
+same queries. This module keeps them in a SQLite file keyed by the SHA-1 of
+the query text, with an in-memory LRU in front, so each distinct text is
+parsed once across all runs. The drop-in functions parse_query,
+split_query_into_stages, lookup_categories and lookup_commands take the
+place of the queryutils functions of the same names.
+
+Each field of an entry is computed the first time it is asked for. The cache
+is cleared whenever the parser version changes.
+
+Callers set attributes such as position and depth on parse trees, so every
+parse tree handed out is a copy of the cached one.
+
+Running this file pre-parses the queries of a source in parallel:
+
+    python lupe/parsing/cache.py -s postgresdb -U lupe -P lupe -D lupe -q scheduled -j 8
+"""
+import atexit
+import hashlib
+import os
+import sqlite3
+
+from collections import OrderedDict
+
+import queryutils.parse
+import queryutils.splunktypes
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+CACHE_SETTINGS = {
+    # Name of the SQLite file. If empty, entries are only kept in memory.
+    'filename': os.environ.get('LUPE_PARSE_CACHE',
+        os.path.join(os.path.expanduser('~'), '.lupe', 'parsecache.sqlite')),
+    'lru_size': 100000, # entries kept in memory
+    'version': None, # if None, derived from the installed parser packages
+}
+
+FORMAT_VERSION = 2
+FLUSH_SIZE = 1000 # new entries written per transaction
+WARM_CHUNK_SIZE = 64 # queries sent to a warm-up worker at a time
+
+PARSETREE = "parsetree"
+STAGES = "stages"
+CATEGORIES = "categories"
+COMMANDS = "commands"
+FIELDS = [PARSETREE, STAGES, CATEGORIES, COMMANDS]
+
+CACHE = None
+
+
+def parse_query(text):
+    return get_cache().get(text, PARSETREE)
+
+
+def split_query_into_stages(text):
+    return get_cache().get(text, STAGES)
+
+
+def lookup_categories(text):
+    return get_cache().get(text, CATEGORIES)
+
+
+def lookup_commands(text):
+    return get_cache().get(text, COMMANDS)
+
+
+def compute(text, field):
+    if field == PARSETREE:
+        return queryutils.parse.parse_query(text)
+    elif field == STAGES:
+        return queryutils.parse.split_query_into_stages(text)
+    elif field == CATEGORIES:
+        return queryutils.splunktypes.lookup_categories(text)
+    elif field == COMMANDS:
+        return queryutils.splunktypes.lookup_commands(text)
+    raise ValueError("Unknown parse cache field: " + str(field))
+
+
+def make_key(text):
+    if isinstance(text, unicode):
+        text = text.encode("utf-8")
+    return hashlib.sha1(text).hexdigest()
+
+
+def parser_version():
+    import pkg_resources
+    versions = ["format-%d" % FORMAT_VERSION]
+    for package in ["splparser", "queryutils"]:
+        try:
+            version = pkg_resources.get_distribution(package).version
+        except pkg_resources.DistributionNotFound:
+            version = "unknown"
+        versions.append("%s-%s" % (package, version))
+    return ",".join(versions)
+
+
+def get_cache():
+    global CACHE
+    if CACHE is None:
+        CACHE = ParseCache(CACHE_SETTINGS['filename'], CACHE_SETTINGS['lru_size'],
+            CACHE_SETTINGS['version'])
+    return CACHE
+
+
+def configure(filename=None, lru_size=None, version=None):
+    global CACHE
+    if filename is not None:
+        CACHE_SETTINGS['filename'] = filename
+    if lru_size is not None:
+        CACHE_SETTINGS['lru_size'] = lru_size
+    if version is not None:
+        CACHE_SETTINGS['version'] = version
+    if CACHE is not None:
+        CACHE.close()
+        CACHE = None
+
+
+@atexit.register
+def close_cache():
+    if CACHE is not None:
+        CACHE.close()
+
+
+def copy_value(text, field, value):
+    """Returns a copy of value if it is a parse tree, and value otherwise."""
+    if field != PARSETREE or value is None:
+        return value
+    try:
+        return pickle.loads(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+    except (pickle.PicklingError, TypeError, RuntimeError):
+        return compute(text, field) # Too deep to pickle; parse it again.
+
+
+class ParseCache(object):
+    """Entries are dicts from field name to value. get() hands out copies of
+    parse trees; the other values are shared between callers, so they must
+    not be modified."""
+
+    def __init__(self, filename=None, lru_size=100000, version=None):
+        self.filename = filename
+        self.lru_size = lru_size
+        self.version = version if version is not None else parser_version()
+        self.recent = OrderedDict()
+        self.pending = {}
+        self.connection = None
+        if filename:
+            self.open()
+
+    def open(self):
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.connection = sqlite3.connect(self.filename, timeout=60)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS meta "
+            "(name TEXT PRIMARY KEY, value TEXT)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS entries "
+            "(key TEXT PRIMARY KEY, parsetree BLOB, stages BLOB, categories BLOB, commands BLOB)")
+        row = self.connection.execute("SELECT value FROM meta WHERE name='version'").fetchone()
+        if row is None or row[0] != self.version:
+            self.connection.execute("DELETE FROM entries")
+            self.connection.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)",
+                (self.version,))
+        self.connection.commit()
+
+    def close(self):
+        if self.connection is not None:
+            self.flush()
+            self.connection.close()
+            self.connection = None
+
+    def get(self, text, field):
+        key = make_key(text)
+        entry = self.lookup(key)
+        if field not in entry:
+            entry[field] = compute(text, field)
+            self.store(key, entry)
+        return copy_value(text, field, entry[field])
+
+    def missing(self, text, fields):
+        entry = self.lookup(make_key(text))
+        return [field for field in fields if field not in entry]
+
+    def update(self, text, values):
+        key = make_key(text)
+        entry = self.lookup(key)
+        entry.update(values)
+        self.store(key, entry)
+
+    def lookup(self, key):
+        entry = self.recent.pop(key, None)
+        if entry is None:
+            entry = self.pending.get(key)
+        if entry is None:
+            entry = self.load(key)
+        self.recent[key] = entry
+        if len(self.recent) > self.lru_size:
+            self.recent.popitem(last=False)
+        return entry
+
+    def load(self, key):
+        if self.connection is None:
+            return {}
+        row = self.connection.execute("SELECT parsetree, stages, categories, commands "
+            "FROM entries WHERE key=?", (key,)).fetchone()
+        if row is None:
+            return {}
+        return dict((field, pickle.loads(str(value)))
+            for (field, value) in zip(FIELDS, row) if value is not None)
+
+    def store(self, key, entry):
+        if self.connection is None:
+            return
+        self.pending[key] = entry
+        if len(self.pending) >= FLUSH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.connection is None or not self.pending:
+            return
+        rows = []
+        for (key, entry) in self.pending.iteritems():
+            rows.append([key] + [serialize(entry, field) for field in FIELDS])
+        self.connection.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)", rows)
+        self.connection.commit()
+        self.pending = {}
+
+
+def serialize(entry, field):
+    if field not in entry:
+        return None
+    try:
+        return sqlite3.Binary(pickle.dumps(entry[field], pickle.HIGHEST_PROTOCOL))
+    except (pickle.PicklingError, TypeError, RuntimeError):
+        return None # Very deep parse trees; these are parsed again next time.
+
+
+def compute_fields(args):
+    (text, fields, stage_fields) = args
+    values = dict((field, compute(text, field)) for field in fields)
+    stage_values = []
+    if stage_fields:
+        stages = values.get(STAGES)
+        if stages is None:
+            stages = compute(text, STAGES)
+        for stage in stages:
+            stage_values.append((stage, dict((field, compute(stage, field)) for field in stage_fields)))
+    return text, values, stage_values
+
+
+def warm(texts, fields=(STAGES, CATEGORIES, COMMANDS), stage_fields=(), workers=0):
+    """Parses every text whose entry is missing one of fields in a pool of
+    workers, and stores the results. If stage_fields are given, those fields
+    are also stored for each stage of every text. The texts are read and
+    sent to the pool a chunk at a time, so memory stays flat however many
+    there are. Returns the number of texts read and the number parsed."""
+    # parallel imports this module, so it is imported here.
+    from lupe.parsing.parallel import chunked, map_chunks
+    cache = get_cache()
+    ntexts = [0]
+
+    def missing_chunks():
+        for chunk in chunked(texts, WARM_CHUNK_SIZE):
+            ntexts[0] += len(chunk)
+            queued = set()
+            tasks = []
+            for text in chunk:
+                key = make_key(text)
+                if key in queued:
+                    continue
+                queued.add(key)
+                missing = cache.missing(text, fields)
+                stages_missing = bool(stage_fields) and (bool(cache.missing(text, [STAGES])) or
+                    any(cache.missing(stage, stage_fields) for stage in cache.get(text, STAGES)))
+                if missing or stages_missing:
+                    tasks.append((text, missing, stage_fields if stages_missing else ()))
+            yield None, tasks
+
+    nparsed = 0
+    for (_, results) in map_chunks(compute_fields, missing_chunks(), workers):
+        for (text, values, stage_values) in results:
+            cache.update(text, values)
+            for (stage, values) in stage_values:
+                cache.update(stage, values)
+            nparsed += 1
+    cache.flush()
+    return ntexts[0], nparsed
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    from queryutils.arguments import get_arguments, initialize_source
+    parser = ArgumentParser(
+        description="Pre-parses the queries of a source into the parse cache.")
+    parser.add_argument("-j", "--jobs", type=int, default=0,
+                        help="number of parsing processes; 0 means one per CPU (default: 0)")
+    parser.add_argument("--cachefile",
+                        help="the parse cache file (default: ~/.lupe/parsecache.sqlite)")
+    parser.add_argument("--stages", action="store_true",
+                        help="also cache the categories and parse tree of every stage")
+    parser.add_argument("--parsetrees", action="store_true",
+                        help="also cache the parse tree of every query")
+    args = get_arguments(parser)
+    if all([arg is None for arg in vars(args).values()]):
+        parser.print_help()
+        exit()
+    if args.source is None:
+        raise RuntimeError(
+            "You must specify where to fetch the data and the corresponding arguments (-s or --source).")
+    if args.querytype is None:
+        raise RuntimeError("You must specify a query type.")
+
+    configure(filename=args.cachefile)
+    fields = [STAGES, CATEGORIES, COMMANDS] + ([PARSETREE] if args.parsetrees else [])
+    stage_fields = [CATEGORIES, PARSETREE] if args.stages else []
+    source = initialize_source(args.source, args)
+    nqueries, nparsed = warm(source.fetch_queries(args.querytype), fields, stage_fields, args.jobs)
+    print "Queries: %d, parsed: %d" % (nqueries, nparsed)
@@ -0,0 +1,49 @@
+"""Collapses a stream of query texts into distinct texts and their counts.
+
+Scheduled queries repeat the same text many times. Tallies that parse
+count_texts(queries) instead of queries, and weight what they count by each
+text's count, give the same results with one parse per distinct text.
+
+The queries are counted chunk_size at a time, and the texts of a chunk are
+yielded before the next chunk is read, so memory stays bounded however many
+queries the source returns. A text that is in several chunks comes out once
+for each, with its count in that chunk. The counts add up to the same totals,
+and the parse cache keeps the later parses of the text cheap.
+
+Within a chunk, texts come out in the order they first appear.
+"""
+from collections import OrderedDict
+from itertools import islice
+
+CHUNK_SIZE = 100000 # queries counted at a time
+
+
+def count_texts(queries, chunk_size=CHUNK_SIZE):
+    """Yields (text, count) for each distinct text in each chunk of queries."""
+    queries = iter(queries)
+    while True:
+        counts = OrderedDict()
+        for text in islice(queries, chunk_size):
+            counts[text] = counts.get(text, 0) + 1
+        if not counts:
+            return
+        for item in counts.iteritems():
+            yield item
+
+
+def count_texts_by_user(queries, chunk_size=CHUNK_SIZE):
+    """Yields (text, user_counts) for each distinct text in each chunk of
+    queries, which are (user, text) pairs. user_counts maps each user that
+    ran the text to how many times they ran it."""
+    queries = iter(queries)
+    while True:
+        counts = OrderedDict()
+        for (user, text) in islice(queries, chunk_size):
+            user_counts = counts.get(text)
+            if user_counts is None:
+                user_counts = counts[text] = {}
+            user_counts[user] = user_counts.get(user, 0) + 1
+        if not counts:
+            return
+        for item in counts.iteritems():
+            yield item
@@ -0,0 +1,125 @@
+"""Parses query texts in a pool of processes, yielding results in input order.
+
+map_ordered is a parallel map over any iterable. It sends the items to the
+pool in chunks and never has more than window chunks in flight, so memory
+stays flat however many queries the source returns.
+
+parse_queries and parse_stages put the parse cache in front of it. The parent
+process looks every text up in the cache, only the misses are sent to the
+workers, and what the workers compute is stored back in the cache.
+"""
+from collections import deque
+from itertools import islice
+from multiprocessing import Pool, cpu_count
+
+from lupe.parsing.cache import STAGES, compute_fields, get_cache
+
+CHUNK_SIZE = 256 # items sent to a worker at a time
+WINDOW_PER_WORKER = 2 # chunks in flight per worker
+
+
+def map_ordered(function, items, workers=1, chunk_size=CHUNK_SIZE, window=None):
+    """Yields function(item) for each item, in order. function must be
+    defined at the top level of a module so that it can be pickled."""
+    chunks = ((None, chunk) for chunk in chunked(items, chunk_size))
+    for (_, results) in map_chunks(function, chunks, workers, window):
+        for result in results:
+            yield result
+
+
+def map_chunks(function, chunks, workers=1, window=None):
+    """For each (context, tasks) in chunks, yields (context, results) in
+    order, where results holds function(task) for each of the tasks. The
+    context stays in this process, and chunks without tasks skip the pool."""
+    if workers == 0:
+        workers = cpu_count()
+    if workers == 1:
+        for (context, tasks) in chunks:
+            yield context, [function(task) for task in tasks]
+        return
+    if window is None:
+        window = WINDOW_PER_WORKER * workers
+    pool = Pool(processes=workers)
+    try:
+        in_flight = deque()
+        for (context, tasks) in chunks:
+            if tasks:
+                in_flight.append((context, pool.apply_async(apply_to_chunk, (function, tasks))))
+            else:
+                in_flight.append((context, None))
+            while len(in_flight) >= window or (in_flight and in_flight[0][1] is None):
+                yield finish(in_flight.popleft())
+        while in_flight:
+            yield finish(in_flight.popleft())
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def finish(chunk):
+    (context, results) = chunk
+    return context, (results.get() if results is not None else [])
+
+
+def apply_to_chunk(function, tasks):
+    return [function(task) for task in tasks]
+
+
+def chunked(items, chunk_size):
+    items = iter(items)
+    while True:
+        chunk = list(islice(items, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def parse_queries(items, fields, workers=1, text=None, chunk_size=CHUNK_SIZE):
+    """Yields (item, value, ...) for each item, with the value of each of
+    fields (see lupe.parsing.cache) for the item's query text. If text is
+    given, it is called on each item to get the text; otherwise the items are
+    the texts."""
+    for (item, query, _) in parse(items, fields, (), workers, text, chunk_size):
+        yield (item,) + tuple(query[field] for field in fields)
+
+
+def parse_stages(items, fields, workers=1, text=None, chunk_size=CHUNK_SIZE):
+    """Yields (item, stages) for each item, where stages lists (stage, value,
+    ...) for each stage of the item's query text, with the value of each of
+    fields for the stage."""
+    for (item, _, stages) in parse(items, (), fields, workers, text, chunk_size):
+        yield item, [(stage,) + tuple(values[field] for field in fields)
+            for (stage, values) in stages]
+
+
+def parse(items, fields, stage_fields, workers, text, chunk_size):
+    cache = get_cache()
+    query_fields = list(fields) + ([STAGES] if stage_fields and STAGES not in fields else [])
+
+    def lookup_chunks():
+        for chunk in chunked(items, chunk_size):
+            texts = [text(item) if text is not None else item for item in chunk]
+            tasks = []
+            for query in texts:
+                missing = cache.missing(query, query_fields)
+                stages_missing = bool(stage_fields) and (STAGES in missing or
+                    any(cache.missing(stage, stage_fields)
+                        for stage in cache.get(query, STAGES)))
+                if missing or stages_missing:
+                    tasks.append((query, missing, stage_fields if stages_missing else ()))
+            yield (chunk, texts), tasks
+
+    for ((chunk, texts), results) in map_chunks(compute_fields, lookup_chunks(), workers):
+        for (query, values, stage_values) in results:
+            cache.update(query, values)
+            for (stage, values) in stage_values:
+                cache.update(stage, values)
+        for (item, query) in zip(chunk, texts):
+            values = dict((field, cache.get(query, field)) for field in query_fields)
+            stages = []
+            if stage_fields:
+                for stage in values[STAGES]:
+                    stages.append((stage, dict((field, cache.get(stage, field))
+                        for field in stage_fields)))
+            yield item, values, stages
@@ -1,25 +1,57 @@
+import re
+import lupe.analysis.accumulate
+import lupe.analysis.stream
 import lupe.statemachines.draw
 import lupe.statemachines.tokens
+import lupe.parsing.cache
 import queryutils.arguments
-import queryutils.splunktypes
 
-def markov_diagram(input, output, querytype, sourcetype=None, threshold=.2):
-    graph = compute_transition_graph(input, querytype, sourcetype)  
+def markov_diagram(input, output, querytype, sourcetype=None, threshold=.2, workers=1):
+    graph = compute_transition_graph(input, querytype, sourcetype, workers)
     normalize_transition_graph(graph)
     lupe.statemachines.draw.make_diagram(graph, threshold, output)
 
-def compute_transition_graph(input, querytype, sourcetype=None):
-    graph = {}
-    patterns = None
-    count = 0
-    if sourcetype is not None:
-        patterns = compile_match_patterns(sourcetype)
-    for query in input.get_queries(querytype):
-        count += 1
-        if patterns is not None and not matches(query, patterns): continue
-        pipeline = lookup_transformation_pipeline(query)
-        update_transition_graph(graph, pipeline)
-    return graph
+def compute_transition_graph(input, querytype, sourcetype=None, workers=1):
+    tally = TransitionGraph(sourcetype)
+    queries = input.get_queries(querytype)
+    if tally.patterns is not None:
+        queries = (query for query in queries if matches(query, tally.patterns))
+    for query in lupe.analysis.stream.parsed_queries(queries, tally.fields, workers):
+        tally.update(query)
+    return tally.graph
+
+class TransitionGraph(object):
+    """Counts the transitions between the transformations of queries, only
+    counting queries on sourcetype if it is given."""
+
+    fields = [lupe.parsing.cache.CATEGORIES]
+
+    def __init__(self, sourcetype=None, threshold=.2):
+        self.sourcetype = sourcetype
+        self.threshold = threshold
+        self.patterns = None
+        if sourcetype is not None:
+            self.patterns = compile_match_patterns(sourcetype)
+        self.graph = {}
+
+    def update(self, query):
+        if self.patterns is not None and not matches(query.text, self.patterns):
+            return
+        pipeline = make_transformation_pipeline(query.categories)
+        update_transition_graph(self.graph, pipeline, query.count)
+
+    def merge(self, other):
+        lupe.analysis.accumulate.check_mergeable(self, other, "sourcetype")
+        lupe.analysis.accumulate.merge_counts(self.graph, other.graph)
+
+    def finalize(self):
+        """Returns the graph with the weights out of each node normalized to sum to one."""
+        graph = dict((src, dict(dsts)) for (src, dsts) in self.graph.iteritems())
+        normalize_transition_graph(graph)
+        return graph
+
+    def write(self, output):
+        lupe.statemachines.draw.make_diagram(self.finalize(), self.threshold, output)
 
 def compile_match_patterns(arg):
     sourcetype_match = re.compile(".*\s*(sourcetype)\s*(=)\s*['\"]?("+arg+").*['\"]?")
@@ -30,12 +62,15 @@ def matches(query, patterns):
     return all([p.match(query) is not None for p in patterns])
 
 def lookup_transformation_pipeline(query):
-    transformations = queryutils.splunktypes.lookup_categories(query)
+    transformations = lupe.parsing.cache.lookup_categories(query)
+    return make_transformation_pipeline(transformations)
+
+def make_transformation_pipeline(transformations):
     return ([lupe.statemachines.tokens.START_TOKEN] + 
         transformations + 
         [lupe.statemachines.tokens.END_TOKEN])
 
-def update_transition_graph(graph, pipeline):
+def update_transition_graph(graph, pipeline, weight=1.):
     for idx, stage in enumerate(pipeline[:-1]):
         src = stage
         dst = pipeline[idx+1]
@@ -43,7 +78,7 @@ def update_transition_graph(graph, pipeline):
             graph[src] = {}
         if not dst in graph[src]:
             graph[src][dst] = 0.
-        graph[src][dst] += 1.
+        graph[src][dst] += weight
 
 def normalize_transition_graph(graph):
     for (src, dsts) in graph.iteritems():
@@ -64,6 +99,8 @@ if __name__ == "__main__":
                         help="the threshold that determines which edges are drawn \
                         -- only edges with weights above this are drawn. \
                         Should be in (0.0, 1.0]")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of processes to parse queries with; 0 means one per CPU (default: 1)")
     args = queryutils.arguments.get_arguments(parser, o=True)
 
     if all([arg is None for arg in vars(args).values()]):
@@ -80,4 +117,4 @@ if __name__ == "__main__":
 
     source = queryutils.arguments.initialize_source(args.source, args)
     markov_diagram(source, args.output, args.querytype, 
-        sourcetype=args.sourcetype, threshold=float(args.threshold))
+        sourcetype=args.sourcetype, threshold=float(args.threshold), workers=args.jobs)
@@ -1,3 +1,4 @@
+import sys
 import lupe.statemachines.compute
 import lupe.statemachines.tokens
 import queryutils.arguments
@@ -31,9 +32,18 @@ def generate_possible_paths(graph, prev, paths, path, freq, count):
             freq * graph[prev][curr], 
             count + 1)
 
-def output_paths(paths):
+class TopPaths(lupe.statemachines.compute.TransitionGraph):
+    """A transition graph that is written out as its most likely paths."""
+
+    def write(self, output):
+        with open(output, "w") as out:
+            output_paths(get_paths(self.finalize()), out)
+
+def output_paths(paths, out=None):
+    if out is None:
+        out = sys.stdout
     for (k, v) in sorted(paths.iteritems(), key=lambda x: x[1], reverse=True):
-        print k, v
+        print >> out, k, v
 
 if __name__ == "__main__":
 
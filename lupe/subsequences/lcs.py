@@ -1,28 +1,56 @@
 from collections import defaultdict
 from queryutils.arguments import get_arguments, lookup, SOURCES
 from queryutils.query import QueryType
-from queryutils.splunktypes import lookup_categories
+from lupe.analysis.accumulate import check_mergeable, merge_counts
+from lupe.analysis.stream import parsed_queries
+from lupe.parsing.cache import CATEGORIES, lookup_categories
 import csv
 
 MIN_LEN = 2
 MAX_LEN = 6
 
-def longest_common_subsequences_unweighted(source, querytype, output):
-    sequences_appearances = defaultdict(int)
-    sequences_queries = defaultdict(int)
-    nqueries = 0
-    for query in source.fetch_queries(querytype):
-        nqueries += 1
-        categories = lookup_categories(query)
+def longest_common_subsequences_unweighted(source, querytype, output, workers=1):
+    tally = SubsequenceTally()
+    for query in parsed_queries(source.fetch_queries(querytype), tally.fields, workers):
+        tally.update(query)
+    tally.write(output)
+
+class SubsequenceTally(object):
+    """Counts the appearances of each subsequence of transformations, and the
+    queries it appears in."""
+
+    fields = [CATEGORIES]
+
+    def __init__(self):
+        self.sequences_appearances = defaultdict(float)
+        self.sequences_queries = defaultdict(float)
+        self.nqueries = 0
+
+    def update(self, query):
+        categories = query.categories
+        count = float(query.count)
+        self.nqueries += query.count
         sequences_in_query = set()
         for length in range(MIN_LEN, MAX_LEN+1):
             for idx, item in enumerate(categories[:-length+1]):
                 sequence = tuple([length] + categories[idx:idx+length])
                 sequences_in_query.add(sequence)
-                sequences_appearances[sequence] += 1.
+                self.sequences_appearances[sequence] += count
         for sequence in sequences_in_query:
-            sequences_queries[sequence] += 1.
-    write_sequences(sequences_appearances, output, sequences_queries, nqueries)
+            self.sequences_queries[sequence] += count
+
+    def merge(self, other):
+        check_mergeable(self, other)
+        merge_counts(self.sequences_appearances, other.sequences_appearances)
+        merge_counts(self.sequences_queries, other.sequences_queries)
+        self.nqueries += other.nqueries
+
+    def finalize(self):
+        """Returns the appearances and queries of each subsequence, and the number of queries."""
+        return self.sequences_appearances, self.sequences_queries, self.nqueries
+
+    def write(self, output):
+        write_sequences(self.sequences_appearances, output, self.sequences_queries, self.nqueries)
 
 
 def longest_common_subsequences(source, querytype, output):
@@ -62,6 +90,8 @@ def write_sequences(sequences, output, total, nqueries):
 if __name__ == "__main__":
     from argparse import ArgumentParser
     parser = ArgumentParser(description="Prints list of longest common subsequences from all scheduled queries.")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of processes to parse queries with; 0 means one per CPU (default: 1)")
     args = get_arguments(parser, o=True)
     if all([arg is None for arg in vars(args).values()]):
         parser.print_help()
@@ -76,4 +106,4 @@ if __name__ == "__main__":
     src_class = SOURCES[args.source][0]
     src_args = lookup(vars(args), SOURCES[args.source][1])
     source = src_class(*src_args)
-    longest_common_subsequences_unweighted(source, args.querytype, args.output)
+    longest_common_subsequences_unweighted(source, args.querytype, args.output, args.jobs)
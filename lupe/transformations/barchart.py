@@ -1,11 +1,13 @@
-from collections import defaultdict
+from collections import Counter, defaultdict
 import numpy
 import matplotlib.pyplot as plt
 from queryutils.arguments import get_arguments, initialize_source
 from queryutils.parse import tokenize_query
-from queryutils.splunktypes import lookup_categories
+from lupe.analysis.accumulate import check_mergeable, merge_counts
+from lupe.analysis.stream import parsed_queries
+from lupe.parsing.cache import CATEGORIES
 
-def tally_and_plot(source, query_type, user_weighted, output):
+def tally_and_plot(source, query_type, user_weighted, output, workers=1):
     """Tallies and creates bar chart for percentage of stages and percentage of
     queries for each type of transformation.
 
@@ -22,11 +24,13 @@ def tally_and_plot(source, query_type, user_weighted, output):
     :type user_weighted: boolean
     :param output: the name of the output file containing the barchart
     :type output: str
+    :param workers: number of processes to parse queries with; 0 means one per CPU
+    :type workers: int
     """
-    stage_pcts, nstages, query_pcts, nqueries = tally(source, query_type, user_weighted)
+    stage_pcts, nstages, query_pcts, nqueries = tally(source, query_type, user_weighted, workers)
     plot_barchart(stage_pcts, nstages, query_pcts, nqueries, user_weighted, output)
 
-def tally(source, query_type, user_weighted=False):
+def tally(source, query_type, user_weighted=False, workers=1):
     """Calls either tally_weighted() or tally_unweighted() to tally percentage of stages
     and percentage of queries for each type of transformation.
 
@@ -36,14 +40,16 @@ def tally(source, query_type, user_weighted=False):
     :type query_type: str
     :param user_weighted: true if the data should be averaged across users
     :type user_weighted: boolean
+    :param workers: number of processes to parse queries with; 0 means one per CPU
+    :type workers: int
     :rtype: dict, int, dict, int
     """
     if user_weighted:
-        return tally_weighted(source, query_type)
+        return tally_weighted(source, query_type, workers)
     else:
-        return tally_unweighted(source, query_type)
+        return tally_unweighted(source, query_type, workers)
 
-def tally_weighted(source, query_type):
+def tally_weighted(source, query_type, workers=1):
     """Tallies percentage of stages and percentage of queries for each type of
     transformation averaged across users.
 
@@ -51,61 +57,17 @@ def tally_weighted(source, query_type):
     :type source: either a CSVFiles, JSONFiles, PostgresDB, or SQLite3DB
     :param query_type: type of queries to look at; either scheduled or interactive
     :type query_type: str
+    :param workers: number of processes to parse queries with; 0 means one per CPU
+    :type workers: int
     :rtype: dict, int, dict, int
     """
-    stage_cnt = {}
-    nstages = 0
-    nstages_per_user = defaultdict(int)
-
-    query_cnt = {}
-    nqueries = 0
-    nqueries_per_user = defaultdict(int)
-    all_transforms = set()
-
-    for (user, query) in source.fetch_queries_by_user(query_type):
-
-        transforms = lookup_categories(query)
-
-        nstages += len(transforms)
-        nstages_per_user[user] += len(transforms)
-        nqueries += 1
-        nqueries_per_user[user] += 1
-
-        if not user in stage_cnt:
-            stage_cnt[user] = defaultdict(int)
-        if not user in query_cnt:
-            query_cnt[user] = defaultdict(int)
-
-        for t in transforms:
-            stage_cnt[user][t] += 1
-        for t in set(transforms):
-            all_transforms.add(t)
-            query_cnt[user][t] += 1
-
-    stage_pct = defaultdict(list)
-    for (user, transform_counts) in stage_cnt.iteritems():
-        user_nstages = float(sum(transform_counts.values()))
-        assert user_nstages == nstages_per_user[user]
-        for t in all_transforms:
-            count = transform_counts.get(t, 0.)
-            user_pct = count / user_nstages
-            stage_pct[t].append(user_pct)
-    stage_pct = { t: numpy.mean(pcts) for (t, pcts) in stage_pct.iteritems() }
-
-    query_pct = defaultdict(list)
-    for (user, transform_counts) in query_cnt.iteritems():
-        user_nquerys = float(nqueries_per_user[user])
-        for t in all_transforms:
-            count = transform_counts.get(t, 0.)
-            user_pct = count / user_nquerys
-            query_pct[t].append(user_pct)
-    query_pct = { t: numpy.mean(pcts) for (t, pcts) in query_pct.iteritems() }
-
-    nstages_per_user = numpy.mean(nstages_per_user.values())
-    nqueries_per_user = numpy.mean(nqueries_per_user.values())
-    return stage_pct, nstages_per_user, query_pct, nqueries_per_user
-
-def tally_unweighted(source, query_type):
+    tally = TransformTally(user_weighted=True)
+    queries = source.fetch_queries_by_user(query_type)
+    for query in parsed_queries(queries, tally.fields, workers, users=True):
+        tally.update(query)
+    return tally.finalize()
+
+def tally_unweighted(source, query_type, workers=1):
     """Tallies percentage of stages and percentage of queries for each type of
     transformation.
 
@@ -113,30 +75,100 @@ def tally_unweighted(source, query_type):
     :type source: either a CSVFiles, JSONFiles, PostgresDB, or SQLite3DB
     :param query_type: type of queries to look at; either scheduled or interactive
     :type query_type: str
+    :param workers: number of processes to parse queries with; 0 means one per CPU
+    :type workers: int
     :rtype: dict, int, dict, int
     """
-    stage_cnt = defaultdict(int)
-    nstages = 0
-
-    query_cnt = defaultdict(int)
-    nqueries = 0
-
-    for query in source.get_queries(query_type):
-
-        transforms = lookup_categories(query)
-
-        nstages += len(transforms)
-        nqueries += 1
-
-        for t in transforms:
-            stage_cnt[t] += 1
-        for t in set(transforms):
-            query_cnt[t] += 1
-
-    stage_pct = { t: float(cnt)/nstages for (t, cnt) in stage_cnt.iteritems() }
-    query_pct = { t: float(cnt)/nqueries for (t, cnt) in query_cnt.iteritems() }
+    tally = TransformTally()
+    for query in parsed_queries(source.get_queries(query_type), tally.fields, workers):
+        tally.update(query)
+    return tally.finalize()
+
+class TransformTally(object):
+    """Counts the stages and queries each transformation appears in, per user if
+    user_weighted and otherwise over all queries. finalize() returns what
+    tally_weighted() or tally_unweighted() return.
+    """
 
-    return stage_pct, nstages, query_pct, nqueries
+    fields = [CATEGORIES]
+
+    def __init__(self, user_weighted=False):
+        self.user_weighted = user_weighted
+        self.stage_cnt = {}
+        self.query_cnt = {}
+        self.nstages = Counter()
+        self.nqueries = Counter()
+
+    def update(self, query):
+        """Counts a query, which is a lupe.analysis.stream.ParsedQuery with categories.
+        """
+        transforms = query.categories
+        for (user, count) in query.weights(self.user_weighted):
+            self.nstages[user] += len(transforms) * count
+            self.nqueries[user] += count
+            stage_cnt = self.stage_cnt.setdefault(user, Counter())
+            query_cnt = self.query_cnt.setdefault(user, Counter())
+            for t in transforms:
+                stage_cnt[t] += count
+            for t in set(transforms):
+                query_cnt[t] += count
+
+    def merge(self, other):
+        """Adds the counts of another TransformTally to this one.
+        """
+        check_mergeable(self, other, "user_weighted")
+        for name in ["stage_cnt", "query_cnt", "nstages", "nqueries"]:
+            merge_counts(getattr(self, name), getattr(other, name))
+
+    def finalize(self):
+        """Returns the percentage of stages and queries for each transformation and
+        the number of stages and queries, all averaged across users if user_weighted.
+
+        :rtype: dict, int, dict, int
+        """
+        if not self.user_weighted:
+            stage_cnt = self.stage_cnt.get(None, {})
+            query_cnt = self.query_cnt.get(None, {})
+            nstages = self.nstages[None]
+            nqueries = self.nqueries[None]
+            stage_pct = { t: float(cnt)/nstages for (t, cnt) in stage_cnt.iteritems() }
+            query_pct = { t: float(cnt)/nqueries for (t, cnt) in query_cnt.iteritems() }
+            return stage_pct, nstages, query_pct, nqueries
+
+        all_transforms = set()
+        for transform_counts in self.query_cnt.itervalues():
+            all_transforms.update(transform_counts)
+
+        stage_pct = defaultdict(list)
+        for (user, transform_counts) in self.stage_cnt.iteritems():
+            user_nstages = float(sum(transform_counts.values()))
+            assert user_nstages == self.nstages[user]
+            for t in all_transforms:
+                count = transform_counts.get(t, 0.)
+                user_pct = count / user_nstages
+                stage_pct[t].append(user_pct)
+        stage_pct = { t: numpy.mean(pcts) for (t, pcts) in stage_pct.iteritems() }
+
+        query_pct = defaultdict(list)
+        for (user, transform_counts) in self.query_cnt.iteritems():
+            user_nquerys = float(self.nqueries[user])
+            for t in all_transforms:
+                count = transform_counts.get(t, 0.)
+                user_pct = count / user_nquerys
+                query_pct[t].append(user_pct)
+        query_pct = { t: numpy.mean(pcts) for (t, pcts) in query_pct.iteritems() }
+
+        nstages_per_user = numpy.mean(self.nstages.values())
+        nqueries_per_user = numpy.mean(self.nqueries.values())
+        return stage_pct, nstages_per_user, query_pct, nqueries_per_user
+
+    def write(self, output):
+        """Plots the bar chart to output.
+        """
+        stage_pcts, nstages, query_pcts, nqueries = self.finalize()
+        plt.figure()
+        plot_barchart(stage_pcts, nstages, query_pcts, nqueries, self.user_weighted, output)
+        plt.close()
 
 def plot_barchart(stage_pcts, nstages, query_pcts, nqueries, user_weighted, output):
     """Plots bar chart of percentage of stages and percentage of queries for each type of transformation.
@@ -212,6 +244,8 @@ if __name__ == "__main__":
     from argparse import ArgumentParser
     parser = ArgumentParser(
         description="Bar graph describing how frequently each transformation appears in user queries.")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of processes to parse queries with; 0 means one per CPU (default: 1)")
     args = get_arguments(parser, o=True, w=True)
 
     if all([arg is None for arg in vars(args).values()]):
@@ -226,4 +260,4 @@ if __name__ == "__main__":
         raise RuntimeError("You must specify a query type.")
 
     source = initialize_source(args.source, args)
-    tally_and_plot(source, args.querytype, args.weighted, args.output)
+    tally_and_plot(source, args.querytype, args.weighted, args.output, args.jobs)
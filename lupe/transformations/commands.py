@@ -1,11 +1,13 @@
-from collections import defaultdict
+from collections import Counter, defaultdict
 import numpy
 import matplotlib.pyplot as plt
 from queryutils.arguments import get_arguments, lookup, SOURCES
 from queryutils.parse import tokenize_query
-from queryutils.splunktypes import lookup_categories, lookup_commands
+from lupe.analysis.accumulate import check_mergeable, merge_counts
+from lupe.analysis.stream import parsed_queries
+from lupe.parsing.cache import CATEGORIES, COMMANDS
 
-def main(source, query_type, user_weighted, output):
+def main(source, query_type, user_weighted, output, workers=1):
     """Calls either tally_weighted() or tally_unweighted() to tally commands per
     transformation along with the percentage of stages and queries they appear in.
 
@@ -17,13 +19,15 @@ def main(source, query_type, user_weighted, output):
     :type user_weighted: boolean
     :param output: the name of the output file containing the output data
     :type output: str
+    :param workers: number of processes to parse queries with; 0 means one per CPU
+    :type workers: int
     """
     if user_weighted:
-        return tally_weighted(source, query_type, output)
+        return tally_weighted(source, query_type, output, workers)
     else:
-        return tally_unweighted(source, query_type, output)
+        return tally_unweighted(source, query_type, output, workers)
 
-def tally_weighted(source, query_type, output):
+def tally_weighted(source, query_type, output, workers=1):
     """Tallies commands per transformation, then calls aggregate_stage_counts() and
     aggregate_query_counts() to calculate count and percentage of stages and queries
     commands appear in averaged across users.
@@ -34,44 +38,14 @@ def tally_weighted(source, query_type, output):
     :type query_type: str
     :param output: the name of the output file containing the output data
     :type output: str
+    :param workers: number of processes to parse queries with; 0 means one per CPU
+    :type workers: int
     """
-    stage_cnt = {}
-    query_cnt = {}
-    user_cnt = {}
-    query_tfm_cnt = {}
-    all_transforms = set()
-    all_commands = defaultdict(set)
-
-    for (user, query) in source.fetch_queries_by_user(query_type):
-
-        transforms = lookup_categories(query)
-        commands = lookup_commands(query)
-
-        if not user in stage_cnt:
-            stage_cnt[user] = defaultdict(int)
-        if not user in query_cnt:
-            query_cnt[user] = defaultdict(int)
-        if not user in query_tfm_cnt:
-            query_tfm_cnt[user] = defaultdict(int)
-
-        for (t, c) in zip(transforms, commands):
-            if not t in stage_cnt[user]:
-                stage_cnt[user][t] = defaultdict(int)
-            stage_cnt[user][t][c] += 1
-
-        #for (t, c) in [(v,k) for (k,v) in dict(zip(commands, transforms)).iteritems()]:
-        for (t, c) in set(zip(transforms, commands)):
-            all_commands[t].add(c)
-            if not t in query_cnt[user]:
-                query_cnt[user][t] = defaultdict(int)
-            query_cnt[user][t][c] += 1
-
-        for t in set(transforms):
-            query_tfm_cnt[user][t] += 1
-            all_transforms.add(t)
-
-    aggregate_stage_counts(stage_cnt, all_transforms, all_commands, output)
-    aggregate_query_counts(query_cnt, query_tfm_cnt, all_transforms, all_commands, output)
+    tally = CommandTally(user_weighted=True)
+    queries = source.fetch_queries_by_user(query_type)
+    for query in parsed_queries(queries, tally.fields, workers, users=True):
+        tally.update(query)
+    tally.write(output)
 
 def aggregate_stage_counts(stage_cnt, all_transforms, all_commands, output):
     """Calculates average count and percentage of stages for commands of each transformation.
@@ -164,7 +138,7 @@ def aggregate_query_counts(query_cnt, query_tfm_cnt, all_transforms, all_command
                 line = "%12s %50s %9d %3.2f\n" % (transform, command, count, percent)
                 out.write(line)
 
-def tally_unweighted(source, query_type, output):
+def tally_unweighted(source, query_type, output, workers=1):
     """Tallies commands per transformation as well as the counts of stages and queries
     in which they appear.
 
@@ -174,29 +148,26 @@ def tally_unweighted(source, query_type, output):
     :type query_type: str
     :param output: the name of the output file containing the output data
     :type output: str
+    :param workers: number of processes to parse queries with; 0 means one per CPU
+    :type workers: int
     """
-    stage_cnt = {}
-    query_cnt = {}
-    query_tfm_cnt = defaultdict(int)
+    tally = CommandTally()
+    for query in parsed_queries(source.fetch_queries(query_type), tally.fields, workers):
+        tally.update(query)
+    tally.write(output)
 
-    for query in source.fetch_queries(query_type):
-
-        transforms = lookup_categories(query)
-        commands = lookup_commands(query)
-
-        for (t, c) in zip(transforms, commands):
-            if not t in stage_cnt:
-                stage_cnt[t] = defaultdict(int)
-            stage_cnt[t][c] += 1
-
-        for (t, c) in [(v,k) for (k,v) in dict(zip(commands, transforms)).iteritems()]:
-            if not t in query_cnt:
-                query_cnt[t] = defaultdict(int)
-            query_cnt[t][c] += 1
-
-        for t in set(transforms):
-            query_tfm_cnt[t] += 1
+def write_unweighted(stage_cnt, query_cnt, query_tfm_cnt, output):
+    """Writes the count and percentage of stages and queries for commands of each transformation.
 
+    :param stage_cnt: dict of transformations to dict of commands' stage count
+    :type stage_cnt: dict
+    :param query_cnt: dict of transformations to dict of commands' query count
+    :type query_cnt: dict
+    :param query_tfm_cnt: dict of total counts of transformations
+    :type query_tfm_cnt: dict
+    :param output: the name of the output file containing the output data
+    :type output: str
+    """
     out = "%s-unweighted-stages-commands-counts.txt" % output
     with open(out, "w") as out:
         header = "%12s %50s %9s %5s\n" % ("transform", "command", "count", "percent")
@@ -222,10 +193,83 @@ def tally_unweighted(source, query_type, output):
                 out.write(line)
 
 
+class CommandTally(object):
+    """Counts the commands of each transformation in stages and queries, per user if
+    user_weighted and otherwise over all queries.
+    """
+
+    fields = [CATEGORIES, COMMANDS]
+
+    def __init__(self, user_weighted=False):
+        self.user_weighted = user_weighted
+        self.stage_cnt = {}
+        self.query_cnt = {}
+        self.query_tfm_cnt = {}
+
+    def update(self, query):
+        """Counts a query, which is a lupe.analysis.stream.ParsedQuery with
+        categories and commands.
+        """
+        transforms = query.categories
+        commands = query.commands
+        if self.user_weighted:
+            query_commands = set(zip(transforms, commands))
+        else:
+            query_commands = [(v,k) for (k,v) in dict(zip(commands, transforms)).iteritems()]
+        for (user, count) in query.weights(self.user_weighted):
+            stage_cnt = self.stage_cnt.setdefault(user, {})
+            query_cnt = self.query_cnt.setdefault(user, {})
+            query_tfm_cnt = self.query_tfm_cnt.setdefault(user, Counter())
+            for (t, c) in zip(transforms, commands):
+                stage_cnt.setdefault(t, Counter())[c] += count
+            for (t, c) in query_commands:
+                query_cnt.setdefault(t, Counter())[c] += count
+            for t in set(transforms):
+                query_tfm_cnt[t] += count
+
+    def merge(self, other):
+        """Adds the counts of another CommandTally to this one.
+        """
+        check_mergeable(self, other, "user_weighted")
+        for name in ["stage_cnt", "query_cnt", "query_tfm_cnt"]:
+            merge_counts(getattr(self, name), getattr(other, name))
+
+    def finalize(self):
+        """Returns the stage counts and query counts of each transformation's commands
+        and the query counts of each transformation, all keyed by user first if
+        user_weighted.
+
+        :rtype: dict, dict, dict
+        """
+        if self.user_weighted:
+            return self.stage_cnt, self.query_cnt, self.query_tfm_cnt
+        return (self.stage_cnt.get(None, {}), self.query_cnt.get(None, {}),
+            self.query_tfm_cnt.get(None, {}))
+
+    def write(self, output):
+        """Writes the tables of stage and query counts, named after output.
+        """
+        stage_cnt, query_cnt, query_tfm_cnt = self.finalize()
+        if not self.user_weighted:
+            write_unweighted(stage_cnt, query_cnt, query_tfm_cnt, output)
+            return
+        all_transforms = set()
+        for transform_counts in query_tfm_cnt.itervalues():
+            all_transforms.update(transform_counts)
+        all_commands = defaultdict(set)
+        for user_query_cnt in query_cnt.itervalues():
+            for (t, command_counts) in user_query_cnt.iteritems():
+                all_commands[t].update(command_counts)
+        aggregate_stage_counts(stage_cnt, all_transforms, all_commands, output)
+        aggregate_query_counts(query_cnt, query_tfm_cnt, all_transforms, all_commands, output)
+
+
 if __name__ == "__main__":
     from argparse import ArgumentParser
     parser = ArgumentParser(
         description="Prints commands for transformations including counts of stages and queries they appear in.")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of processes to parse queries with; 0 means one per CPU (default: 1)")
     args = get_arguments(parser, o=True, w=True)
     if all([arg is None for arg in vars(args).values()]):
         parser.print_help()
@@ -240,4 +284,4 @@ if __name__ == "__main__":
     src_class = SOURCES[args.source][0]
     src_args = lookup(vars(args), SOURCES[args.source][1])
     source = src_class(*src_args)
-    main(source, args.querytype, args.weighted, args.output)
+    main(source, args.querytype, args.weighted, args.output, args.jobs)
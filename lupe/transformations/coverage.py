@@ -1,47 +1,136 @@
-from collections import defaultdict
+import sys
+from collections import Counter
 import numpy as np
 import matplotlib.pyplot as plt
 from queryutils.arguments import get_arguments, lookup, SOURCES
 from queryutils.parse import tokenize_query
 from queryutils.query import QueryType
-from queryutils.splunktypes import lookup_categories
+from lupe.analysis.accumulate import check_mergeable
+from lupe.analysis.stream import parsed_queries
+from lupe.clustering.streaming import stream_query
+from lupe.parsing.cache import CATEGORIES, make_key
+from lupe.transformations.materialize import concat_categories, query_ids
 
-def main(source, querytype):
+def main(source, querytype, workers=1, itersize=None, materialized=False):
     """Calculates and prints count and percentage of all sets of transformations that occur in all queries.
 
     :param source: where to fetch the data and arguments
     :type source: either a CSVFiles, JSONFiles, PostgresDB, or SQLite3DB
     :param querytype: type of queries to look at; either scheduled or interactive
     :type querytype: str
+    :param workers: number of processes to parse queries with; 0 means one per CPU
+    :type workers: int
+    :param itersize: number of rows to fetch from the database at a time
+    :type itersize: int
+    :param materialized: count with SQL from the query_stages table (see materialize.py)
+    :type materialized: bool
     """
-    needs = defaultdict(int)
+    if materialized:
+        count_materialized(source, querytype).write(sys.stdout)
+        return
+    tally = CoverageTally()
     source.connect()
-    nqueries = 0
     if querytype == QueryType.INTERACTIVE:
-        cursor = source.execute("SELECT text FROM queries WHERE is_interactive=true AND is_suspicious=false")
+        sql = "SELECT text FROM queries WHERE is_interactive=true AND is_suspicious=false"
     elif querytype == QueryType.SCHEDULED:
-        cursor = source.execute("SELECT DISTINCT text FROM queries WHERE is_interactive=false")
+        sql = "SELECT DISTINCT text FROM queries WHERE is_interactive=false"
     else:
         raise RuntimeError("Invalid query type.")
-    for row in cursor.fetchall():
-        nqueries += 1
-        query = row["text"]
-        categories = lookup_categories(query)
-        need = list(set(categories))
-        need = tuple(sorted(need))
-        needs[need] += 1
-    needs = sorted(needs.iteritems(), key=lambda x: x[1], reverse=True)
-    print "Transformations, Count"
-    for (need, cnt) in needs:
-        pct = float(cnt) / float(nqueries)
-        print "%s, %d, %f" % (",".join(list(need)), cnt, pct)
+    queries = (row["text"] for row in stream_query(source, sql, itersize=itersize))
+    for query in parsed_queries(queries, tally.fields, workers):
+        tally.update(query)
+    tally.write(sys.stdout)
     source.close()
 
+def count_materialized(source, querytype):
+    """Counts the queries that use each set of transformations with GROUP BY over
+    the query_stages table.
+
+    :param source: where to fetch the data and arguments
+    :type source: either a PostgresDB or SQLite3DB
+    :param querytype: type of queries to look at; either scheduled or interactive
+    :type querytype: str
+    :rtype: CoverageTally
+    """
+    sql = ("SELECT needs.need AS need, COUNT(*) AS count FROM "
+        "(SELECT selected.id AS id, %s AS need FROM (%s) AS selected "
+        "LEFT JOIN query_stages ON query_stages.query_id = selected.id "
+        "GROUP BY selected.id) AS needs GROUP BY needs.need") % (
+        concat_categories(source), query_ids(querytype))
+    tally = CoverageTally()
+    source.connect()
+    for row in source.execute(sql):
+        # The categories of a query come in no particular order, and repeated.
+        need = tuple(sorted(set(row["need"].split(",")))) if row["need"] else ()
+        tally.needs[need] += row["count"]
+        tally.nqueries += row["count"]
+    source.close()
+    return tally
+
+class CoverageTally(object):
+    """Counts the queries that use each set of transformations. If distinct,
+    each distinct query text is counted once, even across merged tallies.
+    """
+
+    fields = [CATEGORIES]
+
+    def __init__(self, distinct=False):
+        self.distinct = distinct
+        self.needs = Counter()
+        self.nqueries = 0
+        self.texts = {} # if distinct, the set of transformations of each text
+
+    def update(self, query):
+        """Counts a query, which is a lupe.analysis.stream.ParsedQuery with categories.
+        """
+        need = tuple(sorted(set(query.categories)))
+        if self.distinct:
+            self.texts[make_key(query.text)] = need
+        else:
+            self.needs[need] += query.count
+            self.nqueries += query.count
+
+    def merge(self, other):
+        """Adds the counts of another CoverageTally to this one.
+        """
+        check_mergeable(self, other, "distinct")
+        self.needs.update(other.needs)
+        self.nqueries += other.nqueries
+        self.texts.update(other.texts)
+
+    def finalize(self):
+        """Returns (transformations, count, fraction of queries) for each set of
+        transformations, most common first.
+
+        :rtype: list
+        """
+        needs, nqueries = self.needs, self.nqueries
+        if self.distinct:
+            needs, nqueries = Counter(self.texts.itervalues()), len(self.texts)
+        needs = sorted(needs.iteritems(), key=lambda x: x[1], reverse=True)
+        return [(need, cnt, float(cnt) / float(nqueries)) for (need, cnt) in needs]
+
+    def write(self, out):
+        """Writes the table to out, which is a file name or an open file.
+        """
+        if isinstance(out, basestring):
+            with open(out, "w") as f:
+                return self.write(f)
+        out.write("Transformations, Count\n")
+        for (need, cnt, pct) in self.finalize():
+            out.write("%s, %d, %f\n" % (",".join(list(need)), cnt, pct))
+
 if __name__ == "__main__":
     from argparse import ArgumentParser
     parser = ArgumentParser(
         description="Calculates and prints count and percentage of all sets of transformations \
                     that occur in all queries.")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of processes to parse queries with; 0 means one per CPU (default: 1)")
+    parser.add_argument("--itersize", type=int,
+                        help="number of rows to fetch from the database at a time (default: 10000)")
+    parser.add_argument("--use-materialized", action="store_true",
+                        help="count with SQL from the query_stages table built by materialize.py")
     args = get_arguments(parser)
     if all([arg is None for arg in vars(args).values()]):
         parser.print_help()
@@ -54,4 +143,4 @@ if __name__ == "__main__":
     src_class = SOURCES[args.source][0]
     src_args = lookup(vars(args), SOURCES[args.source][1])
     source = src_class(*src_args)
-    main(source, args.querytype)
+    main(source, args.querytype, args.jobs, args.itersize, args.use_materialized)
@@ -4,7 +4,7 @@ import matplotlib.pyplot as plt
 from queryutils.arguments import get_arguments, lookup, SOURCES
 from queryutils.parse import tokenize_query
 from queryutils.query import QueryType
-from queryutils.splunktypes import lookup_categories
+from lupe.parsing.cache import lookup_categories
 
 def main(source, query_type, transform):
     print_transform_data(source, query_type, transform)
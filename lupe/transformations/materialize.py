@@ -0,0 +1,132 @@
+"""Stores the category and command of every stage of every query in the database.
+
+The query_stages table has a row (query_id, position, command, category) for
+each stage of each query, pairing the categories of the stages with the
+commands get_commands() finds, as topcmds.py does, or with NULL if it finds
+fewer commands than stages. Once it is built, the coverage and topcmds
+scripts can count with GROUP BY in the database instead of parsing every
+query text again (their --use-materialized option). Building it parses each
+distinct text once, through the parse cache:
+
+    python lupe/transformations/materialize.py -s postgresdb -U lupe -P lupe -D lupe -j 8
+
+The table is rebuilt from scratch each time, and must be rebuilt after new
+queries are loaded for the fast paths to count them.
+"""
+from operator import itemgetter
+from queryutils.arguments import get_arguments, initialize_source
+from queryutils.parse import tokenize_query
+from queryutils.query import QueryType
+from lupe.clustering.streaming import stream_query
+from lupe.parsing.cache import CATEGORIES
+from lupe.parsing.parallel import parse_queries
+
+INSERT_BATCH_SIZE = 1000
+
+SCHEMA = [
+    "DROP TABLE IF EXISTS query_stages",
+    "CREATE TABLE query_stages (query_id INTEGER NOT NULL, position INTEGER NOT NULL, "
+        "command TEXT, category TEXT, PRIMARY KEY (query_id, position))",
+]
+
+INDEXES = [
+    "CREATE INDEX query_stages_category_command ON query_stages (category, command)",
+]
+
+# The ids of the queries each query type counts. Scheduled queries are
+# counted once per distinct text.
+QUERY_IDS = {
+    QueryType.INTERACTIVE: "SELECT id FROM queries WHERE is_interactive=true AND is_suspicious=false",
+    QueryType.SCHEDULED: "SELECT MIN(id) AS id FROM queries WHERE is_interactive=false GROUP BY text",
+}
+
+def materialize(source, workers=1, itersize=None):
+    """Builds the query_stages table and its indexes for all of the queries in source.
+
+    :param source: where to fetch the data and arguments
+    :type source: either a PostgresDB or SQLite3DB
+    :param workers: number of processes to parse queries with; 0 means one per CPU
+    :type workers: int
+    :param itersize: number of rows to fetch from the database at a time
+    :type itersize: int
+    :rtype: int
+    """
+    source.connect()
+    try:
+        for statement in SCHEMA:
+            source.execute(statement)
+        insert = "INSERT INTO query_stages VALUES (%s)" % ", ".join([source.wildcard] * 4)
+        cursor = source.connection.cursor()
+        rows = stream_query(source, "SELECT id, text FROM queries", itersize=itersize)
+        queries = ((row["id"], row["text"]) for row in rows)
+        batch = []
+        nqueries = 0
+        for ((query_id, query), categories) in parse_queries(queries, [CATEGORIES], workers,
+                text=itemgetter(1)):
+            nqueries += 1
+            commands = get_commands(query)
+            for (position, category) in enumerate(categories):
+                # topcmds.py skips the categories left without a command.
+                command = commands[position] if position < len(commands) else None
+                batch.append((query_id, position, command, category))
+            if len(batch) >= INSERT_BATCH_SIZE:
+                cursor.executemany(insert, batch)
+                batch = []
+        if batch:
+            cursor.executemany(insert, batch)
+        for statement in INDEXES:
+            source.execute(statement)
+        source.connection.commit()
+        return nqueries
+    finally:
+        source.close()
+
+def get_commands(querystring):
+    commands = []
+    tokens = tokenize_query(querystring)
+    for token in tokens:
+        if token.type == "USER_DEFINED_COMMAND":
+            commands.append(token.value)
+        elif token.type == "MACRO":
+            commands.append(token.value)
+        elif token.type not in ["ARGS", "PIPE", "LBRACKET", "RBRACKET"]:
+            commands.append(token.value)
+    return commands
+
+def query_ids(querytype):
+    """Returns SQL selecting the ids of the queries of querytype to count, as a column named id.
+
+    :param querytype: type of queries to look at; either scheduled or interactive
+    :type querytype: str
+    :rtype: str
+    """
+    if querytype not in QUERY_IDS:
+        raise RuntimeError("Invalid query type.")
+    return QUERY_IDS[querytype]
+
+def concat_categories(source):
+    """Returns the SQL aggregate that joins the categories of a group of stages with commas.
+
+    :param source: where to fetch the data and arguments
+    :type source: either a PostgresDB or SQLite3DB
+    :rtype: str
+    """
+    if source.is_postgres():
+        return "string_agg(query_stages.category, ',')"
+    return "group_concat(query_stages.category, ',')"
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    parser = ArgumentParser(
+        description="Stores the category and command of every stage of every query in the query_stages table.")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of processes to parse queries with; 0 means one per CPU (default: 1)")
+    parser.add_argument("--itersize", type=int,
+                        help="number of rows to fetch from the database at a time (default: 10000)")
+    args = get_arguments(parser)
+    if args.source is None:
+        raise RuntimeError(
+            "You must specify where to fetch the data and the corresponding arguments (-s or --source).")
+    source = initialize_source(args.source, args)
+    nqueries = materialize(source, args.jobs, args.itersize)
+    print "Materialized the stages of %d queries." % nqueries
@@ -4,9 +4,11 @@ import matplotlib.pyplot as plt
 from queryutils.arguments import get_arguments, lookup, SOURCES
 from queryutils.parse import tokenize_query
 from queryutils.query import QueryType
-from queryutils.splunktypes import lookup_categories
+from lupe.clustering.streaming import stream_query
+from lupe.parsing.cache import lookup_categories
+from lupe.transformations.materialize import get_commands, query_ids
 
-def main(source, querytype, transformation):
+def main(source, querytype, transformation, itersize=None, materialized=False):
     """Calculates and prints top commands for a given transformation type.
 
     Calculates counts and percentages for each command in the given transformation
@@ -18,17 +20,45 @@ def main(source, querytype, transformation):
     :type querytype: str
     :param transformation: type of transformation to examine
     :type transformation: str
+    :param itersize: number of rows to fetch from the database at a time
+    :type itersize: int
+    :param materialized: count with SQL from the query_stages table (see materialize.py)
+    :type materialized: bool
+    """
+    if materialized:
+        counted = count_materialized(source, querytype, transformation)
+    else:
+        counted = count(source, querytype, transformation, itersize)
+    total = sum(counted.values())
+    counted = sorted(counted.iteritems(), key=lambda x: x[1], reverse=True)
+    print "command, count"
+    for (cmd, cnt) in counted:
+        pct = float(cnt) / total
+        print "%s, %d, %f" % (cmd, cnt, pct)
+
+def count(source, querytype, transformation, itersize=None):
+    """Counts the stages of each command in the given transformation type by parsing every query.
+
+    :param source: where to fetch the data and arguments
+    :type source: either a CSVFiles, JSONFiles, PostgresDB, or SQLite3DB
+    :param querytype: type of queries to look at; either scheduled or interactive
+    :type querytype: str
+    :param transformation: type of transformation to examine
+    :type transformation: str
+    :param itersize: number of rows to fetch from the database at a time
+    :type itersize: int
+    :rtype: dict
     """
     counted = defaultdict(int)
     source.connect()
     nqueries = 0
     if querytype == QueryType.INTERACTIVE:
-        cursor = source.execute("SELECT text FROM queries WHERE is_interactive=true AND is_suspicious=false")
+        sql = "SELECT text FROM queries WHERE is_interactive=true AND is_suspicious=false"
     elif querytype == QueryType.SCHEDULED:
-        cursor = source.execute("SELECT DISTINCT text FROM queries WHERE is_interactive=false")
+        sql = "SELECT DISTINCT text FROM queries WHERE is_interactive=false"
     else:
         raise RuntimeError("Invalid query type.")
-    for row in cursor.fetchall():
+    for row in stream_query(source, sql, itersize=itersize):
         nqueries += 1
         query = row["text"]
         categories = lookup_categories(query)
@@ -36,25 +66,27 @@ def main(source, querytype, transformation):
         for (category, command) in zip(categories, commands):
             if category == transformation:
                 counted[command] += 1
-    total = sum(counted.values())
-    counted = sorted(counted.iteritems(), key=lambda x: x[1], reverse=True)
-    print "command, count"
-    for (cmd, cnt) in counted:
-        pct = float(cnt) / total
-        print "%s, %d, %f" % (cmd, cnt, pct)
     source.close()
+    return counted
 
-def get_commands(querystring):
-    commands = []
-    tokens = tokenize_query(querystring)
-    for token in tokens:
-        if token.type == "USER_DEFINED_COMMAND":
-            commands.append(token.value)
-        elif token.type == "MACRO":
-            commands.append(token.value)
-        elif token.type not in ["ARGS", "PIPE", "LBRACKET", "RBRACKET"]:
-            commands.append(token.value)
-    return commands
+def count_materialized(source, querytype, transformation):
+    """Counts the stages of each command in the given transformation type with
+    GROUP BY over the query_stages table.
+
+    :param source: where to fetch the data and arguments
+    :type source: either a PostgresDB or SQLite3DB
+    :param querytype: type of queries to look at; either scheduled or interactive
+    :type querytype: str
+    :param transformation: type of transformation to examine
+    :type transformation: str
+    :rtype: dict
+    """
+    sql = ("SELECT command, COUNT(*) AS count FROM query_stages "
+        "WHERE category = %s AND command IS NOT NULL AND query_id IN (%s) GROUP BY command") % (source.wildcard, query_ids(querytype))
+    source.connect()
+    counted = dict((row["command"], row["count"]) for row in source.execute(sql, (transformation,)))
+    source.close()
+    return counted
 
 if __name__ == "__main__":
     from argparse import ArgumentParser
@@ -62,6 +94,10 @@ if __name__ == "__main__":
         description="Prints top commands for a given transformation type.")
     parser.add_argument("-t", "--transform",
                         help="the type of transformation to examine")
+    parser.add_argument("--itersize", type=int,
+                        help="number of rows to fetch from the database at a time (default: 10000)")
+    parser.add_argument("--use-materialized", action="store_true",
+                        help="count with SQL from the query_stages table built by materialize.py")
     args = get_arguments(parser)
     if all([arg is None for arg in vars(args).values()]):
         parser.print_help()
@@ -76,4 +112,4 @@ if __name__ == "__main__":
     src_class = SOURCES[args.source][0]
     src_args = lookup(vars(args), SOURCES[args.source][1])
     source = src_class(*src_args)
-    main(source, args.querytype, args.transformation)
+    main(source, args.querytype, args.transformation, args.itersize, args.use_materialized)
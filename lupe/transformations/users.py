@@ -1,16 +1,18 @@
-from collections import defaultdict
+from collections import Counter, defaultdict
 import numpy
 import matplotlib.pyplot as plt
 from queryutils.arguments import get_arguments, lookup, SOURCES
 from queryutils.parse import tokenize_query
 from queryutils.query import QueryType
-from queryutils.splunktypes import lookup_categories, lookup_commands
+from lupe.analysis.accumulate import check_mergeable, merge_counts
+from lupe.analysis.stream import parsed_queries
+from lupe.parsing.cache import CATEGORIES, COMMANDS
 
 class Category(object):
     TRANSFORMS = "transforms"
     COMMANDS = "commands"
 
-def main(source, query_type, output):
+def main(source, query_type, output, workers=1):
     """Calls tally_users_per() on transformations and commands and prints average, max, and min counts
     of each transformation or command per user.
 
@@ -25,11 +27,13 @@ def main(source, query_type, output):
     :type query_type: str
     :param output: the name of the output file containing the barchart
     :type output: str
+    :param workers: number of processes to parse queries with; 0 means one per CPU
+    :type workers: int
     """
-    tally_users_per(source, query_type, output, Category.TRANSFORMS)
-    tally_users_per(source, query_type, output, Category.COMMANDS)
+    tally_users_per(source, query_type, output, Category.TRANSFORMS, workers)
+    tally_users_per(source, query_type, output, Category.COMMANDS, workers)
 
-def tally_users_per(source, query_type, output, category):
+def tally_users_per(source, query_type, output, category, workers=1):
     """Calculates and prints average, max, and min counts of each transformation or command per user.
 
     This function calculates and prints the average distinct transformations, max distinct transformations,
@@ -43,39 +47,86 @@ def tally_users_per(source, query_type, output, category):
     :type output: str
     :param category: the category to tally, either transformations or commands
     :type category: Category
+    :param workers: number of processes to parse queries with; 0 means one per CPU
+    :type workers: int
     """
-    if category == Category.TRANSFORMS:
-        lookup_query = lookup_categories
-    elif category == Category.COMMANDS:
-        lookup_query = lookup_commands
+    tally = UserTally(category)
+    queries = source.fetch_queries_by_user(query_type)
+    for query in parsed_queries(queries, tally.fields, workers, users=True):
+        tally.update(query)
+    tally.write(output)
 
-    user_cnt = defaultdict(set)
-    ctgy_cnt = defaultdict(list)
+class UserTally(object):
+    """Counts the distinct users of each transformation or command, and the
+    transformations or commands each user ran.
+    """
+
+    def __init__(self, category):
+        if category == Category.TRANSFORMS:
+            self.field = CATEGORIES
+        elif category == Category.COMMANDS:
+            self.field = COMMANDS
+        else:
+            raise ValueError("Unknown category: " + str(category))
+        self.category = category
+        self.fields = [self.field]
+        self.user_cnt = defaultdict(set)
+        self.ctgy_cnt = {}
+
+    def update(self, query):
+        """Counts a query, which is a lupe.analysis.stream.ParsedQuery with the
+        categories or commands this tally is for.
+        """
+        categories = getattr(query, self.field)
+        for (user, count) in query.users.iteritems():
+            for c in categories:
+                self.user_cnt[c].add(user)
+                self.ctgy_cnt.setdefault(user, Counter())[c] += count
+
+    def merge(self, other):
+        """Adds the counts of another UserTally to this one.
+        """
+        check_mergeable(self, other, "category")
+        for (c, users) in other.user_cnt.iteritems():
+            self.user_cnt[c].update(users)
+        merge_counts(self.ctgy_cnt, other.ctgy_cnt)
+
+    def finalize(self):
+        """Returns the number of distinct users of each category, and the number of
+        distinct and total categories of each user.
 
-    for (user, query) in source.fetch_queries_by_user(query_type):
-        categories = lookup_query(query)
-        for c in categories:
-            user_cnt[c].add(user)
-            ctgy_cnt[user].append(c)
+        :rtype: dict, list, list
+        """
+        nusers = { c: len(users) for (c, users) in self.user_cnt.iteritems() }
+        distinct_ctgy_per = [len(c) for c in self.ctgy_cnt.values()]
+        total_ctgy_per = [sum(c.values()) for c in self.ctgy_cnt.values()]
+        return nusers, distinct_ctgy_per, total_ctgy_per
 
-    out = "%s-distinct-users-per-%s.txt" % (output, category)
-    with open(out, "w") as out:
-        header = "%12s %6s\n" % (category, "nusers")
-        out.write(header)
-        for (c, users) in user_cnt.iteritems():
-            line = "%12s %6d\n" % (c, len(users))
-            out.write(line)
-    distinct_ctgy_per = [len(set(c)) for c in ctgy_cnt.values()]
-    print "Average distinct %s per user: %.4f:" %  (category, numpy.mean(distinct_ctgy_per))
-    print "Max distinct %s per user: %.4f:" %  (category, numpy.max(distinct_ctgy_per))
-    print "Min distinct %s per user: %.4f:" %  (category, numpy.min(distinct_ctgy_per))
-    print "Average total %s per user: %.4f:" % (category, numpy.mean([len(c) for c in ctgy_cnt.values()]))
+    def write(self, output):
+        """Writes the number of users of each category to a file named after output
+        and prints the statistics per user.
+        """
+        category = self.category
+        nusers, distinct_ctgy_per, total_ctgy_per = self.finalize()
+        out = "%s-distinct-users-per-%s.txt" % (output, category)
+        with open(out, "w") as out:
+            header = "%12s %6s\n" % (category, "nusers")
+            out.write(header)
+            for (c, n) in nusers.iteritems():
+                line = "%12s %6d\n" % (c, n)
+                out.write(line)
+        print "Average distinct %s per user: %.4f:" %  (category, numpy.mean(distinct_ctgy_per))
+        print "Max distinct %s per user: %.4f:" %  (category, numpy.max(distinct_ctgy_per))
+        print "Min distinct %s per user: %.4f:" %  (category, numpy.min(distinct_ctgy_per))
+        print "Average total %s per user: %.4f:" % (category, numpy.mean(total_ctgy_per))
 
 if __name__ == "__main__":
     from argparse import ArgumentParser
     parser = ArgumentParser(
         description="Tallies and prints average distinct, max distinct, min distinct, and average total \
                     transforms and commands per user.")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of processes to parse queries with; 0 means one per CPU (default: 1)")
     args = get_arguments(parser, o=True)
     if all([arg is None for arg in vars(args).values()]):
         parser.print_help()
@@ -90,4 +141,4 @@ if __name__ == "__main__":
     src_class = SOURCES[args.source][0]
     src_args = lookup(vars(args), SOURCES[args.source][1])
     source = src_class(*src_args)
-    main(source, args.querytype, args.output)
+    main(source, args.querytype, args.output, args.jobs)